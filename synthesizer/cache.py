@@ -0,0 +1,188 @@
+"""
+    Persistent on-disk cache of numpy arrays.
+
+    Every entry is a directory named after a hash key, holding one .npy file
+    per array. Entries are loaded as read-only memory maps and evicted in
+    least-recently-used order once the total size exceeds a limit.
+
+    Compressed caches instead store every entry as a single .npz file, 
+    which is smaller on disk but fully loaded into memory when read.
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import numpy as np
+
+from synthesizer import utils
+
+
+class DiskCache():
+    def __init__(self, path='.synthesizer_cache', maxsize=10, compress=False):
+        """
+            Create a cache located at path, holding up to maxsize GB.
+            If compress is True, entries are stored as compressed .npz files.
+        """
+
+        self.path = path
+        self.maxsize = maxsize * 2**30
+        self.compress = compress
+
+    @staticmethod
+    def key(*args, **kwargs):
+        """ Hash key built from the representation of any set of values """
+        items = [repr(a) for a in args]
+        items += [f'{k}={v!r}' for k, v in sorted(kwargs.items())]
+        return hashlib.sha1('|'.join(items).encode()).hexdigest()
+
+    @staticmethod
+    def file_hash(*filenames, sample=2**20):
+        """
+            Content hash of one or more files. To keep it fast for very large
+            snapshots, only the size, the modification time and three blocks
+            of sample bytes (at the beginning, middle and end) of every file 
+            are hashed. The modification time catches files rewritten in 
+            place outside of the sampled blocks, at the cost of a miss for 
+            copies of a file.
+        """
+
+        sha = hashlib.sha1()
+        for filename in filenames:
+            stat = os.stat(filename)
+            size = stat.st_size
+            sha.update(f'{size} {stat.st_mtime_ns}'.encode())
+
+            with open(filename, 'rb') as f:
+                for offset in [0, size // 2, max(size - sample, 0)]:
+                    f.seek(offset)
+                    sha.update(f.read(sample))
+
+        return sha.hexdigest()
+
+    @staticmethod
+    def array_hash(*arrays):
+        """ Content hash of the values, shapes and types of numpy arrays """
+
+        sha = hashlib.sha1()
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            sha.update(f'{array.dtype.str}{array.shape}'.encode())
+            sha.update(array.tobytes())
+
+        return sha.hexdigest()
+
+    def get(self, key, names=None):
+        """
+            Return a dictionary with the arrays given by names (all of them
+            by default), memory-mapped from disk, or None if the entry does 
+            not exist.
+        """
+
+        if self.compress:
+            return self._get_compressed(key, names)
+
+        entry = os.path.join(self.path, key)
+        if not os.path.isdir(entry):
+            return None
+
+        if names is None:
+            names = [f[:-4] for f in os.listdir(entry) if f.endswith('.npy')]
+
+        files = [os.path.join(entry, f'{name}.npy') for name in names]
+        if not all(os.path.exists(f) for f in files):
+            return None
+
+        # Mark the entry as recently used
+        os.utime(entry)
+
+        return {n: np.load(f, mmap_mode='r') for n, f in zip(names, files)}
+
+    def _get_compressed(self, key, names=None):
+        """ Same as get(), for entries stored as .npz files """
+
+        entry = os.path.join(self.path, f'{key}.npz')
+        if not os.path.isfile(entry):
+            return None
+
+        with np.load(entry) as data:
+            if names is None:
+                names = data.files
+            if not all(name in data.files for name in names):
+                return None
+
+            arrays = {name: data[name] for name in names}
+
+        os.utime(entry)
+
+        return arrays
+
+    def put(self, key, arrays, evict=True):
+        """ 
+            Store a dictionary of arrays under key and evict old entries.
+            When storing many entries at once, pass evict=False and call 
+            evict() only once at the end. Returns the path of the entry.
+        """
+
+        if self.compress:
+            entry = os.path.join(self.path, f'{key}.npz')
+            tmp = f'{entry[:-4]}.tmp{os.getpid()}.npz'
+            os.makedirs(self.path, exist_ok=True)
+            np.savez_compressed(tmp, **arrays)
+            os.replace(tmp, entry)
+
+            if evict:
+                self.evict(keep=[entry])
+            return entry
+
+        entry = os.path.join(self.path, key)
+        tmp = f'{entry}.tmp{os.getpid()}'
+        os.makedirs(tmp, exist_ok=True)
+
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, f'{name}.npy'), array)
+
+        # Move into place at once, so no incomplete entry is ever read
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.replace(tmp, entry)
+
+        if evict:
+            self.evict(keep=[entry])
+
+        return entry
+
+    def evict(self, keep=()):
+        """ 
+            Remove the least recently used entries beyond the size limit, 
+            except those in keep (i.e., the entries just stored).
+        """
+
+        if not os.path.isdir(self.path):
+            return
+
+        entries = []
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            if '.tmp' in name:
+                continue
+            if self.compress and name.endswith('.npz'):
+                size = os.path.getsize(entry)
+            elif not self.compress and os.path.isdir(entry):
+                size = sum(f.stat().st_size for f in os.scandir(entry))
+            else:
+                continue
+            entries.append((os.path.getmtime(entry), size, entry))
+
+        total = sum(e[1] for e in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.maxsize:
+                break
+            if entry in keep:
+                continue
+            utils.print_(f'Evicting cache entry {os.path.basename(entry)}')
+            if self.compress:
+                os.remove(entry)
+            else:
+                shutil.rmtree(entry)
+            total -= size
@@ -1 +1 @@
-from .dustmixer import Dust
+from .dustmixer import Dust, size_grid, sizes_per_decade
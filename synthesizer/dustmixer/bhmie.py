@@ -2,6 +2,7 @@
 
 import numpy as np
 import math
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 def bhmie(x,refrel,theta):
     """
@@ -165,3 +166,259 @@ def bhmie(x,refrel,theta):
     # Return results
     #
     return S1, S2, Qext, Qsca, Qabs, Qback, gsca
+
+
+def angular_functions(nstop, theta):
+    """
+    Angular functions pi_n(mu) and tau_n(mu) of the Mie series, for orders
+    n = 1, ..., nstop, as used by bhmie(). They do not depend on the size 
+    parameter, so they are shared by every grain size and wavelength.
+
+    Arguments:
+      nstop  = Number of orders of the series expansion
+      theta  = A numpy array of scattering angles between 0 and 180.
+
+    Returns:
+      P, T   = numpy arrays of shape (nstop, nang), such that 
+               S1 = sum_n fn*(an*P[n] + bn*T[n]) and 
+               S2 = sum_n fn*(an*T[n] + bn*P[n])
+    """
+    nang   = len(theta)
+    mu     = np.cos(theta*math.pi/180.)
+    P      = np.zeros((nstop,nang),dtype=np.float64)
+    T      = np.zeros((nstop,nang),dtype=np.float64)
+    pi0    = np.zeros(nang,dtype=np.float64)
+    pi1    = np.zeros(nang,dtype=np.float64) + 1.0
+    p      = -1.0
+    #
+    # Same upward recurrence as bhmie(), over |mu|, flipping the signs 
+    # for mu<0 
+    #
+    for n in range(nstop):
+        en      = float(n+1)
+        pi      = pi1.copy()
+        tau     = en * np.abs(mu) * pi - (en+1.0) * pi0
+        p       = -p
+        P[n]    = np.where(mu>=0, pi, p*pi)
+        T[n]    = np.where(mu>=0, tau, -p*tau)
+        pi1     = ( (2*en+1.0)*np.abs(mu)*pi - (en+1.0)*pi0 ) / en
+        pi0     = pi
+    return P, T
+
+def mie_batch(x,refrel,theta,amplitudes=True,P=None,T=None):
+    """
+    Mie series for one batch of size parameters, used by bhmie_batch(). 
+    It only needs plain arrays, so it can run in a worker process.
+
+    Arguments:
+      x          = numpy array of size parameters
+      refrel     = numpy array of complex indices of refraction, as x
+      theta      = A numpy array of scattering angles between 0 and 180.
+      amplitudes = If False, S1 and S2 are only evaluated at 0 and 180 
+                   degrees, as needed for Qext and Qback
+      P, T       = Optional angular functions with at least as many orders
+                   as the batch needs (see angular_functions)
+
+    Returns:
+      S1, S2 (with shape (x.size, nang), or (x.size, 2) if not amplitudes),
+      Qsca and gsca sums over the orders.
+    """
+    y      = x*refrel
+    xstop  = x + 4 * x**0.3333 + 2.0
+    nstop  = np.floor(xstop).astype(int)
+    nmx    = np.floor(np.maximum(xstop, np.abs(y))).astype(int) + 15
+    N      = nstop.max()
+    if P is None:
+        P, T = angular_functions(N, theta)
+    P, T   = P[:N], T[:N]
+    if not amplitudes:
+        ends = [0, len(theta)-1]
+        P, T = P[:, ends], T[:, ends]
+    #
+    # Logarithmic derivative dlog by downward recurrence, beginning 
+    # with 0.+0j at nmx-1 of every size parameter
+    #
+    dlog   = np.zeros((N,x.size),dtype=np.complex128)
+    d      = np.zeros(x.size,dtype=np.complex128)
+    for n in range(nmx.max()-2, -1, -1):
+        en     = float(n+2)
+        d      = np.where(n < nmx-1, en/y - 1.0/(d+en/y), 0j)
+        if n < N:
+            dlog[n] = d
+    #
+    # Riccati-Bessel functions by upward recurrence. Orders beyond 
+    # nstop are masked, so they add nothing to the sums. Their 
+    # recurrences may overflow, which is harmless.
+    #
+    psi0   =  np.cos(x)
+    psi1   =  np.sin(x)
+    chi0   = -np.sin(x)
+    chi1   =  np.cos(x)
+    xi1    =  psi1 - chi1*1j
+    an     =  np.zeros(x.size,dtype=np.complex128)
+    bn     =  np.zeros(x.size,dtype=np.complex128)
+    Qsca   =  np.zeros(x.size,dtype=np.float64)
+    gsca   =  np.zeros(x.size,dtype=np.float64)
+    A      =  np.zeros((N,x.size),dtype=np.complex128)
+    B      =  np.zeros((N,x.size),dtype=np.complex128)
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        for n in range(N):
+            en      = float(n+1)
+            fn      = (2*en+1.0)/(en*(en+1.0))
+            psi     = (2*en-1.0)*psi1/x - psi0
+            chi     = (2*en-1.0)*chi1/x - chi0
+            xi      = psi - chi*1j
+            an1     = an
+            bn1     = bn
+            dum     = dlog[n]/refrel + en/x
+            an      = ( dum * psi - psi1 ) / ( dum * xi - xi1 )
+            dum     = dlog[n]*refrel + en/x
+            bn      = ( dum * psi - psi1 ) / ( dum * xi - xi1 )
+            mask    = n < nstop
+            an      = np.where(mask, an, 0j)
+            bn      = np.where(mask, bn, 0j)
+            #
+            # Add contributions to Qsca and gsca
+            #
+            Qsca   += ( 2*en + 1.0 ) * ( np.abs(an)**2 + np.abs(bn)**2 )
+            dum     = ( 2*en + 1.0 ) / ( en*(en+1.0) )
+            gsca   += dum * ( an.real*bn.real + an.imag*bn.imag )
+            dum     = (en-1.0)*(en+1.0) / en
+            gsca   += dum * ( an1.real*an.real + an1.imag*an.imag +
+                              bn1.real*bn.real + bn1.imag*bn.imag )
+            A[n]    = fn * an
+            B[n]    = fn * bn
+            #
+            # Now prepare for the next iteration
+            #
+            psi0    = psi1
+            psi1    = psi
+            chi0    = chi1
+            chi1    = chi
+            xi1     = psi1 - chi1*1j
+    #
+    # Scattering intensity pattern as a function of angle, summed over
+    # orders as real matrix products
+    #
+    S1 = A.real.T @ P + B.real.T @ T + 1j*(A.imag.T @ P + B.imag.T @ T)
+    S2 = A.real.T @ T + B.real.T @ P + 1j*(A.imag.T @ T + B.imag.T @ P)
+
+    return S1, S2, Qsca, gsca
+
+def bhmie_batch(x,refrel,theta,batchsize=2**20,progress=None,nproc=1,
+        amplitudes=True):
+    """
+    Vectorized version of bhmie(), which evaluates the Mie series for a
+    whole array of size parameters (e.g., for every grain size and 
+    wavelength) at once. 
+
+    Size parameters are sorted and split into batches of similar nstop. 
+    The dlog and Riccati-Bessel recurrences run over every batch at once, 
+    padded to the largest nstop of the batch, with the coefficients an and
+    bn of the orders beyond the nstop of every size parameter masked to 0. 
+    The angular sums are then matrix products with the angular functions 
+    pi_n and tau_n, which are common to all of them.
+
+    Batches can be evaluated by a pool of nproc processes, which only 
+    receive the size parameters and refractive indices of their batch. 
+    Batches do not depend on nproc, so results are byte-identical to a 
+    serial run.
+
+    Arguments:
+      x          = numpy array of size parameters 2*pi*radius_grain/lambda
+      refrel     = Complex index of refraction, either a scalar or an array
+                   of the same shape as x
+      theta      = A numpy array of scattering angles between 0 and 180.
+      batchsize  = Maximum number of padded orders times size parameters 
+                   per batch, which bounds the memory usage
+      progress   = Optional function called with the number of size 
+                   parameters done after every batch
+      nproc      = Number of processes evaluating the batches
+      amplitudes = If False, S1 and S2 are not returned (None), which 
+                   saves their evaluation at every angle
+    
+    Returns:
+      S1, S2 (with shape x.shape + (nang,)) and Qext, Qsca, Qabs, Qback and
+      gsca (with shape x.shape), as returned by bhmie().
+    """
+    #
+    # Check the angle grid as bhmie() does
+    #
+    nang = len(theta)
+    if theta[0]==0.0:
+        assert theta[nang-1]==180, "Error in bhmie_batch(): Angle grid must extend from 0 to 180 degrees."
+        iang0   = 0
+        iang180 = nang-1
+    else:
+        assert theta[0]==180, "Error in bhmie_batch(): Angle grid must extend from 0 to 180 degrees."
+        assert theta[nang-1]==0, "Error in bhmie_batch(): Angle grid must extend from 0 to 180 degrees."
+        iang0   = nang-1
+        iang180 = 0
+    #
+    # Flatten the inputs and sort them by size parameter
+    #
+    shape  = np.shape(x)
+    x      = np.ravel(x).astype(np.float64)
+    refrel = np.broadcast_to(refrel, shape).ravel().astype(np.complex128)
+    order  = np.argsort(x, kind='stable')
+    nstop  = np.floor(x + 4 * x**0.3333 + 2.0).astype(int)
+    #
+    # Split into the largest batches of sorted size parameters whose 
+    # padded orders fit within batchsize
+    #
+    batches = []
+    i0 = 0
+    while i0 < x.size:
+        padded = nstop[order[i0:]] * np.arange(1, x.size-i0+1)
+        i1     = i0 + max(1, np.searchsorted(padded, batchsize, side='right'))
+        batches.append(order[i0:i1])
+        i0     = i1
+    #
+    # Evaluate the batches, storing S1 and S2 at every angle or only at the
+    # ends (0 and 180 degrees)
+    #
+    ncol   = nang if amplitudes else 2
+    S1     = np.zeros((x.size,ncol),dtype=np.complex128)
+    S2     = np.zeros((x.size,ncol),dtype=np.complex128)
+    Qsca   = np.zeros(x.size,dtype=np.float64)
+    gsca   = np.zeros(x.size,dtype=np.float64)
+
+    def store(idx, result):
+        S1[idx], S2[idx], Qsca[idx], gsca[idx] = result
+        store.done += idx.size
+        if progress is not None:
+            progress(store.done)
+    store.done = 0
+
+    if nproc > 1:
+        with ProcessPoolExecutor(max_workers=nproc) as pool:
+            # Submit the largest batches first, to balance the load
+            futures = {pool.submit(mie_batch, x[idx], refrel[idx], theta, 
+                amplitudes): idx for idx in batches[::-1]}
+            for future in as_completed(futures):
+                store(futures[future], future.result())
+    else:
+        P, T = angular_functions(nstop.max(initial=0), theta)
+        for idx in batches:
+            store(idx, mie_batch(x[idx], refrel[idx], theta, amplitudes, P, T))
+    #
+    # Now do the final calculations
+    #
+    if not amplitudes:
+        iang0, iang180 = (0, 1) if iang0 == 0 else (1, 0)
+    gsca  = 2*gsca/Qsca
+    Qsca  = (2.0/(x*x))*Qsca
+    Qext  = (4.0/(x*x))*S1[:,iang0].real
+    Qback = (abs(S1[:,iang180])/x)**2 / math.pi
+    Qabs  = Qext - Qsca
+    #
+    # Return results with the shape of x
+    #
+    if amplitudes:
+        S1 = S1.reshape(shape+(nang,))
+        S2 = S2.reshape(shape+(nang,))
+    else:
+        S1 = S2 = None
+
+    return S1, S2, Qext.reshape(shape), Qsca.reshape(shape), \
+        Qabs.reshape(shape), Qback.reshape(shape), gsca.reshape(shape)
@@ -21,7 +21,6 @@ import os
 import sys
 import copy
 import errno
-import itertools
 import progressbar
 import numpy as np
 from pathlib import Path
@@ -29,7 +28,6 @@ from astropy.io import ascii
 from astropy import units as u
 import matplotlib.pyplot as plt
 from time import time, strftime, gmtime
-import multiprocessing
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from scipy.interpolate import interp1d
 
@@ -37,6 +35,54 @@ from synthesizer import utils
 from synthesizer.dustmixer import bhmie, bhcoat
 
 
+def trapezoid_weights(x):
+    """
+        Weights w of the trapezoidal rule over the samples x, such that the
+        integral of y over x is y @ w. Integrals of whole arrays along one 
+        axis then become tensor contractions.
+    """
+    dx = np.diff(x)
+    w = np.zeros(np.size(x))
+    w[:-1] += dx / 2
+    w[1:] += dx / 2
+
+    return w
+
+
+def sizes_per_decade(amin, amax, na):
+    """
+        Smallest power of two of sizes per decade that samples the range 
+        [amin, amax] with at least na sizes.
+    """
+    decades = np.log10(amax / amin)
+    return int(2**np.ceil(np.log2(max((na - 1) / decades, 1))))
+
+
+def size_grid(amin, amax, na=100, ppd=None):
+    """
+        Grain sizes between amin and amax (in microns), with at least na 
+        sizes, or ppd sizes per decade if given. 
+        
+        Besides amin and amax, sizes are taken from the fixed grid 
+        10^(k/ppd) microns, with ppd a power of two. Grids of different 
+        ranges, or of finer sampling, then share their sizes, so that 
+        efficiencies cached for one distribution are reused by the others.
+    """
+    if na == 1 or amin == amax:
+        return np.logspace(np.log10(amin), np.log10(amax), na)
+
+    if ppd is None:
+        ppd = sizes_per_decade(amin, amax, na)
+
+    k = np.arange(np.ceil(np.log10(amin) * ppd), 
+        np.floor(np.log10(amax) * ppd) + 1)
+    a = 10**(k / ppd)
+    a = a[~np.isclose(a, amin, rtol=1e-10) & ~np.isclose(a, amax, rtol=1e-10)]
+    a = a[(a > amin) & (a < amax)]
+
+    return np.concatenate([[amin], a, [amax]])
+
+
 class Dust():
     """ Dust object. Defines the properties of a dust component. """
     verbose = False
@@ -54,6 +100,7 @@ class Dust():
         self.Qext = None
         self.Qsca = None
         self.Qabs = None
+        self.Qext_a = []
         self.kext = None
         self.ksca = None
         self.kabs = None
@@ -61,6 +108,7 @@ class Dust():
         self.scatmatrix = scatmatrix
         self.l = np.logspace(-1, 5, 200) * u.micron.to(u.cm)
         self.pb = True
+        self.nproc = 1
 
     def __str__(self):
         print(f'{self.name}')
@@ -199,7 +247,7 @@ class Dust():
 
         # Optionally read the density as the second number from the file header
         if get_dens:
-            dens = float(ascii.read(path, data_end=1)['col2'])
+            dens = float(ascii.read(path, data_end=1)['col2'][0])
             self.set_density(dens)
 
         print(f' | Density: {dens} g/cm3' if get_dens else '')
@@ -285,16 +333,24 @@ class Dust():
         return eps_mean.real.squeeze(), eps_mean.imag.squeeze()
         
     def get_efficiencies(self, a, nang=3, algorithm='bhmie', coat=None, 
-            verbose=True, parallel_counter=0):
+            verbose=True, progress=None):
         """ 
             Compute the extinction, scattering and absorption
             efficiencies (Q) by calling bhmie or bhcoat.
 
+            With bhmie, all wavelengths are computed at once by the 
+            vectorized bhmie.bhmie_batch(), over self.nproc processes. 
+            a can also be an array of grain sizes, which are then computed 
+            at once too, adding a leading axis over sizes to all the 
+            returned arrays.
+
             Arguments: 
-              - a: Size of the dust grain in cm
+              - a: Size of the dust grain in cm, or an array of sizes
               - nang: Number of angles to sample scattering between 0 and 180
               - algorithm: 'bhmie' or 'bhcoat', algorithm used to calculate Q 
               - coat: Dust Object, material used as a iced coat for the grain
+              - progress: Function called with the number of (size, 
+                wavelength) pairs done, as computation progresses
         
             Returns:
               - Qext: Dust extinction efficiency
@@ -303,68 +359,68 @@ class Dust():
               - gsca: Assymetry parameter for Henyey-Greenstein scattering
         """
 
+        shape = np.shape(a) + self.l.shape
         self.angles = np.linspace(0, 180, self.nang)
         self.mass  = (4 / 3 * np.pi) * self.dens * a**3
-        self.Qext = np.zeros(self.l.size)
-        self.Qsca = np.zeros(self.l.size)
-        self.Qabs = np.zeros(self.l.size)
-        self.Qbac = np.zeros(self.l.size)
-        self.Gsca = np.zeros(self.l.size)
+        self.Qext = np.zeros(shape)
+        self.Qsca = np.zeros(shape)
+        self.Qabs = np.zeros(shape)
+        self.Qbac = np.zeros(shape)
+        self.Gsca = np.zeros(shape)
         self.s11 = np.zeros(nang)
         self.s12 = np.zeros(nang)
         self.s33 = np.zeros(nang)
         self.s34 = np.zeros(nang)
-        self.Z11 = np.zeros((self.l.size, nang))
-        self.Z12 = np.zeros((self.l.size, nang))
-        self.Z22 = np.zeros((self.l.size, nang))
-        self.Z33 = np.zeros((self.l.size, nang))
-        self.Z34 = np.zeros((self.l.size, nang))
-        self.Z44 = np.zeros((self.l.size, nang))
+        self.Z11 = np.zeros(shape + (nang,))
+        self.Z12 = np.zeros(shape + (nang,))
+        self.Z22 = np.zeros(shape + (nang,))
+        self.Z33 = np.zeros(shape + (nang,))
+        self.Z34 = np.zeros(shape + (nang,))
+        self.Z44 = np.zeros(shape + (nang,))
         self.current_a = a
         a_micron = a * u.cm.to(u.micron)
 
-        utils.print_(f'Calulating {self.name} efficiencies Q for a grain size'+\
-            f' of {np.round(a_micron, 1)} microns', verbose=verbose)
+        if np.ndim(a) == 0:
+            utils.print_(f'Calulating {self.name} efficiencies Q for a '+\
+                f'grain size of {np.round(a_micron, 1)} microns', 
+                verbose=verbose)
+        else:
+            utils.print_(f'Calulating {self.name} efficiencies Q for '+\
+                f'{np.size(a)} grain sizes between ' +\
+                f'{np.round(a_micron.min(), 1)} and ' +\
+                f'{np.round(a_micron.max(), 1)} microns', verbose=verbose)
 
         # Calculate dust efficiencies for a bare grain
         if algorithm.lower() == 'bhmie':
-            
-            # Iterate over wavelength
-            for i, l_ in enumerate(self.l):
-                # Define the size parameter
-                self.x = 2 * np.pi * a / l_
 
-                # Define the complex refractive index (m)
-                self.m = complex(self.n[i], self.k[i])
-                
-                # Compute dust efficiencies using BHMIE (Bohren & Huffman 1986)
-                bhmie_ = bhmie.bhmie(self.x, self.m, self.angles)
-                
-                # Store the results
-                s1 = bhmie_[0]
-                s2 = bhmie_[1]
-                self.Qext[i] = bhmie_[2]
-                self.Qsca[i] = bhmie_[3]
-                self.Qabs[i] = bhmie_[4]
-                self.Qbac[i] = bhmie_[5]
-                self.Gsca[i] = bhmie_[6]
+            # Define the size parameters, for every size and wavelength
+            self.x = np.divide.outer(2 * np.pi * a, self.l)
 
-                if self.scatmatrix:
-                    # Compute the Scattering Matrix Elements
-                    self.s11 = 0.5 * (np.abs(s2)**2 + np.abs(s1)**2)
-                    self.s12 = 0.5 * (np.abs(s2)**2 - np.abs(s1)**2)
-                    self.s33 = 0.5 * np.real(s1 * np.conj(s2) + s2 * np.conj(s1))
-                    self.s34 = 0.5 * np.imag(s1 * np.conj(s2) - s2 * np.conj(s1))
-                    
-                    # Normlize the Scattering Matrix 
-                    k = 2 * np.pi / l_
-                    factor = 1 / (k**2 * self.mass)
-                    self.Z11[i, :] = self.s11 / (k**2 * self.mass)
-                    self.Z12[i, :] = self.s12 / (k**2 * self.mass)
-                    self.Z22[i, :] = self.s11 / (k**2 * self.mass)
-                    self.Z33[i, :] = self.s33 / (k**2 * self.mass)
-                    self.Z34[i, :] = self.s34 / (k**2 * self.mass)
-                    self.Z44[i, :] = self.s33 / (k**2 * self.mass)
+            # Define the complex refractive index (m)
+            self.m = np.broadcast_to(self.n + self.k * 1j, shape)
+
+            # Compute dust efficiencies using BHMIE (Bohren & Huffman 1986)
+            s1, s2, self.Qext, self.Qsca, self.Qabs, self.Qbac, self.Gsca = \
+                bhmie.bhmie_batch(self.x, self.m, self.angles, 
+                    progress=progress, nproc=self.nproc, 
+                    amplitudes=self.scatmatrix)
+
+            if self.scatmatrix:
+                # Compute the Scattering Matrix Elements
+                self.s11 = 0.5 * (np.abs(s2)**2 + np.abs(s1)**2)
+                self.s12 = 0.5 * (np.abs(s2)**2 - np.abs(s1)**2)
+                self.s33 = 0.5 * np.real(s1 * np.conj(s2) + s2 * np.conj(s1))
+                self.s34 = 0.5 * np.imag(s1 * np.conj(s2) - s2 * np.conj(s1))
+                
+                # Normlize the Scattering Matrix 
+                k = 2 * np.pi / self.l
+                factor = np.multiply.outer(self.mass, k**2)[..., None]
+                self.Z11 = self.s11 / factor
+                self.Z12 = self.s12 / factor
+                self.Z22 = self.s11 / factor
+                self.Z33 = self.s33 / factor
+                self.Z34 = self.s34 / factor
+                self.Z44 = self.s33 / factor
 
         # Calculate dust efficiencies for a coated grain
         elif algorithm.lower() == 'bhcoat':
@@ -400,22 +456,69 @@ class Dust():
         else:
             raise ValueError(f'Invalid value for algorithm = {algorithm}.')
 
-        # Print a simpler progress meter if using multiprocessing
-        if self.nproc > 1 and self.pb:
-            i = parallel_counter
-            counter = i * 100 / self.a.size
-            endl = '\r' if i != self.a.size-1 else '\n'
-            bar = (' ' * 20).replace(" ", "⣿⣿", int(counter / 100 * 20))
-            sys.stdout.write(f'[get_efficiencies] Using {self.nproc} processes'+\
-                f' | Progress: {counter} % |{bar:>20}| {endl}')
-            sys.stdout.flush()
-
         return self.Qext, self.Qsca, self.Qabs, self.Gsca, \
             self.Z11, self.Z12, self.Z22, self.Z33, self.Z34, self.Z44
 
-        
+    def get_cached_efficiencies(self, a, nang, cache, algorithm='bhmie', 
+            progress=None):
+        """
+            Same as get_efficiencies() for an array of grain sizes a (in cm),
+            but reusing the efficiencies of every size stored in cache (a 
+            DiskCache) by previous runs. Only the missing sizes are computed, 
+            and then stored for later runs.
+
+            Entries are addressed by the content of the optical constants 
+            and wavelength grid, the material density, the number of angles 
+            and the grain size (to 10 significant digits), so they are 
+            shared by any size distribution sampling the same sizes.
+        """
+
+        names = ['Qext', 'Qsca', 'Qabs', 'gsca']
+        if self.scatmatrix:
+            names += ['Z11', 'Z12', 'Z33', 'Z34']
+
+        material = cache.array_hash(self.l, self.n, self.k)
+        keys = [cache.key(material=material, dens=float(self.dens), 
+            nang=nang, scatmatrix=self.scatmatrix, algorithm=algorithm, 
+            a=float(f'{a_:.10g}')) for a_ in a]
+
+        cached = [cache.get(key, names) for key in keys]
+        missing = [i for i, c in enumerate(cached) if c is None]
+
+        if len(missing) < len(a):
+            utils.print_(f'Loading efficiencies of {len(a) - len(missing)} '+\
+                f'grain sizes from {cache.path}')
+
+        if len(missing) > 0:
+            done = (len(a) - len(missing)) * self.l.size
+            results = self.get_efficiencies(a[missing], nang, algorithm, 
+                None, False, progress=None if progress is None else 
+                    lambda n: progress(done + n))
+
+            stored = []
+            for j, i in enumerate(missing):
+                cached[i] = dict(zip(names, [r[j] for r in results[:4]]))
+                if self.scatmatrix:
+                    cached[i].update(Z11=results[4][j], Z12=results[5][j], 
+                        Z33=results[7][j], Z34=results[8][j])
+                stored.append(cache.put(keys[i], cached[i], evict=False))
+
+            cache.evict(keep=stored)
+
+        qe, qs, qa, gs = [np.array([c[n] for c in cached]) for n in names[:4]]
+
+        # Z22 and Z44 equal Z11 and Z33 for spherical grains, so only the 
+        # independent elements are stored
+        if self.scatmatrix:
+            z11, z12, z33, z34 = [
+                np.array([c[n] for c in cached]) for n in names[4:]]
+        else:
+            z11 = z12 = z33 = z34 = np.zeros(qe.shape + (nang,))
+
+        return qe, qs, qa, gs, z11, z12, z11, z33, z34, z33
+
     def get_opacities(self, a=np.logspace(-1, 2, 100), q=-3.5, 
-            algorithm='bhmie', nang=2, nproc=1):
+            algorithm='bhmie', nang=2, nproc=1, cache=None):
         """ 
             Convert the dust efficiencies into dust opacities by integrating 
             them over a range of grain sizes. Assumes grain sizes are given in
@@ -426,6 +529,9 @@ class Dust():
               - q: Exponent of the power-law grain size distribution
               - algorithm: 'bhmie' or 'bhcoat', algorithm for get_efficiencies
               - nang: Number of angles used in get_efficiencies
+              - nproc: Number of processes used to compute the efficiencies
+              - cache: DiskCache (compressed) where the efficiencies of every 
+                grain size are reused from and stored to, or None
         
             Returns:
               - kext: Dust extinction opacity (cm^2/g_dust)
@@ -451,6 +557,7 @@ class Dust():
         self.z33 = np.zeros((self.l.size, nang))
         self.z34 = np.zeros((self.l.size, nang))
         self.z44 = np.zeros((self.l.size, nang))
+        self.a_grid = self.a
         self.Qext_a = []
         self.Qsca_a = []
         self.Qabs_a = []
@@ -485,60 +592,39 @@ class Dust():
             return self.kext, self.ksca, self.kabs, self.gsca, \
                 self.z11, self.z12, self.z22, self.z33, self.z34, self.z44
 
-        # Serial execution
-        if self.nproc == 1:
-            # Customize the progressbar
-            widgets = [f'[get_opacities] ', progressbar.Timer(), ' ', 
-                progressbar.GranularBar(' ⡀⡄⡆⡇⣇⣧⣷⣿')]
-
-            if self.pb:
-                pb = progressbar.ProgressBar(maxval=self.a.size, widgets=widgets)
-                pb.start()
-
-            # Calculate the efficiencies for the range of grain sizes
-            for j, a_ in enumerate(self.a):
-                qe, qs, qa, gs, z11, z12, z22, z33, z34, z44 = \
-                        self.get_efficiencies(a_, nang, algorithm, None, False)
-                self.Qext_a.append(qe) 
-                self.Qsca_a.append(qs) 
-                self.Qabs_a.append(qa) 
-                self.gsca_a.append(gs) 
-                self.z11_a.append(z11) 
-                self.z12_a.append(z12) 
-                self.z22_a.append(z22) 
-                self.z33_a.append(z33) 
-                self.z34_a.append(z34) 
-                self.z44_a.append(z44) 
-                if self.pb: pb.update(j)
-            if self.pb: pb.finish()
-
-        # Multiprocessing (Parallelized)
+        # Customize the progressbar
+        widgets = [f'[get_opacities] ', progressbar.Timer(), ' ', 
+            progressbar.GranularBar(' ⡀⡄⡆⡇⣇⣧⣷⣿')]
+
+        if self.pb:
+            pb = progressbar.ProgressBar(
+                maxval=self.a.size * self.l.size, widgets=widgets)
+            pb.start()
+
+        # Calculate the efficiencies for all grain sizes at once, in 
+        # parallel over nproc processes. Results do not depend on nproc.
+        if self.nproc > 1:
+            utils.print_(f'Using {self.nproc} processes')
+
+        if cache is not None:
+            qe, qs, qa, gs, z11, z12, z22, z33, z34, z44 = \
+                self.get_cached_efficiencies(self.a, nang, cache, algorithm, 
+                    progress=pb.update if self.pb else None)
         else:
-            # Calculate the efficiencies for the range of grain sizes
-            with multiprocessing.Pool(processes=self.nproc) as pool:
-                params = zip(
-                    self.a, 
-                    itertools.repeat(nang), 
-                    itertools.repeat(algorithm),
-                    itertools.repeat(None),
-                    itertools.repeat(False),
-                    range(self.a.size), 
-                )
-                # Parallel map function
-                qe, qs, qa, gs, z11, z12, z22, z33, z34, z44 = \
-                    pool.starmap(self.get_efficiencies, params)
-                
-                # Reorder from (a, Q, l) to (Q, a, l)
-                self.Qext_a = qe
-                self.Qsca_a = qs
-                self.Qabs_a = qa
-                self.gsca_a = gs
-                self.z11_a = z11
-                self.z12_a = z12
-                self.z22_a = z22
-                self.z33_a = z33
-                self.z34_a = z34
-                self.z44_a = z44
+            qe, qs, qa, gs, z11, z12, z22, z33, z34, z44 = \
+                self.get_efficiencies(self.a, nang, algorithm, None, False, 
+                    progress=pb.update if self.pb else None)
+        self.Qext_a = qe
+        self.Qsca_a = qs
+        self.Qabs_a = qa
+        self.gsca_a = gs
+        self.z11_a = z11
+        self.z12_a = z12
+        self.z22_a = z22
+        self.z33_a = z33
+        self.z34_a = z34
+        self.z44_a = z44
+        if self.pb: pb.finish()
     
         # Transpose from (a, l) to (l, a) to later integrate over l
         self.Qext_a = np.transpose(self.Qext_a)
@@ -552,11 +638,62 @@ class Dust():
         self.z34_a = np.swapaxes(self.z34_a, 0, 1)
         self.z44_a = np.swapaxes(self.z44_a, 0, 1)
         
+        return self.integrate_opacities()
+
+    def integrate_opacities(self, q=None, amin=None, amax=None):
+        """
+            Integrate the efficiencies of every grain size computed by 
+            get_opacities() over a power-law size distribution, into the 
+            dust opacities and scattering matrix. 
+
+            Efficiencies are kept for all the computed sizes, so this can be 
+            called again with a new slope q, or a subrange [amin, amax] of 
+            the computed sizes (e.g., to study grain growth), at a small 
+            fraction of the cost of get_opacities(). For mixtures, integrate 
+            every material and mix them again.
+
+            Arguments:
+              - q: Exponent of the power-law grain size distribution. 
+                Defaults to the current one.
+              - amin: Minimum grain size in microns. Defaults to the 
+                smallest computed size.
+              - amax: Maximum grain size in microns. Defaults to the 
+                largest computed size.
+        
+            Returns:
+              - kext: Dust extinction opacity (cm^2/g_dust)
+              - ksca: Dust scattering opacity (cm^2/g_dust)
+              - kabs: Dust absorption opacity (cm^2/g_dust)
+        """
+
+        if np.size(self.Qext_a) == 0:
+            raise ValueError('Efficiencies per grain size are not set. ' +\
+                'Call get_opacities() first.')
+
+        # Select the computed sizes within [amin, amax]
+        a_micron = self.a_grid * u.cm.to(u.micron)
+        inside = np.ones(a_micron.size, dtype=bool)
+        if amin is not None:
+            inside &= a_micron >= amin * (1 - 1e-10)
+        if amax is not None:
+            inside &= a_micron <= amax * (1 + 1e-10)
+
+        if inside.sum() < 2:
+            raise ValueError(f'At least two of the computed grain sizes ' +\
+                f'between {a_micron.min():.3g} and {a_micron.max():.3g} ' +\
+                f'microns must lie within [{amin}, {amax}] microns.')
+
+        self.a = self.a_grid[inside]
+        self.amin = self.a.min()
+        self.amax = self.a.max()
+        self.na = self.a.size
+        if q is not None: self.q = q
+
         utils.print_(f'Integrating opacities ', end='')
         print(f'and scattering matrix ' if self.scatmatrix else '', end='')
-        print(f'using a power-law slope of {q = }')
+        print(f'using a power-law slope of q = {self.q}')
 
-        # Mass integral: int (a^q * a^3) da = [amax^(q+4) - amin^(q-4)]/(q-4)
+        # Mass integral: int (a^q * a^3) da = [amax^(q+4) - amin^(q+4)]/(q+4)
         q4 = self.q + 4
         int_da = (self.amax**q4 - self.amin**q4) / q4
         
@@ -570,42 +707,37 @@ class Dust():
         mass = 4/3 * np.pi * self.a**3 * self.dens 
         m_of_a = (self.a*u.cm.to(u.micron))**(self.q + 1) * mass
         mtot = np.sum(m_of_a)
-        mfrac = m_of_a / mtot
-
-        # Integrate quantities over size distribution per wavelength 
-        for i, l_ in enumerate(self.l):
-            sigma_geo = np.pi * self.a**2
-            Cext = self.Qext_a[i] * sigma_geo
-            Csca = self.Qsca_a[i] * sigma_geo
-            Cabs = self.Qabs_a[i] * sigma_geo
-
-            # Integrate Zij
-            for j in range(self.nang): 
-                self.z11[i][j] = np.sum(self.z11_a[i, :, j] * mfrac)
-                self.z12[i][j] = np.sum(self.z12_a[i, :, j] * mfrac)
-                self.z22[i][j] = np.sum(self.z22_a[i, :, j] * mfrac)
-                self.z33[i][j] = np.sum(self.z33_a[i, :, j] * mfrac)
-                self.z34[i][j] = np.sum(self.z34_a[i, :, j] * mfrac)
-                self.z44[i][j] = np.sum(self.z44_a[i, :, j] * mfrac)
-            
-            # Angular integral of Z11
-            mu = np.cos(self.angles * np.pi / 180)
-            int_Z11_dmu = -np.trapz(self.z11[i, :], mu)
-            int_Z11_mu_dmu = -np.trapz(self.z11[i, :] * mu, mu)
-
-            if self.scatmatrix:
-                self.ksca[i] = 2 * np.pi * int_Z11_dmu
-                self.gsca[i] = 2 * np.pi * int_Z11_mu_dmu / self.ksca[i]
-            else:
-                self.ksca[i] = np.trapz(Csca * phi, self.a) / mass_norm
-                self.gsca[i] = np.sum(self.gsca_a[i] * mfrac)
+        mfrac = np.zeros(self.a_grid.size)
+        mfrac[inside] = m_of_a / mtot
+
+        # Integrate quantities over the size distribution, for all 
+        # wavelengths and angles at once, as contractions over the size axis
+        sigma_geo = np.pi * self.a**2
+        w_a = np.zeros(self.a_grid.size)
+        w_a[inside] = trapezoid_weights(self.a) * phi * sigma_geo / mass_norm
+        self.kext = np.tensordot(self.Qext_a, w_a, axes=([1], [0]))
+        self.kabs = np.tensordot(self.Qabs_a, w_a, axes=([1], [0]))
+
+        # Integrate Zij, weighted by mass
+        self.z11 = np.tensordot(self.z11_a, mfrac, axes=([1], [0]))
+        self.z12 = np.tensordot(self.z12_a, mfrac, axes=([1], [0]))
+        self.z22 = np.tensordot(self.z22_a, mfrac, axes=([1], [0]))
+        self.z33 = np.tensordot(self.z33_a, mfrac, axes=([1], [0]))
+        self.z34 = np.tensordot(self.z34_a, mfrac, axes=([1], [0]))
+        self.z44 = np.tensordot(self.z44_a, mfrac, axes=([1], [0]))
 
-            self.kext[i] = np.trapz(Cext * phi, self.a) / mass_norm
-            self.kabs[i] = np.trapz(Cabs * phi, self.a) / mass_norm
+        if self.scatmatrix:
+            # Angular integrals of Z11, with mu decreasing from 1 to -1
+            mu = np.cos(self.angles * np.pi / 180)
+            w_mu = -trapezoid_weights(mu)
+            self.ksca = 2 * np.pi * (self.z11 @ w_mu)
+            self.gsca = 2 * np.pi * (self.z11 @ (w_mu * mu)) / self.ksca
 
             # Calculate the relative error between kscat and int Z11 dmu
-            if self.scatmatrix:
-                self.compare_ksca_vs_z11(i)
+            self.compare_ksca_vs_z11()
+        else:
+            self.ksca = np.tensordot(self.Qsca_a, w_a, axes=([1], [0]))
+            self.gsca = np.tensordot(self.gsca_a, mfrac, axes=([1], [0]))
 
         if self.scatmatrix:
             self.check_ksca_z11_error(tolerance=0.1, show=False)
@@ -613,17 +745,14 @@ class Dust():
         return self.kext, self.ksca, self.kabs, self.gsca, \
             self.z11, self.z12, self.z22, self.z33, self.z34, self.z44
 
-    def compare_ksca_vs_z11(self, lam_i):
+    def compare_ksca_vs_z11(self):
         """ Compute the relative error between ksca and int Z11 dmu """
-        self.err_i = np.zeros(self.l.size)
         mu = np.cos(self.angles * np.pi / 180)
-        dmu = np.abs(mu[1:self.nang] - mu[0:self.nang-1])
-        zav = 0.5 * (self.z11[lam_i, 1: self.nang] + 
-            self.z11[lam_i, 0:self.nang-1])
+        dmu = np.abs(np.diff(mu))
+        zav = 0.5 * (self.z11[:, 1:] + self.z11[:, :-1])
         dum = 0.5 * zav * dmu
-        self.dumsum = 4 * np.pi * dum.sum()
-        err = np.abs(self.dumsum / self.ksca[lam_i] - 1)
-        self.err_i[lam_i] = np.max(err, 0)
+        self.dumsum = 4 * np.pi * dum.sum(axis=1)
+        self.err_i = np.abs(self.dumsum / self.ksca - 1)
     
     def check_ksca_z11_error(self, tolerance, show=False):
         """ Warn if the error between kscat and int Z11 dmu is large """
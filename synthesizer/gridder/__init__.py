@@ -1,4 +1,4 @@
-from .gridder import CartesianGrid
+from .gridder import CartesianGrid, OctreeGrid, SphericalGrid
 from .analytical import AnalyticalModel
 from .vector_field import VectorField
 from .sph_reader import *
@@ -1,27 +1,166 @@
+import os
 import numpy as np
 import astropy.units as u
 import astropy.constants as const
 import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
 
 from synthesizer.gridder.vector_field import VectorField
+# Importing the custom model registers it as 'user'
 from synthesizer.gridder.custom_model import CustomModel
 from synthesizer.gridder import models
 from synthesizer import utils 
 
+def default_bbox(model):
+    """ Default half-box size (in cm) of the predefined models """
+    return get_model_class(model).bbox
+
+def get_model_class(model):
+    """ Model class registered under the name given by the variable model """
+    if model not in models.registry:
+        raise ValueError(
+            f'{utils.color.red}' +\
+            f'Model: {model} cannot be found. Available models are: ' +\
+            f'{list(models.registry)}' +\
+            f'{utils.color.none}')
+
+    return models.registry[model]
+
+def get_model(model, x, y, z, field=None, params=None):
+    """ 
+        Create the model indexed by the variable model at positions x, y, z,
+        with the dictionary params overriding its default parameters.
+    """
+    return get_model_class(model)(x, y, z, field, **(params or {}))
+
+
+def map_slabs(func, nrows, rowsize, nthreads=1, slabsize=2**20):
+    """ 
+        Call func(i0, i1) over consecutive slabs of rows [i0, i1), covering 
+        nrows rows of rowsize cells each, in slabs of about slabsize cells.
+        Slabs are evaluated by a pool of nthreads threads, which run in 
+        parallel since NumPy releases the GIL during array operations.
+        Returns the results of func, in the order of the slabs.
+    """
+
+    step = int(np.clip(slabsize // rowsize, 1, nrows))
+    slabs = [(i, min(i + step, nrows)) for i in range(0, nrows, step)]
+
+    if nthreads > 1:
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            return list(pool.map(lambda s: func(*s), slabs))
+    else:
+        return [func(*s) for s in slabs]
+
+def evaluate_model(model, x, y, z, r_c, dens, temp=None, field=None, g2d=1,
+        nthreads=1, backend='numpy', params=None, geometry=None):
+    """
+        Evaluate a model at the positions x, y, z in slabs along the first 
+        axis, writing density (divided by g2d) and, optionally, temperature 
+        into the preallocated arrays dens and temp. r_c is the model scale 
+        radius, given explicitly since every slab only covers part of the 
+        grid. Returns the model instance of the first slab.
+
+        backend is used by the models to evaluate their expressions (see 
+        models.evaluate). numexpr runs its own nthreads threads over every 
+        slab, so slabs are then evaluated one after another.
+
+        params overrides the default model parameters. geometry is an 
+        optional dictionary where every slab caches the definitions that only
+        depend on the coordinates (see models.evaluate). Passing the same 
+        dictionary to every call with the same coordinates, e.g., in a 
+        parameter sweep, evaluates them only once.
+    """
+
+    if backend not in models.backends:
+        raise ValueError(f'backend must be one of {models.backends}, ' +\
+            f'not {backend}')
+
+    if backend == 'numexpr':
+        models.import_numexpr().set_num_threads(nthreads)
+        nthreads = 1
+
+    def evaluate(i0, i1):
+        m = get_model(model, *[c[i0: i1] if c.shape[0] > 1 else c 
+            for c in [x, y, z]], field, params)
+        m.r_c = r_c
+        m.backend = backend
+        if geometry is not None:
+            m.geometry = geometry.setdefault(i0, {})
+
+        dens[i0: i1] = m.dens / g2d
+        if temp is not None: 
+            temp[i0: i1] = m.temp
+
+        # Free the cached fields, once copied into the output arrays
+        m.invalidate()
+
+        return m
+
+    return map_slabs(evaluate, dens.shape[0], np.prod(dens.shape[1:]), 
+        nthreads)[0]
+
+def evaluate_vector_field(x, y, z, morphology, dtype=np.float64, nthreads=1):
+    """
+        Create a VectorField at the positions x, y, z. Compact morphologies 
+        are evaluated at once. The rest are evaluated in slabs along the 
+        first axis, written into preallocated components. 
+    """
+
+    if morphology.lower() in VectorField.compact:
+        return VectorField(x, y, z, morphology, dtype=dtype)
+
+    vfield = VectorField(x, y, z, None, dtype=dtype)
+    vfield.morphology = morphology.lower()
+    vx, vy, vz = [np.empty(vfield.shape, dtype) for _ in range(3)]
+
+    def evaluate(i0, i1):
+        v = VectorField(*[c[i0: i1] if c.shape[0] > 1 else c 
+            for c in [x, y, z]], morphology, dtype=dtype)
+        vx[i0: i1] = v.vx
+        vy[i0: i1] = v.vy
+        vz[i0: i1] = v.vz
+
+    map_slabs(evaluate, vfield.shape[0], np.prod(vfield.shape[1:]), nthreads)
+    vfield.vx, vfield.vy, vfield.vz = vx, vy, vz
+
+    return vfield
+
+
 class AnalyticalModel():
     def __init__(self, model, bbox, ncells=100, g2d=100, temp=False, nspec=1, 
-        csubl=0, sootline=300):
+        csubl=0, sootline=300, precision='double', nthreads=1, 
+        backend='numpy', params=None):
         """
         Create an analytical density model indexed by the variable model.
         All quantities should be treated in cgs unless explicitly converted.
+
+        The model and the vector field are evaluated in slabs, in parallel 
+        over nthreads threads. Model expressions are evaluated by backend,
+        either 'numpy' or 'numexpr'.
+
+        precision can be 'double' or 'single'. Models are always evaluated 
+        in double precision, but with 'single' the density, temperature and
+        vector field are stored and written as float32.
+
+        params is a dictionary overriding the default model parameters, 
+        declared by every model class (see models.BaseModel).
         """
 
-        self.dens = np.zeros((ncells, ncells, ncells))
-        self.temp = np.zeros((ncells, ncells, ncells))
+        if precision not in ['single', 'double']:
+            raise ValueError(f'precision must be single or double, ' +\
+                f'not {precision}')
+
+        self.dtype = np.float32 if precision == 'single' else np.float64
+        self.dens = np.zeros((ncells, ncells, ncells), dtype=self.dtype)
+        self.temp = np.zeros((ncells, ncells, ncells), dtype=self.dtype)
         self.vfield = None
         self.add_temp = temp
         self.model = model 
+        self.params = dict(params or {})
         self.ncells = ncells
+        self.nthreads = nthreads
+        self.backend = backend
         self.g2d = g2d
         self.nspec = nspec
         self.csubl = csubl
@@ -31,21 +170,17 @@ class AnalyticalModel():
 
         if bbox is None:
             # Set default half-box sizes for predefined models
-            self.bbox = {
-                'constant': 1 * u.au.to(u.cm), 
-                'plaw': 8500 * u.au.to(u.cm),    
-                'pcore': 0.1 * u.pc.to(u.cm), 
-                'ppdisk': 300 * u.au.to(u.cm),
-                'l1544': 5000 * u.au.to(u.cm),
-                'filament': 1 * u.pc.to(u.cm), 
-                'user': 100 * u.au.to(u.cm), 
-            }.get(model, 100 * u.au.to(u.cm))
+            self.bbox = default_bbox(model)
         else:
             self.bbox = bbox
 
 
-    def create_model(self):
-        """ Setup a density model box """
+    def create_model(self, geometry=None):
+        """ 
+            Setup a density model box. geometry is an optional dictionary
+            caching the model terms that only depend on the coordinates 
+            (see evaluate_model). 
+        """
 
         utils.print_(f'Creating density model: {self.model}')
     
@@ -56,71 +191,77 @@ class AnalyticalModel():
         xc = 0.5 * (self.xw[0: self.ncells] + self.xw[1: self.ncells + 1])
         yc = 0.5 * (self.yw[0: self.ncells] + self.yw[1: self.ncells + 1])
         zc = 0.5 * (self.zw[0: self.ncells] + self.zw[1: self.ncells + 1])
-        x, y, z = np.meshgrid(xc, yc, zc, indexing='ij')
+        x, y, z = np.meshgrid(xc, yc, zc, indexing='ij', sparse=True)
         self.X = x
         self.Y = y
         self.Z = z
         field = self.vfield
-        r_c = self.bbox
         self.plotmin = None
         self.plotmax = None
 
         # Custom user-defined model
-        if self.model == 'user':
-            if self.bbox == 100*u.au.to(u.cm):
-                utils.print_(
-                    'Using a default half-box size of 100 au. '+\
-                    f'You can change it with --bbox')
+        if self.model == 'user' and self.bbox == 100*u.au.to(u.cm):
+            utils.print_(
+                'Using a default half-box size of 100 au. '+\
+                f'You can change it with --bbox')
+
+        # Evaluate the model density and temperature into the current obj 
+        # (analytical), slab by slab. Models scale with the outermost cell 
+        # center, as if evaluated on the whole grid at once.
+        shape = (self.ncells, self.ncells, self.ncells)
+        self.dens = np.empty(shape, dtype=self.dtype)
+        if self.add_temp: self.temp = np.empty(shape, dtype=self.dtype)
+
+        model = evaluate_model(self.model, x, y, z, r_c=xc.max(), 
+            dens=self.dens, temp=self.temp if self.add_temp else None, 
+            field=field, g2d=self.g2d, nthreads=self.nthreads, 
+            backend=self.backend, params=self.params, geometry=geometry)
+
+        # Fields are lazy, so only the vector field is evaluated on the grid
+        if self.vfield is not None: 
+            self.vfield = get_model(self.model, x, y, z, field, 
+                self.params).vfield
+        if model.plotmin is not None: self.plotmin = model.plotmin
+        if model.plotmax is not None: self.plotmax = model.plotmax
 
-            model = CustomModel(x, y, z, field)
+    def sweep(self, sets, binary=False):
+        """
+            Create the model for every set of parameter values in sets, a 
+            sequence of dictionaries, and write its grid, density and 
+            temperature files into the directories sweep_000, sweep_001, ... 
+            The parameters of every set are listed in sweep.txt.
+
+            Terms that only depend on the coordinates (e.g., radii) are 
+            evaluated for the first set and reused by the rest. The model 
+            parameters and fields are restored at the end.
+        """
 
-        # Constant density  
-        elif self.model == 'constant':          
-            model = models.Constant(x, y, z, field)
+        utils.print_(f'Sweeping {len(sets)} sets of model parameters')
 
-        # Radial power-law 
-        elif self.model == 'plaw':
-            model = models.PowerLaw(x, y, z, field)
+        geometry = {}
+        params, dens, temp = self.params, self.dens, self.temp
+        cwd = os.getcwd()
 
-        # Prestellar Core 
-        elif self.model == 'pcore':
-            model = models.PrestellarCore(x, y, z, field)
-            
-        # L1544 Prestellar Core 
-        elif self.model == 'l1544':
-            model = models.L1544(x, y, z, field)
-
-        # Protoplanetary Disk
-        elif self.model == 'ppdisk':
-            model = models.PPdisk(x, y, z, field)
-
-        # Gravitationally unstable disk
-        elif self.model == 'gidisk':
-            utils.not_implemented(f'Model: {self.model}')
-            model = models.GIdisk(x, y, z, field)
-
-        # Disk with spiral arms
-        elif self.model == 'spiral-disk':
-            utils.not_implemented(f'Model: {self.model}')
-            model = models.SpiralDisk(x, y, z, field)
-
-        # Gas filament 
-        elif self.model == 'filament':
-            utils.not_implemented(f'Model: {self.model}')
-            model = models.Filament(x, y, z, field)
-    
-        else:
-            raise ValueError(
-                f'{utils.color.red}' +\
-                f'Model: {self.model} cannot be found.' +\
-                f'{utils.color.none}')
-
-        # Copy the model density and temperature to the current obj (anaytical)
-        self.dens = model.dens / self.g2d
-        if self.add_temp: self.temp = model.temp
-        if self.vfield is not None: self.vfield = model.vfield                
-        if model.plotmin is not None: self.plotmin = model.plotmin
-        if model.plotmax is not None: self.plotmax = model.plotmax
+        try:
+            with open('sweep.txt', 'w') as table:
+                for i, values in enumerate(sets):
+                    directory = f'sweep_{i:03d}'
+                    table.write(f'{directory} ' + ' '.join(
+                        f'{k}={v!r}' for k, v in values.items()) + '\n')
+
+                    self.params = {**params, **values}
+                    self.create_model(geometry)
+
+                    os.makedirs(directory, exist_ok=True)
+                    os.chdir(directory)
+                    self.write_grid_file()
+                    self.write_density_file(binary=binary)
+                    if self.add_temp:
+                        self.write_temperature_file(binary=binary)
+                    os.chdir(cwd)
+        finally:
+            os.chdir(cwd)
+            self.params, self.dens, self.temp = params, dens, temp
 
 
     def write_grid_file(self):
@@ -140,79 +281,54 @@ class AnalyticalModel():
             f.write(f'{self.ncells:d} {self.ncells:d} {self.ncells:d}\n')
 
             # Write the cell walls
-            for i in self.xw:
-                f.write(f'{i:13.6e}\n')
-            for j in self.yw:
-                f.write(f'{j:13.6e}\n')
-            for k in self.zw:
-                f.write(f'{k:13.6e}\n')
+            np.savetxt(f, np.concatenate([self.xw, self.yw, self.zw]), 
+                fmt='%13.6e')
 
 
-    def write_density_file(self):
-        """ Write the density file """
+    def write_density_file(self, binary=False):
+        """ Write the density file, optionally in binary format (.binp) """
         utils.print_('Writing dust density file')
 
         # Flatten the array into a 1D fortran-style indexing
         density = self.dens.ravel(order='F')
-        with open('dust_density.inp','w+') as f:
-            f.write('1\n')
-            f.write(f'{density.size:d}\n')
-            f.write(f'{self.nspec}\n')
 
-            if self.nspec == 1:
-                # Write a single dust species
-                for d in density:
-                    f.write(f'{d:13.6e}\n')
-            else:
-                utils.print_(f'Writing two density species ...')
-                # Write two densities: 
-                # one with original value outside the sootline and zero within 
-                temp1d = self.interp_temp.ravel(order='F')
-                for i, d in enumerate(density):
-                    if temp1d[i] < self.sootline:
-                        f.write(f'{d:13.6e}\n')
-                    else:
-                        f.write('0\n')
-
-                # one with zero outside the sootline and reduced density within
-                for i, d in enumerate(density):
-                    if temp1d[i] < self.sootline:
-                        f.write('0\n')
-                    else:
-                        f.write(f'{(d * self.subl_mfrac):13.6e}\n')
-
-    def write_temperature_file(self):
-        """ Write the temperature file """
+        if self.nspec > 1:
+            utils.print_(f'Writing two density species ...')
+            # Write two densities: 
+            # one with original value outside the sootline and zero within 
+            # one with zero outside the sootline and reduced density within
+            subl = self.temp.ravel(order='F') >= self.sootline
+            density = np.concatenate([
+                np.where(subl, 0, density), 
+                np.where(subl, density * self.subl_mfrac, 0), 
+            ])
+
+        utils.write_radmc3d_file(
+            'dust_density.inp', density, nrspec=self.nspec, binary=binary)
+
+    def write_temperature_file(self, binary=False):
+        """ Write the temperature file, optionally in binary format (.bdat) """
         utils.print_('Writing dust temperature file')
 
-        temperature = self.temp.ravel(order='F')
-        with open('dust_temperature.dat','w+') as f:
-            f.write('1\n')
-            f.write(f'{temperature.size:d}\n')
-            f.write(f'{self.nspec}\n')
+        # Write the temperature Nspec times for Nspec dust species
+        temperature = np.tile(self.temp.ravel(order='F'), self.nspec)
 
-            # Write the temperature Nspec times for Nspec dust species
-            for i in range(self.nspec):
-                for t in temperature:
-                    f.write(f'{t:13.6e}\n')
+        utils.write_radmc3d_file(
+            'dust_temperature.dat', temperature, nrspec=self.nspec, 
+            binary=binary)
 
-    def write_vector_field(self, morphology):
+    def write_vector_field(self, morphology, binary=False):
         """ Create a vector field for dust alignment """
  
         utils.print_('Writing grain alignment direction file')
  
         if self.model != 'user':
-            self.vfield = VectorField(self.X, self.Y, self.Z, morphology)
- 
-        with open('grainalign_dir.inp','w+') as f:
-            f.write('1\n')
-            f.write(f'{int(self.ncells**3)}\n')
-            for iz in range(self.ncells):
-                for iy in range(self.ncells):
-                    for ix in range(self.ncells):
-                        f.write(f'{self.vfield.vx[ix, iy, iz]:13.6e} ' +\
-                                f'{self.vfield.vy[ix, iy, iz]:13.6e} ' +\
-                                f'{self.vfield.vz[ix, iy, iz]:13.6e}\n')
+            self.vfield = evaluate_vector_field(self.X, self.Y, self.Z, 
+                morphology, dtype=self.dtype, nthreads=self.nthreads)
+
+        # One row of (vx, vy, vz) per cell, in fortran-style indexing
+        utils.write_radmc3d_file('grainalign_dir.inp', self.vfield.rows(), 
+            nrcells=self.vfield.ncells, binary=binary)
 
     def plot_midplane(self, field, data=None):
         """ Plot the density midplane at z=0 using Matplotlib """
@@ -476,3 +592,38 @@ class AnalyticalModel():
                 utils.print_(e, bold=True)
 
 
+
+
+def benchmark(model='ppdisk', ncells=256, nthreads=1, repeat=3):
+    """
+        Compare the time taken to evaluate the density and temperature of a 
+        model over ncells^3 cells with every backend. Prints and returns the
+        best time (in s) of repeat runs per backend, along with the maximum 
+        relative difference between the densities of both backends.
+    """
+
+    import time
+
+    times = {}
+    dens = {}
+    for backend in models.backends:
+        grid = AnalyticalModel(model, None, ncells=ncells, temp=True, 
+            nthreads=nthreads, backend=backend)
+
+        times[backend] = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            grid.create_model()
+            times[backend] = min(times[backend], time.perf_counter() - start)
+
+        dens[backend] = grid.dens
+
+    diff = np.max(np.abs(dens['numexpr'] / dens['numpy'] - 1))
+
+    utils.print_(f'Model: {model} | Cells: {ncells}^3 | Threads: {nthreads}')
+    for backend, t in times.items():
+        utils.print_(f'{backend}: {t:.3f} s')
+    utils.print_(f'Speed-up: {times["numpy"] / times["numexpr"]:.2f} | ' +\
+        f'Max. relative difference: {diff:.1e}')
+
+    return times, diff
@@ -1,8 +1,9 @@
 import numpy as np
 
-from synthesizer.gridder.models import BaseModel
+from synthesizer.gridder.models import BaseModel, cached_field, register
 from synthesizer.gridder.vector_field import VectorField
 
+@register('user')
 class CustomModel(BaseModel):
     """ 
         This object is meant to create user-defined analytical models for 
@@ -18,11 +19,25 @@ class CustomModel(BaseModel):
 
         To create a vector field, make sure to create 
         self.vx, self.vy and self.vz.
+
+        Expressions can be plain numpy code using self.x, self.y and self.z,
+        or strings passed to self.evaluate(), which can also be evaluated 
+        with the numexpr backend (--backend numexpr).
+
+        Free parameters and their default values (in cgs) are declared in 
+        parameters. They are available as self.<name> and within 
+        self.evaluate() expressions, and can be changed from the command 
+        line with --model-params NAME=VALUE or swept over with --sweep.
+
+        Fields defined with @cached_field are evaluated only once, and again
+        whenever a parameter changes. If they use any other attributes of 
+        the model, name them as dependencies, e.g., @cached_field('rho_c').
     """
 
-    @property
+    parameters = dict(rho_0=1)
+
+    @cached_field()
     def dens(self):
         # Example: create a sphere
-        r = np.sqrt(x*x + y*y + z*z)
-        return 1 / r
+        return self.evaluate('rho_0 / r', [('r', 'sqrt(x*x + y*y + z*z)')])
 
@@ -3,16 +3,29 @@ import subprocess
 import numpy as np
 import astropy.units as u
 import matplotlib.pyplot as plt
-from scipy.interpolate import griddata
 
 from synthesizer.gridder.vector_field import VectorField
+from synthesizer.gridder import vector_field
+from synthesizer.gridder import sph_kernels
 from synthesizer.gridder.sph_reader  import *
 from synthesizer.gridder.amr_reader  import *
 from synthesizer import utils
 
+def cell_centers(X, Y, Z):
+    """ 
+        Stack coordinate arrays, which may be sparse (i.e., broadcastable 
+        instead of full meshgrids), into a single array of shape (ncells, 3).
+    """
+    cells = np.empty(np.broadcast(X, Y, Z).shape + (3, ))
+    for i, coord in enumerate([X, Y, Z]):
+        cells[..., i] = coord
+
+    return cells.reshape(-1, 3)
+
 class CartesianGrid():
     def __init__(self, ncells, bbox=None, rout=None, nspec=1, csubl=0, 
-            sootline=300, g2d=100, temp=False):
+            sootline=300, g2d=100, temp=False, auto_ncells=False, 
+            precision='double'):
         """ 
         Create a cartesian grid from a set of 3D points.
 
@@ -28,19 +41,37 @@ class CartesianGrid():
                   bbox = 50 
                   rout = 50
 
+        If auto_ncells is True, the number of cells per side is chosen from 
+        the nearest neighbour particle separation, up to ncells.
+
+        precision can be 'double' or 'single'. In single precision, the 
+        interpolated fields, particle values and vector fields are stored as 
+        float32, which halves the memory and disk usage of large grids. 
+        Positions, masses and smoothing lengths keep the precision of the 
+        reader, since their powers in cgs can exceed the float32 range.
+
         """
 
+        if precision not in ['single', 'double']:
+            raise ValueError(f'precision must be single or double, ' +\
+                f'not {precision}')
+
+        self.precision = precision
+        self.dtype = np.float32 if precision == 'single' else np.float64
         self.cordsystem = 1
         self.fx = 1
         self.fy = 1
         self.fz = 1
-        self.dens = np.zeros((ncells, ncells, ncells))
-        self.temp = np.zeros((ncells, ncells, ncells))
+        self.dens = np.zeros((ncells, ncells, ncells), dtype=self.dtype)
+        self.temp = np.zeros((ncells, ncells, ncells), dtype=self.dtype)
         self.interp_dens = None
         self.interp_temp = None
         self.vfield = None
         self.add_temp = temp
+        self.particle_fields = [
+            'x', 'y', 'z', 'dens', 'temp', 'vx', 'vy', 'vz', 'hsml', 'mass']
         self.ncells = ncells
+        self.auto_ncells = auto_ncells
         self.bbox = bbox
         self.rout = rout
         self.g2d = g2d
@@ -50,12 +81,24 @@ class CartesianGrid():
         self.carbon = 0.375
         self.subl_mfrac = 1 - self.carbon * self.csubl / 100
 
-    def read_sph(self, filename, source='sphng'):
+    def read_sph(self, filename, source='sphng', nproc=1, fields=None):
         """ Read SPH data. 
             Below are defined small interfaces to read in data from SPH codes.
 
             To add new code sources, synthesizer needs (all values in CGS):
                 self.x, self.y, self.z, self.dens and self.temp (optional) 
+
+            Particles outside self.bbox or self.rout are removed. Readers 
+            that support partial reads (i.e., providing a select() method) 
+            are trimmed right after reading the coordinates, so that other 
+            fields are only read for the particles within the box.
+            nproc is the number of processes used to read multi-file 
+            snapshots.
+
+            fields is a list of the additional per-particle fields required,
+            among vx, vy, vz, hsml and mass. Only these are requested from 
+            the reader, which reads them from disk on demand. By default, 
+            all the fields provided by the reader are stored. 
          """
 
         utils.print_(
@@ -68,13 +111,13 @@ class CartesianGrid():
             self.sph = SPHng(filename, temp=self.add_temp)
 
         elif source.lower() == 'gizmo':
-            self.sph = Gizmo(filename, temp=self.add_temp)
+            self.sph = Gizmo(filename, temp=self.add_temp, nproc=nproc)
 
         elif source.lower() == 'gadget':
-            self.sph = Gadget(filename, temp=self.add_temp)
+            self.sph = Gadget(filename, temp=self.add_temp, nproc=nproc)
 
         elif source.lower() == 'arepo':
-            self.sph = Arepo(filename, temp=self.add_temp)
+            self.sph = Arepo(filename, temp=self.add_temp, nproc=nproc)
 
         elif source.lower() == 'phantom':
             utils.not_implemented()
@@ -90,15 +133,41 @@ class CartesianGrid():
         self.x = self.sph.x
         self.y = self.sph.y
         self.z = self.sph.z
-        self.dens = self.sph.rho_g / self.g2d
-        self.npoints = len(self.dens)
+        self.npoints = self.x.size
         print(f' | Particles: {self.npoints}')
 
+        trim = self.bbox is not None or self.rout is not None
+        lazy = hasattr(self.sph, 'select')
+
+        # Trim lazy readers before reading any other field
+        if trim and lazy:
+            self.trim_box()
+
+        self.dens = self.sph.rho_g / self.g2d
+
         if self.add_temp:
             self.temp = self.sph.temp
         else:
             self.temp = np.zeros(self.dens.shape)
 
+        # Store additional per-particle quantities, if provided by the reader
+        for field in ['vx', 'vy', 'vz', 'hsml', 'mass']:
+            if fields is not None and field not in fields:
+                continue
+
+            if getattr(self.sph, field, None) is not None:
+                setattr(self, field, getattr(self.sph, field))
+
+        # Keep the values to be interpolated in the grid precision
+        if self.precision == 'single':
+            for field in ['dens', 'temp', 'vx', 'vy', 'vz']:
+                value = getattr(self, field, None)
+                if isinstance(value, np.ndarray):
+                    setattr(self, field, value.astype(self.dtype, copy=False))
+
+        if trim and not lazy:
+            self.trim_box()
+
     def read_amr(self, filename, sourle='athena++'):
         """ Read AMR data """
 
@@ -145,130 +214,506 @@ class CartesianGrid():
         else:
             raise ValueError(f'Source = {source} is currently not supported')
 
-    def trim_box(self):
+    def trim_box(self, bbox=None, rout=None, rcyl=None, zcyl=None, 
+            planes=None):
         """ 
-        Trim the original grid to a given size, can be rectangular or spherical. 
+        Trim the original grid to a given size. All the given cuts are 
+        combined into a single boolean mask, which is then applied to every
+        per-particle quantity (coordinates, density, temperature and, if 
+        available, velocities, smoothing lengths and masses).
+
+        Supported cuts (all in units of cm):
+            - bbox: half-length of a cube or box vertices 
+                    [[xmin, xmax], [ymin, ymax], [zmin, zmax]]
+            - rout: radius of a sphere
+            - rcyl, zcyl: radius and half-height of a cylinder along z
+            - planes: list of (normal, point) pairs. Particles on the side 
+                      the normal points to are removed.
+
+        If bbox and rout are not given, self.bbox and self.rout are used.
         """
 
-        # Emtpy dynamic array to store the indices of the particles to remove
-        to_remove = []
+        bbox = self.bbox if bbox is None else bbox
+        rout = self.rout if rout is None else rout
 
-        if self.bbox is not None:
+        # Start by keeping every particle and reject upon each cut
+        keep = np.ones(self.x.size, dtype=bool)
 
-            utils.print_(f'Deleting particles outside a box ' +
-                f'half-length of {self.bbox * u.cm.to(u.au)} au')
+        if bbox is not None:
+            if np.isscalar(bbox):
+                utils.print_(f'Deleting particles outside a box ' +
+                    f'half-length of {bbox * u.cm.to(u.au)} au')
+                bbox = [[-bbox, bbox]] * 3
+            else:
+                utils.print_(f'Deleting particles outside the box ' +
+                    f'{np.round(np.array(bbox) * u.cm.to(u.au), 1).tolist()} au')
 
-            # Iterate over particles and delete upon reject
-            for i in range(self.x.size):
-                if self.x[i] < -self.bbox or self.x[i] > self.bbox:
-                    to_remove.append(i)
+            for coord, (cmin, cmax) in zip([self.x, self.y, self.z], bbox):
+                keep &= (coord >= cmin) & (coord <= cmax)
 
-            for j in range(self.y.size):
-                if self.y[j] < -self.bbox or self.y[j] > self.bbox:
-                    to_remove.append(j)
+        if rout is not None:
+            utils.print_('Deleting particles outside a radius of ' +
+                f'{rout * u.cm.to(u.au)} au ...')
 
-            for k in range(self.z.size):
-                if self.z[k] < -self.bbox or self.z[k] > self.bbox:
-                    to_remove.append(k)
+            # Compare squared distances to avoid the square root
+            keep &= self.x**2 + self.y**2 + self.z**2 <= rout**2
 
-        elif self.rout is not None:
-            # Override any previous value of rout
-            utils.print_('Deleting particles outside a radius of ' +
-                f'{self.rout * u.cm.to(u.au)} au ...')
+        if rcyl is not None:
+            utils.print_('Deleting particles outside a cylinder of radius ' +
+                f'{rcyl * u.cm.to(u.au)} au ...')
+            keep &= self.x**2 + self.y**2 <= rcyl**2
 
-            # Convert cartesian to polar coordinates to define a radial trim
-            r = np.sqrt(self.x**2 + self.y**2 + self.z**2)
+        if zcyl is not None:
+            keep &= np.abs(self.z) <= zcyl
 
-            for i in range(self.x.size):
-                if r[i] > self.rout:
-                    to_remove.append(i)
+        if planes is not None:
+            for normal, point in planes:
+                nx, ny, nz = normal
+                px, py, pz = point
+                keep &= nx*(self.x-px) + ny*(self.y-py) + nz*(self.z-pz) <= 0
 
         # Remove the particles from each quantity
-        self.x = np.delete(self.x, to_remove)
-        self.y = np.delete(self.y, to_remove)
-        self.z = np.delete(self.z, to_remove)
-        self.dens = np.delete(self.dens, to_remove)
-        self.temp = np.delete(self.temp, to_remove)
+        self._apply_mask(keep)
+
+        # Let lazy readers know which particles are left to be read
+        if hasattr(getattr(self, 'sph', None), 'select'):
+            self.sph.select(keep)
+
         utils.print_(f'Particles included: {self.x.size} | ' +
             f'Particles excluded: {self.npoints - self.x.size} ')
 
-    def find_resolution(self):
+    def _apply_mask(self, mask):
+        """ Select the particles given by mask from every particle field """
+
+        for field in self.particle_fields:
+            value = getattr(self, field, None)
+            if isinstance(value, np.ndarray) and value.size == mask.size:
+                setattr(self, field, value[mask])
+
+    def find_resolution(self, percentile=5):
         """
-        Find the minimum distance between points. 
-        If particles are too many, it uses only those that are 
-        closer to the geometrical center than the mean distance.
+        Find the separation between every particle and its nearest neighbour,
+        using a KD-tree in O(N log N). Returns the minimum and the given 
+        percentile of the separations, in cm. Particles sharing the same 
+        position are ignored.
         """
         
-        from scipy.spatial import distance
+        from scipy.spatial import cKDTree
 
-        utils.print_('Calculating minimum distance between all particles')
+        utils.print_('Calculating the nearest neighbour particle separation')
 
-        try:
-            dmin = distance.pdist(np.vstack([self.x, self.y, self.z]).T).min()
+        points = np.vstack([self.x, self.y, self.z]).T
+        dist, _ = cKDTree(points).query(points, k=2, workers=-1)
+        dist = dist[:, 1][dist[:, 1] > 0]
 
-        except MemoryError as e:
-            # Use only the 10000 closest particles to the center
-            n = 10000
-            x = np.sort(np.abs(self.x))[-n:]
-            y = np.sort(np.abs(self.y))[-n:]
-            z = np.sort(np.abs(self.z))[-n:]
-            dmin = distance.pdist(np.vstack([x, y, z]).T).min()
+        dmin = dist.min()
+        dperc = np.percentile(dist, percentile)
+        self.resolution = dmin
 
-        if self.cellsize > self.resolution:
-            utils.print_(
-                f'The current cell size {self.cellsize*u.cm.to(u.au):.1}au '+\
-                f'is larger than the minimum particle separation '+\
-                f'{self.resolution*u.cm.to(u.au):.1}au. ', blue=True)
-            utils.print_('You may want to increase ncells or use a bbox', 
-                blue=True)
+        utils.print_(f'Minimum separation: {dmin*u.cm.to(u.au):.2e} au | ' +\
+            f'{percentile}th percentile: {dperc*u.cm.to(u.au):.2e} au')
 
-        return dmin
+        return dmin, dperc
 
-    def interpolate_points(self, field, method='linear', fill='min'):
+    def suggest_ncells(self, resolution=None, percentile=5, ncellsmax=1024):
+        """
+        Number of cells per side needed for a cell size equal to resolution 
+        (in cm) or, by default, to the given percentile of the nearest 
+        neighbour particle separation. The result is limited to ncellsmax.
+        """
+
+        if resolution is None:
+            _, resolution = self.find_resolution(percentile)
+
+        rmin = np.min([self.x.min(), self.y.min(), self.z.min()])
+        rmax = np.max([self.x.max(), self.y.max(), self.z.max()])
+        ncells = int(np.clip(np.ceil((rmax - rmin) / resolution), 2, ncellsmax))
+
+        utils.print_(f'Suggested number of cells per side: {ncells}' +\
+            (f' (limited to {ncellsmax})' if ncells == ncellsmax else ''))
+
+        return ncells
+
+    def interpolate_points(self, field, method='linear', fill='min', 
+            kernel='cubic', nproc=1, neighbours=8, radius=None, memory=None):
         """
             Interpolate a set of points in cartesian coordinates along with their
             values into a rectangular grid.
+
+            This is a shortcut for interpolate_fields() using a single field.
         """
 
+        self.interpolate_fields([field], method, fill, kernel, nproc, 
+            neighbours, radius, memory)
+
+    def interpolate_fields(self, fields=['dens', 'temp'], method='linear', 
+            fill='min', kernel='cubic', nproc=1, neighbours=8, radius=None, 
+            memory=None):
+        """
+            Interpolate any number of particle fields onto a rectangular grid,
+            building the spatial structure (triangulation or kernel stencils) 
+            only once for all of them. 
+
+            fields are names of per-particle attributes, e.g., 'dens', 'temp',
+            'vx', 'vy' or 'vz'. Each result is stored as self.interp_<field>.
+
+            method can be:
+              - 'linear': linear interpolation over a Delaunay triangulation,
+                as in scipy's griddata.
+              - 'nearest': value of the closest particle, found using a 
+                KD-tree queried in parallel.
+              - 'idw': inverse-distance weighted average of the closest 
+                neighbours particles. Much faster than 'linear', so it is 
+                well suited for quick-look grids.
+              - 'sph': deposits the particle masses onto the grid using an 
+                SPH kernel ('cubic' or 'wendland') scaled by the particle 
+                smoothing lengths. It conserves the total mass and can be
+                parallelized over nproc processes.
+
+            For 'nearest' and 'idw', particles farther than radius (in cm) 
+            from a cell are ignored and cells with no particles within radius
+            are set to fill.
+
+            If memory (in bytes) is given, the grid is processed in z-slabs 
+            sized to fit within that budget, using only the particles that 
+            contribute to each slab, and the results are written into 
+            memory-mapped arrays on disk instead of being held in RAM.
+            Results do not depend on the budget. 'linear' is not supported 
+            in this mode, since a triangulation of the particles within a 
+            slab differs from the global one.
+        """
+
+        # Adapt the number of cells to the particle spacing, up to ncells
+        if self.auto_ncells:
+            self.ncells = self.suggest_ncells(ncellsmax=self.ncells)
+
         # Construct the rectangular grid
         rmin = np.min([self.x.min(), self.y.min(), self.z.min()])
         rmax = np.max([self.x.max(), self.y.max(), self.z.max()])
         self.bbox = (rmax - rmin) / 2
         self.cellsize = self.bbox / self.ncells
-        #self.resolution = self.find_resolution()
 
         self.xc = np.linspace(rmin, rmax, self.ncells)
         self.yc = np.linspace(rmin, rmax, self.ncells)
         self.zc = np.linspace(rmin, rmax, self.ncells)
-        self.X, self.Y, self.Z = np.meshgrid(self.xc, self.yc, self.zc)
 
         utils.print_(f'Creating a box of size [{rmin*u.cm.to(u.au):.1f} au, ' +\
             f'{rmax*u.cm.to(u.au):.1f} au] with {self.ncells} cells per side.')
 
-        # Determine which quantity is to be interpolated
-        if field == 'dens':
-            utils.print_(f'Interpolating density values onto the grid')
-            values = self.dens
-        elif field == 'temp':
-            utils.print_(f'Interpolating temperature values onto the grid')
-            values = self.temp
+        # Collect the values of every field to be interpolated
+        values = []
+        for field in fields:
+            value = getattr(self, field, None)
+            if not isinstance(value, np.ndarray) or value.size != self.x.size:
+                raise ValueError(f'Field {field} is not a per-particle array.')
+            values.append(value)
+
+        fills = {f: np.min(v) if fill == 'min' else fill 
+            for f, v in zip(fields, values)}
+
+        if method not in ['linear', 'nearest', 'idw', 'sph']:
+            raise ValueError(f'Interpolation method {method} not supported.')
+
+        if method == 'linear' and memory is not None:
+            raise ValueError(f'Interpolation method linear does not ' +\
+                'support a memory budget. Use nearest, idw or sph instead.')
+
+        utils.print_(f'Interpolating {", ".join(fields)} values onto the grid')
+
+        # Spatial structures shared by all fields and slabs
+        shared = {}
+        if method in ['nearest', 'idw']:
+            from scipy.spatial import cKDTree
+            shared['tree'] = cKDTree(np.vstack([self.x, self.y, self.z]).T)
+            shared['k'] = 1 if method == 'nearest' else neighbours
+            shared['radius'] = radius
+
+        elif method == 'sph':
+            shared['mass'], shared['hsml'] = self._sph_mass_hsml()
+            utils.print_(f'Depositing {self.x.size} particles using a ' +\
+                f'{kernel} kernel' + \
+                (f' and {nproc} processes' if nproc > 1 else ''))
+
+        if memory is None:
+            self.X, self.Y, self.Z = np.meshgrid(
+                self.xc, self.yc, self.zc, sparse=True)
+            interp = self._interpolate_slab(fields, values, fills, method, 
+                0, self.ncells, kernel=kernel, nproc=nproc, **shared)
+
+        else:
+            self.X = self.Y = self.Z = None
+            interp = self._interpolate_slabs(fields, values, fills, method, 
+                memory, kernel=kernel, nproc=nproc, **shared)
+
+        # Store the interpolated fields
+        for field, grid in zip(fields, interp):
+            setattr(self, f'interp_{field}', grid)
+
+    def get_interpolated(self, fields):
+        """ 
+            Dictionary of the interpolated fields and the cell centers, 
+            e.g., to be stored on disk and restored with set_interpolated().
+        """
+
+        arrays = {f'interp_{f}': getattr(self, f'interp_{f}') for f in fields}
+        arrays.update(xc=self.xc, yc=self.yc, zc=self.zc)
+
+        return arrays
+
+    def set_interpolated(self, arrays):
+        """ Restore a grid from the arrays given by get_interpolated() """
+
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+        # The stored grid may have been resized, e.g., by auto_ncells
+        self.ncells = self.xc.size
+        self.bbox = (self.xc[-1] - self.xc[0]) / 2
+        self.cellsize = self.bbox / self.ncells
+        self.X = self.Y = self.Z = None
+
+    def _interpolate_slabs(self, fields, values, fills, method, memory, 
+            **kwargs):
+        """
+            Interpolate the grid in z-slabs whose size fits within the memory
+            budget (in bytes) and write every slab into memory-mapped arrays.
+            Arrays are stored in fortran order, so that every slab is 
+            contiguous on disk and so is the 1D RADMC3D ordering.
+        """
+
+        import tempfile
+
+        n = self.ncells
+        nf = len(fields)
+
+        # Rough number of bytes used per cell while processing a slab: 
+        # cell coordinates, temporary and final results and, for the 
+        # neighbour queries, distances, indices and gathered values.
+        per_cell = 8 * (3 + 2 * nf) + np.dtype(self.dtype).itemsize * nf
+        if method in ['nearest', 'idw']:
+            per_cell += 8 * kwargs['k'] * (2 + nf)
+
+        nz = int(np.clip(memory // (per_cell * n * n), 1, n))
+        nslabs = int(np.ceil(n / nz))
+
+        utils.print_(f'Streaming the grid in {nslabs} slabs of {nz} cells ' +\
+            f'to fit within {memory / 2**30:.1f} GB')
+
+        # Scratch directory holding the memory-mapped grids. It is removed 
+        # along with the grid instance.
+        self._scratch = tempfile.TemporaryDirectory(prefix='synthesizer_')
+        grids = [np.lib.format.open_memmap(
+            os.path.join(self._scratch.name, f'interp_{f}.npy'), mode='w+', 
+            dtype=self.dtype, shape=(n, n, n), fortran_order=True)
+            for f in fields]
+
+        for k0 in range(0, n, nz):
+            k1 = min(k0 + nz, n)
+            for grid, slab in zip(grids, self._interpolate_slab(
+                    fields, values, fills, method, k0, k1, **kwargs)):
+                grid[:, :, k0: k1] = slab
+
+            utils.print_(f'Slab {k0 // nz + 1}/{nslabs} done', end='\r')
+
+        print('')
+        for grid in grids:
+            grid.flush()
+
+        return grids
+
+    def _interpolate_slab(self, fields, values, fills, method, k0, k1, 
+            kernel='cubic', nproc=1, tree=None, k=1, radius=None, mass=None, 
+            hsml=None):
+        """
+            Interpolate all fields onto the cells of the z-slab [k0, k1).
+            Returns a list of arrays indexed as [iy, ix, iz], like the 
+            meshgrid of cell centers. 
+        """
+
+        from scipy.interpolate import LinearNDInterpolator
+
+        if method == 'sph':
+            return self._deposit_sph(fields, kernel, nproc, fills, mass, hsml, 
+                zrange=(k0, k1))
+
+        # Sparse coordinates of the cells, stacked only once
+        X, Y, Z = np.meshgrid(self.xc, self.yc, self.zc[k0: k1], sparse=True)
+        shape = np.broadcast(X, Y, Z).shape
+        cells = cell_centers(X, Y, Z)
+
+        if method == 'linear':
+            # Triangulate once and interpolate all fields at the grid points
+            points = np.vstack([self.x, self.y, self.z]).T
+            interpolator = LinearNDInterpolator(
+                points, np.column_stack(values), fill_value=np.nan)
+            result = interpolator(cells).astype(self.dtype, copy=False)
+
+        else:
+            # Query the closest particles to every cell using the KD-tree
+            result = self._query_neighbours(tree, cells, values, k, radius)
+
+        result = result.reshape(shape + (len(values), ))
+
+        interp = []
+        for i, field in enumerate(fields):
+            grid = result[..., i]
+            grid[np.isnan(grid)] = fills[field]
+            interp.append(grid)
+
+        return interp
+
+    def _interpolate_at(self, cells, fields, method='linear', fill='min', 
+            neighbours=8, radius=None):
+        """
+            Interpolate particle fields at arbitrary cell centers, given as
+            an array of shape (ncells, 3), as used by non-regular grids. 
+            method can be 'linear', 'nearest' or 'idw'. 
+            Returns a list of 1D arrays, one per field.
+        """
+
+        from scipy.interpolate import LinearNDInterpolator
+        from scipy.spatial import cKDTree
+
+        values = [getattr(self, f) for f in fields]
+        points = np.vstack([self.x, self.y, self.z]).T
+
+        if method == 'linear':
+            result = LinearNDInterpolator(points, np.column_stack(values), 
+                fill_value=np.nan)(cells).astype(self.dtype, copy=False)
+
+        elif method in ['nearest', 'idw']:
+            result = self._query_neighbours(cKDTree(points), cells, values, 
+                1 if method == 'nearest' else neighbours, radius)
+
         else:
-            raise ValueError('field must be "dens" or "temp".')
-
-        # Interpolate the point values at the grid points
-        interp = griddata(
-            points=np.vstack([self.x, self.y, self.z]).T, 
-            values=values, 
-            xi=(self.X, self.Y, self.Z), 
-            method=method, 
-            fill_value=np.min(values) if fill == 'min' else fill,
+            raise ValueError(f'Interpolation method {method} not supported ' +\
+                f'by {type(self).__name__}.')
+
+        interp = []
+        for i, value in enumerate(values):
+            grid = result[:, i]
+            grid[np.isnan(grid)] = np.min(value) if fill == 'min' else fill
+            interp.append(grid)
+
+        return interp
+
+    def _query_neighbours(self, tree, cells, values, k=1, radius=None):
+        """
+            Inverse-distance weighted average of values over the k particles
+            closest to every cell (nearest neighbour when k = 1). Queries run 
+            in parallel on all available cores. Cells with no particles within 
+            radius are set to NaN. Results are given in the grid precision.
+        """
+
+        dist, idx = tree.query(cells, k=k, workers=-1,
+            distance_upper_bound=np.inf if radius is None else radius)
+
+        values = np.column_stack(values)
+        result = np.full((cells.shape[0], values.shape[1]), np.nan, 
+            dtype=self.dtype)
+
+        if k == 1:
+            found = np.isfinite(dist)
+            result[found] = values[idx[found]]
+        else:
+            # Missing neighbours come with infinite distance and null weight
+            found = np.isfinite(dist)
+            exact = dist[:, 0] == 0
+            weights = np.zeros(dist.shape)
+            weights[found] = 1 / dist[found]
+            weights[exact] = 0
+            weights[exact, 0] = 1
+            norm = weights.sum(axis=1)
+            has = norm > 0
+
+            # Missing neighbours are indexed past the end, so clip them
+            idx = np.clip(idx, 0, values.shape[0] - 1)
+            result[has] = np.einsum('ij,ijk->ik', weights[has], 
+                values[idx[has]]) / norm[has, None]
+
+        return result
+
+    def _sph_mass_hsml(self):
+        """
+            Dust mass and smoothing length of every particle.
+
+            Particle masses and smoothing lengths are taken from the reader. 
+            If one of them is missing, it is derived from the other and the 
+            density, as m = rho * (h / eta)^3, with eta = 1.2.
+        """
+
+        eta = 1.2
+        mass = getattr(self, 'mass', None)
+        hsml = getattr(self, 'hsml', None)
+
+        if mass is None and hsml is None:
+            raise ValueError('SPH interpolation requires particle masses ' +\
+                f'or smoothing lengths, but the reader provides none.')
+
+        # Powers of cgs values overflow in single precision (e.g., memory-
+        # mapped SPHng columns), so work in double precision
+        dens = np.asarray(self.dens, dtype=np.float64)
+        if mass is not None:
+            mass = np.asarray(mass, dtype=np.float64) / self.g2d
+        else:
+            mass = dens * (np.asarray(hsml, dtype=np.float64) / eta)**3
+
+        if hsml is None:
+            hsml = eta * (mass / dens)**(1/3)
+
+        return mass, hsml
+
+    def _deposit_sph(self, fields, kernel='cubic', nproc=1, fills={}, 
+            mass=None, hsml=None, zrange=None):
+        """
+            Deposit the particles onto the grid using an SPH kernel.
+            Density is obtained from the deposited mass and any other field
+            is mass-weighted. Cells that receive no mass keep a zero density,
+            to conserve the total mass, while other fields are set to their
+            value in fills (zero by default).
+
+            If zrange = (k0, k1) is given, only the z-slab of cells [k0, k1)
+            is computed, using the particles whose kernels overlap with it.
+            Deposition is accumulated in double precision and the results 
+            are converted to the grid precision.
+        """
+
+        if mass is None or hsml is None:
+            mass, hsml = self._sph_mass_hsml()
+
+        dx = float(self.xc[1] - self.xc[0])
+        use = slice(None)
+
+        if zrange is not None:
+            k0, k1 = zrange
+            use = (self.z + 2 * hsml >= self.zc[k0] - dx / 2) & \
+                (self.z - 2 * hsml <= self.zc[k1 - 1] + dx / 2)
+
+        deposited, means = sph_kernels.deposit(
+            self.x[use], self.y[use], self.z[use], mass[use], hsml[use], 
+            ncells=self.ncells, 
+            origin=self.xc[0], 
+            dx=dx, 
+            values=[getattr(self, f)[use] for f in fields if f != 'dens'], 
+            kernel=kernel,
+            nproc=nproc,
+            zrange=zrange,
         )
- 
-        # Store the interpolated field
-        if field == 'dens':
-            self.interp_dens = interp
-        elif field == 'temp':
-            self.interp_temp = interp
+        means = iter(means)
+        empty = deposited == 0
+
+        grids = []
+        for f in fields:
+            if f == 'dens':
+                grid = deposited / dx**3
+            else:
+                grid = next(means)
+                grid[empty] = fills.get(f, 0)
+
+            # Swap to the [y, x, z] indexing of the meshgrid used by griddata
+            grids.append(np.swapaxes(grid.astype(self.dtype, copy=False), 0, 1))
+
+        return grids
 
 
     def write_grid_file(self):
@@ -301,79 +746,64 @@ class CartesianGrid():
             self.zw = np.insert(self.zw, 0, self.zc[0])
 
             # Write the cell walls
-            for i in self.xw:
-                f.write(f'{i:13.6e}\n')      
-            for j in self.yw:
-                f.write(f'{j:13.6e}\n')      
-            for k in self.zw:
-                f.write(f'{k:13.6e}\n')      
+            np.savetxt(f, np.concatenate([self.xw, self.yw, self.zw]), 
+                fmt='%13.6e')
 
 
-    def write_density_file(self):
-        """ Write the density file """
+    def write_density_file(self, binary=False):
+        """ Write the density file, optionally in binary format (.binp) """
         utils.print_('Writing dust density file')
 
         # Flatten the array into a 1D fortran-style indexing
         density = self.interp_dens.ravel(order='F')
-        with open('dust_density.inp','w+') as f:
-            f.write('1\n')                      
-            f.write(f'{density.size:d}\n')
-            f.write(f'{self.nspec}\n')                
 
-            if self.nspec == 1:
-                # Write a single dust species
-                for d in density:
-                    f.write(f'{d:13.6e}\n')
-            else:
-                utils.print_(f'Writing two density species ...')
-                # Write two densities: 
-                # one with original value outside the sootline and zero within 
-                temp1d = self.interp_temp.ravel(order='F')
-                for i, d in enumerate(density):
-                    if temp1d[i] < self.sootline:
-                        f.write(f'{d:13.6e}\n')
-                    else:
-                        f.write('0\n')
-
-                # one with zero outside the sootline and reduced density within
-                for i, d in enumerate(density):
-                    if temp1d[i] < self.sootline:
-                        f.write('0\n')
-                    else:
-                        f.write(f'{(d * self.subl_mfrac):13.6e}\n')
-
-    def write_temperature_file(self):
-        """ Write the temperature file """
+        if self.nspec > 1:
+            utils.print_(f'Writing two density species ...')
+            # Write two densities: 
+            # one with original value outside the sootline and zero within 
+            # one with zero outside the sootline and reduced density within
+            # Species are generated in chunks to stream large grids
+            def species(dens, temp, chunk=2**20):
+                for s in range(2):
+                    for i in range(0, dens.size, chunk):
+                        d = dens[i: i + chunk]
+                        subl = temp[i: i + chunk] >= self.sootline
+                        yield np.where(subl, d * self.subl_mfrac, 0) if s \
+                            else np.where(subl, 0, d)
+
+            density = species(density, self.interp_temp.ravel(order='F'))
+
+        utils.write_radmc3d_file('dust_density.inp', density, 
+            nrspec=self.nspec, binary=binary, nrcells=self.interp_dens.size)
+
+    def write_temperature_file(self, binary=False):
+        """ Write the temperature file, optionally in binary format (.bdat) """
         utils.print_('Writing dust temperature file')
         
-        temperature = self.interp_temp.ravel(order='F')
-        with open('dust_temperature.dat','w+') as f:
-            f.write('1\n')                      
-            f.write(f'{temperature.size:d}\n')
-            f.write(f'{self.nspec}\n')                
+        # Write the temperature Nspec times for Nspec dust species
+        temperature = [self.interp_temp.ravel(order='F')] * self.nspec
 
-            # Write the temperature Nspec times for Nspec dust species
-            for i in range(self.nspec):
-                for t in temperature:
-                    f.write(f'{t:13.6e}\n')
+        utils.write_radmc3d_file(
+            'dust_temperature.dat', temperature, nrspec=self.nspec, 
+            binary=binary)
 
-    def write_vector_field(self, morphology):
+    def write_vector_field(self, morphology, binary=False):
         """ Create a vector field for dust alignment """
  
         utils.print_('Writing grain alignment direction file')
  
         if self.vfield is None:
-            self.vfield = VectorField(self.X, self.Y, self.Z, morphology)
- 
-        with open('grainalign_dir.inp','w+') as f:
-            f.write('1\n')
-            f.write(f'{int(self.ncells**3)}\n')
-            for iz in range(self.ncells):
-                for iy in range(self.ncells):
-                    for ix in range(self.ncells):
-                        f.write(f'{self.vfield.vx[ix, iy, iz]:13.6e} ' +\
-                                f'{self.vfield.vy[ix, iy, iz]:13.6e} ' +\
-                                f'{self.vfield.vz[ix, iy, iz]:13.6e}\n')
+            # Grids interpolated in slabs do not keep the cell coordinates
+            if getattr(self, 'X', None) is None:
+                self.X, self.Y, self.Z = np.meshgrid(
+                    self.xc, self.yc, self.zc, sparse=True)
+
+            self.vfield = VectorField(self.X, self.Y, self.Z, morphology, 
+                dtype=self.dtype)
+
+        # One row of (vx, vy, vz) per cell, in fortran-style indexing
+        utils.write_radmc3d_file('grainalign_dir.inp', self.vfield.rows(), 
+            nrcells=self.vfield.ncells, binary=binary)
 
     def plot_midplane(self, field, data=None):
         """ Plot the density midplane at z=0 using Matplotlib """
@@ -619,13 +1049,404 @@ class CartesianGrid():
                 utils.print_(e, bold=True)
 
 
-class SphericalGrid():
-    def __init__(self):
-        """ This is yet to be implemented.
-            It will be translated from old scripts and from the very own
-            radmc3d's implementation.
-            src:https://github.com/dullemond/radmc3d-2.0/blob/master/python/
-                radmc3d_tools/sph_to_sphergrid.py
-         """
+class OctreeGrid(CartesianGrid):
+    def __init__(self, ncells=8, levelmax=6, maxpart=8, gradient=None, 
+            **kwargs):
+        """ 
+        Create an adaptive oct-tree grid from a set of 3D points.
+
+        A regular base grid of ncells^3 cells is recursively refined, up to 
+        levelmax levels, where cells contain more than maxpart particles or, 
+        if gradient is given, where the particle densities within a cell span
+        more than gradient orders of magnitude. Values are only stored for 
+        the leaf cells, in the depth-first order used by RADMC3D.
+
+        Any other argument is passed to CartesianGrid, except auto_ncells, 
+        since the resolution is set by the refinement instead.
+        """
+
+        if kwargs.get('auto_ncells', False):
+            raise ValueError('auto_ncells is not supported by oct-tree ' +\
+                'grids. Set the resolution with levelmax and maxpart instead.')
+
+        super().__init__(ncells, **kwargs)
+        self.levelmax = levelmax
+        self.maxpart = maxpart
+        self.gradient = gradient
+
+    def build_tree(self):
+        """ 
+            Refine the base grid level by level, using only the particles 
+            within the cells refined in the previous level. 
+        """
+
+        n = self.ncells
+        rmin = np.min([self.x.min(), self.y.min(), self.z.min()])
+        rmax = np.max([self.x.max(), self.y.max(), self.z.max()])
+        size = rmax - rmin
+        self.bbox = size / 2
+        self.xi = np.linspace(rmin, rmax, n + 1)
+        self.yi = np.linspace(rmin, rmax, n + 1)
+        self.zi = np.linspace(rmin, rmax, n + 1)
+
+        # Integer coordinates of every node at its own level
+        cells = np.indices((n, n, n)).reshape(3, -1)
+        active = np.ones(self.x.size, dtype=bool)
+        nodes = []
+
+        for level in range(self.levelmax + 1):
+            m = n * 2**level
+            p = [np.clip(((c[active] - rmin) / size * m).astype(np.int64), 
+                0, m - 1) for c in [self.x, self.y, self.z]]
+            pkey = (p[0] * m + p[1]) * m + p[2]
+            ckey = (cells[0] * m + cells[1]) * m + cells[2]
+
+            # Particle counts (and density range) per occupied cell
+            order = np.argsort(pkey)
+            pkey = pkey[order]
+            ukey, start, counts = np.unique(
+                pkey, return_index=True, return_counts=True)
+            pos = np.clip(np.searchsorted(ukey, ckey), 0, ukey.size - 1)
+            found = ukey[pos] == ckey
+
+            refine = found & (counts[pos] > self.maxpart)
+
+            if self.gradient is not None:
+                dens = self.dens[active][order]
+                drange = np.log10(np.maximum.reduceat(dens, start) / 
+                    np.minimum.reduceat(dens, start))
+                refine |= found & (drange[pos] > self.gradient)
+
+            if level == self.levelmax:
+                refine[:] = False
+
+            nodes.append((level, cells, refine))
+
+            # Children of the refined cells and the particles within them
+            if not refine.any():
+                break
+
+            offsets = np.indices((2, 2, 2)).reshape(3, -1)
+            cells = 2 * cells[:, refine, None] + offsets[:, None, :]
+            cells = cells.reshape(3, -1)
+            active[active] = np.isin(
+                (p[0] * m + p[1]) * m + p[2], ckey[refine])
+
+        self._sort_tree(nodes)
+
+        utils.print_(f'Oct-tree with {self.leaves.shape[0]} leaf cells ' +\
+            f'and {len(nodes) - 1} refinement levels')
+
+    def _sort_tree(self, nodes):
+        """ 
+            Sort the nodes of every level in depth-first order, with x 
+            varying fastest both in the base grid and among the children.
+        """
+
+        n = self.ncells
+        L = len(nodes) - 1
+        level = np.concatenate([np.full(c.shape[1], l) for l, c, _ in nodes])
+        ix, iy, iz = np.concatenate([c for _, c, _ in nodes], axis=1)
+        refined = np.concatenate([r for _, _, r in nodes])
+
+        # Sort keys: base cell first, then the child index at every level, 
+        # shifted by one so that parents come before their children
+        base = ((iz >> level) * n + (iy >> level)) * n + (ix >> level)
+        digits = []
+        for k in range(1, L + 1):
+            shift = np.maximum(level - k, 0)
+            d = ((ix >> shift) & 1) + 2 * ((iy >> shift) & 1) + \
+                4 * ((iz >> shift) & 1)
+            digits.append(np.where(level >= k, d + 1, 0))
+
+        order = np.lexsort(digits[::-1] + [base])
+        self.flags = refined[order].astype(np.int8)
+        self.nlevels = L
+
+        # Leaf centers
+        leaf = order[~refined[order]]
+        dx = 2 * self.bbox / (n * 2.0**level[leaf])
+        self.leaves = np.column_stack([self.xi[0] + (i[leaf] + 0.5) * dx 
+            for i in [ix, iy, iz]])
+
+    def interpolate_fields(self, fields=['dens', 'temp'], method='linear', 
+            fill='min', kernel='cubic', nproc=1, neighbours=8, radius=None, 
+            memory=None):
+        """
+            Build the oct-tree and interpolate the given particle fields at 
+            the centers of its leaf cells. method can be 'linear', 'nearest' 
+            or 'idw', as in CartesianGrid.interpolate_fields(). Results are 
+            1D arrays, sorted like the leaf cells. kernel and memory are 
+            not used, since kernels and slabs only apply to regular grids.
+        """
+
+        self.build_tree()
+
+        utils.print_(f'Interpolating {", ".join(fields)} values onto the ' +\
+            'leaf cells')
+
+        interp = self._interpolate_at(self.leaves, fields, method, fill, 
+            neighbours, radius)
+
+        for field, grid in zip(fields, interp):
+            setattr(self, f'interp_{field}', grid)
+
+    def get_interpolated(self, fields):
+        """ Dictionary of the interpolated fields and the tree structure """
+
+        arrays = {f'interp_{f}': getattr(self, f'interp_{f}') for f in fields}
+        arrays.update(xi=self.xi, yi=self.yi, zi=self.zi, flags=self.flags, 
+            leaves=self.leaves, nlevels=np.array(self.nlevels))
+
+        return arrays
+
+    def set_interpolated(self, arrays):
+        """ Restore a grid from the arrays given by get_interpolated() """
+
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+        self.nlevels = int(self.nlevels)
+        self.ncells = self.xi.size - 1
+        self.bbox = (self.xi[-1] - self.xi[0]) / 2
+
+    def write_grid_file(self):
+        """ Write the oct-tree grid file """
+        with open('amr_grid.inp','w+') as f:
+            # iformat
+            f.write('1\n')                     
+            # Oct-tree grid
+            f.write('1\n')                      
+            # Coordinate system
+            f.write(f'{self.cordsystem}\n')                     
+            # Gridinfo
+            f.write('0\n')                       
+            # Number of cells
+            f.write('1 1 1\n')                   
+            # Size of the base grid
+            f.write(f'{self.ncells:d} {self.ncells:d} {self.ncells:d}\n')
+            # Max. refinement level, number of leafs and branches
+            f.write(f'{self.nlevels} {self.leaves.shape[0]} {self.flags.size}\n')
+
+            # Write the base cell walls
+            np.savetxt(f, np.concatenate([self.xi, self.yi, self.zi]), 
+                fmt='%13.6e')
+
+            # Write the refinement flags in depth-first order
+            np.savetxt(f, self.flags, fmt='%d')
+
+    def write_vector_field(self, morphology, binary=False):
+        """ Create a vector field for dust alignment on the leaf cells """
+ 
+        utils.print_('Writing grain alignment direction file')
+ 
+        if self.vfield is None:
+            self.vfield = VectorField(*self.leaves.T, morphology, 
+                dtype=self.dtype)
+
+        utils.write_radmc3d_file('grainalign_dir.inp', self.vfield.rows(), 
+            nrcells=self.vfield.ncells, binary=binary)
+
+    def plot_midplane(self, field, data=None):
+        utils.not_implemented('Midplane plots of oct-tree grids')
+
+    def plot_3d(self, field, data=None, tau=False): 
+        utils.not_implemented('3D rendering of oct-tree grids')
+
+
+def spherical_to_cartesian(r, theta, phi):
+    """ Map spherical (r, theta, phi) onto cartesian (x, y, z) coordinates """
+    sin_theta = np.sin(theta)
+    return r * sin_theta * np.cos(phi), r * sin_theta * np.sin(phi), \
+        r * np.cos(theta)
+
+
+class SphericalGrid(CartesianGrid):
+    def __init__(self, ncells=100, ntheta=64, nphi=1, rin=None, rout=None, 
+            **kwargs):
+        """ 
+        Create a spherical grid (r, theta, phi), with ncells logarithmically
+        spaced radii between rin and rout, ntheta cells in polar angle and 
+        nphi cells in azimuth. A single azimuthal (or polar) cell makes the 
+        grid axisymmetric (or 1D) for RADMC3D. 
+
+        Centrally concentrated models reach the same central resolution as 
+        a cartesian grid with orders of magnitude fewer cells.
+
+        The grid can be filled either from an analytical model, using 
+        create_model(), or from SPH particles, using read_sph() and 
+        interpolate_fields(). Fields are arrays indexed as [ir, itheta, iphi].
+
+        rin and rout are given in cm. By default, rout is the largest 
+        particle radius (or the model's default box size) and 
+        rin = 1e-3 rout. Any other argument is passed to CartesianGrid, 
+        except auto_ncells, since particle separations set no natural number
+        of logarithmic radial cells.
+        """
 
-        utils.not_implemented()
+        if kwargs.get('auto_ncells', False):
+            raise ValueError('auto_ncells is not supported by spherical ' +\
+                'grids. Set the number of radial cells with ncells instead.')
+
+        super().__init__(ncells, rout=rout, **kwargs)
+        self.cordsystem = 100
+        self.ntheta = ntheta
+        self.nphi = nphi
+        self.rin = rin
+
+    def create_walls(self):
+        """ Set the cell walls and the cartesian position of the centers """
+
+        if self.rout is None:
+            self.rout = np.sqrt(self.x**2 + self.y**2 + self.z**2).max()
+
+        rin = self.rout * 1e-3 if self.rin is None else self.rin
+        self.bbox = self.rout
+
+        self.ri = np.logspace(np.log10(rin), np.log10(self.rout), self.ncells+1)
+        self.thetai = np.linspace(0, np.pi, self.ntheta + 1)
+        self.phii = np.linspace(0, 2 * np.pi, self.nphi + 1)
+
+        # Cell centers, geometrically centered in radius
+        self.rc = np.sqrt(self.ri[:-1] * self.ri[1:])
+        self.thetac = 0.5 * (self.thetai[:-1] + self.thetai[1:])
+        self.phic = 0.5 * (self.phii[:-1] + self.phii[1:])
+
+        self.R, self.Theta, self.Phi = np.meshgrid(
+            self.rc, self.thetac, self.phic, indexing='ij', sparse=True)
+        self.X, self.Y, self.Z = spherical_to_cartesian(
+            self.R, self.Theta, self.Phi)
+
+        utils.print_(f'Creating a spherical grid from ' +\
+            f'{rin*u.cm.to(u.au):.2f} au to {self.rout*u.cm.to(u.au):.1f} au '+\
+            f'with {self.ncells * self.ntheta * self.nphi} cells ' +\
+            f'({self.ncells} x {self.ntheta} x {self.nphi})')
+
+    def create_model(self, model, nthreads=1, backend='numpy', params=None):
+        """ 
+            Evaluate an analytical model at the cell centers, in radial 
+            slabs and in parallel over nthreads threads. Model expressions
+            are evaluated by backend, either 'numpy' or 'numexpr'. params
+            is a dictionary overriding the default model parameters.
+        """
+
+        from synthesizer.gridder import analytical
+
+        utils.print_(f'Creating density model: {model}')
+
+        if self.rout is None:
+            self.rout = analytical.default_bbox(model)
+
+        self.create_walls()
+
+        # Models scale with the box size, so use rout instead of x.max()
+        shape = (self.ncells, self.ntheta, self.nphi)
+        self.interp_dens = np.empty(shape, dtype=self.dtype)
+        self.interp_temp = np.empty(shape, dtype=self.dtype) \
+            if self.add_temp else np.zeros(shape, dtype=self.dtype)
+
+        m = analytical.evaluate_model(model, self.X, self.Y, self.Z, 
+            r_c=self.rout, dens=self.interp_dens, 
+            temp=self.interp_temp if self.add_temp else None, 
+            field=self.vfield, g2d=self.g2d, nthreads=nthreads, 
+            backend=backend, params=params)
+
+        # Fields are lazy, so only the vector field is evaluated on the grid
+        if model == 'user':
+            self.vfield = analytical.get_model(model, self.X, self.Y, self.Z, 
+                self.vfield, params).vfield
+
+    def interpolate_fields(self, fields=['dens', 'temp'], method='linear', 
+            fill='min', kernel='cubic', nproc=1, neighbours=8, radius=None, 
+            memory=None):
+        """
+            Interpolate the given particle fields at the cell centers. method
+            can be 'linear', 'nearest' or 'idw', as in 
+            CartesianGrid.interpolate_fields(). kernel and memory are not 
+            used, since kernels and slabs only apply to regular grids.
+        """
+
+        self.create_walls()
+
+        utils.print_(f'Interpolating {", ".join(fields)} values onto the grid')
+
+        interp = self._interpolate_at(cell_centers(self.X, self.Y, self.Z), 
+            fields, method, fill, neighbours, radius)
+
+        shape = (self.ncells, self.ntheta, self.nphi)
+        for field, grid in zip(fields, interp):
+            setattr(self, f'interp_{field}', grid.reshape(shape))
+
+    def get_interpolated(self, fields):
+        """ Dictionary of the interpolated fields and the cell walls """
+
+        arrays = {f'interp_{f}': getattr(self, f'interp_{f}') for f in fields}
+        arrays.update(ri=self.ri, thetai=self.thetai, phii=self.phii)
+
+        return arrays
+
+    def set_interpolated(self, arrays):
+        """ Restore a grid from the arrays given by get_interpolated() """
+
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+        self.rin, self.rout = self.ri[0], self.ri[-1]
+        self.ncells = self.ri.size - 1
+        self.ntheta = self.thetai.size - 1
+        self.nphi = self.phii.size - 1
+        self.create_walls()
+
+    def write_grid_file(self):
+        """ Write the spherical grid file """
+        with open('amr_grid.inp','w+') as f:
+            # iformat
+            f.write('1\n')                     
+            # Regular grid
+            f.write('0\n')                      
+            # Coordinate system
+            f.write(f'{self.cordsystem}\n')                     
+            # Gridinfo
+            f.write('0\n')                       
+            # Include the polar and azimuthal dimensions if resolved
+            f.write(f'1 {int(self.ntheta > 1)} {int(self.nphi > 1)}\n')
+            # Size of the grid
+            f.write(f'{self.ncells:d} {self.ntheta:d} {self.nphi:d}\n')
+
+            # Write the cell walls
+            np.savetxt(f, np.concatenate([self.ri, self.thetai, self.phii]), 
+                fmt='%13.6e')
+
+    def write_vector_field(self, morphology, binary=False):
+        """ 
+            Create a vector field for dust alignment. Vectors are given in 
+            the local (r, theta, phi) basis of every cell.
+        """
+ 
+        utils.print_('Writing grain alignment direction file')
+ 
+        if self.vfield is None:
+            self.vfield = VectorField(self.X, self.Y, self.Z, morphology, 
+                dtype=self.dtype)
+
+        # Project the cartesian components onto the spherical basis. Compact
+        # components give compact projections, expanded only when written.
+        vx, vy, vz = self.vfield.components
+        st, ct = [f(self.Theta).astype(self.dtype) for f in [np.sin, np.cos]]
+        sp, cp = [f(self.Phi).astype(self.dtype) for f in [np.sin, np.cos]]
+
+        vfield = vector_field.rows(
+            vx * st * cp + vy * st * sp + vz * ct, 
+            vx * ct * cp + vy * ct * sp - vz * st, 
+            -vx * sp + vy * cp, 
+            self.vfield.shape,
+        )
+ 
+        utils.write_radmc3d_file('grainalign_dir.inp', vfield, 
+            nrcells=self.vfield.ncells, binary=binary)
+
+    def plot_midplane(self, field, data=None):
+        utils.not_implemented('Midplane plots of spherical grids')
+
+    def plot_3d(self, field, data=None, tau=False): 
+        utils.not_implemented('3D rendering of spherical grids')
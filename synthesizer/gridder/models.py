@@ -1,3 +1,4 @@
+import re
 import numpy as np
 import astropy.units as u
 import astropy.constants as const
@@ -11,30 +12,315 @@ m_H2 = (2.3 * (const.m_p + const.m_e).cgs.value)
 G = const.G.cgs.value
 kB = const.k_B.cgs.value
 
+# Backends available to evaluate model expressions
+backends = ['numpy', 'numexpr']
+
+# Functions that can be used within model expressions, named as in numexpr
+functions = {f: getattr(np, f) for f in ['sqrt', 'exp', 'log', 'log10', 
+    'sin', 'cos', 'tan', 'arctan2', 'where', 'abs']}
+
+def import_numexpr():
+    """ Import numexpr, which is only required by the numexpr backend """
+    try:
+        import numexpr
+    except ImportError:
+        raise utils.NotInstalled('The numexpr backend requires numexpr. ' +\
+            'Install it with: pip install numexpr')
+
+    return numexpr
+
+def evaluate(expr, variables, definitions=(), backend='numpy', geometry=None):
+    """
+        Evaluate the expression expr, given as a string, over the arrays and
+        scalars in the dictionary variables. 
+
+        definitions is a sequence of (name, expression) pairs evaluated in 
+        order, like a sequence of assignments, that expr can refer to. 
+        A name can be redefined in terms of its previous value. 
+
+        With the numpy backend, every definition is evaluated into a 
+        temporary array. With the numexpr backend, the definitions and 
+        scalars are inlined into a single expression, which numexpr 
+        evaluates in one multi-threaded pass over memory, in blocks that fit
+        in cache, without any full-size temporaries. Definitions that do not
+        span the full grid (e.g., a cylindrical radius over sparse 
+        coordinates) are still evaluated once into small arrays, instead of
+        being recomputed for every cell.
+
+        geometry is an optional dictionary caching the definitions that only
+        depend on the coordinates x, y and z (e.g., radii), keyed by their 
+        expression in terms of x, y and z. They are evaluated once into 
+        arrays, with either backend, and taken from the cache by any later 
+        evaluation over the same coordinates.
+    """
+
+    def substitute(expr, values):
+        if not values:
+            return expr
+
+        return re.sub(r'\b(' + '|'.join(values) + r')\b', 
+            lambda m: values[m.group(1)], expr)
+
+    # Definitions that only depend on the coordinates, expanded in terms of 
+    # x, y and z, which is their key in the geometry cache
+    coordinates = {c: c for c in ['x', 'y', 'z']}
+
+    def expand(name, definition):
+        names = set(re.findall(r'\b[A-Za-z_]\w*\b', definition))
+        if geometry is None or not names - functions.keys() <= \
+                coordinates.keys():
+            coordinates.pop(name, None)
+            return None
+
+        coordinates[name] = f'({substitute(definition, coordinates)})'
+        return coordinates[name]
+
+    if backend == 'numpy':
+        namespace = dict(variables)
+        for name, definition in definitions:
+            key = expand(name, definition)
+            if key is None:
+                namespace[name] = eval(definition, functions, namespace)
+            else:
+                if key not in geometry:
+                    geometry[key] = eval(definition, functions, namespace)
+                namespace[name] = geometry[key]
+
+        return eval(expr, functions, namespace)
+
+    elif backend == 'numexpr':
+        numexpr = import_numexpr()
+
+        arrays = {n: v for n, v in variables.items() if np.ndim(v) > 0}
+        size = np.prod(np.broadcast_shapes(*[v.shape for v in arrays.values()]))
+
+        # Text replacing every name: scalars by their value, and definitions 
+        # by their inlined expression or by the key of their evaluated array
+        values = {n: f'({float(v)!r})' for n, v in variables.items() 
+            if np.ndim(v) == 0}
+
+        for i, (name, definition) in enumerate(definitions):
+            key = expand(name, definition)
+            definition = substitute(definition, values)
+            names = set(re.findall(r'\b[A-Za-z_]\w*\b', definition))
+            shape = np.broadcast_shapes(
+                *[arrays[n].shape for n in names & arrays.keys()])
+
+            # Evaluate smaller and cached definitions once, inline the rest
+            if key is not None and key in geometry:
+                array = geometry[key]
+            elif key is not None or np.prod(shape) < size:
+                array = numexpr.evaluate(definition, local_dict=arrays, 
+                    global_dict={})
+                if key is not None:
+                    geometry[key] = array
+            else:
+                values[name] = f'({definition})'
+                continue
+
+            arrays[f'{name}__{i}'] = array
+            values[name] = f'{name}__{i}'
+
+        return numexpr.evaluate(substitute(expr, values), local_dict=arrays, 
+            global_dict={})
+
+    else:
+        raise ValueError(f'backend must be one of {backends}, not {backend}')
+
+class cached_field():
+    """
+        Model property that is evaluated on first access and cached, so 3D 
+        fields are computed only once. Fields depend on the coordinates, 
+        the scale radius r_c, the backend and the declared parameters of the
+        model, plus any attribute named in depends. The cached value is 
+        invalidated, and evaluated again on next access, when any of them 
+        is assigned a different value. Use parameters=False for fields that
+        do not depend on the model parameters.
+
+        Values assigned to the field are kept until they are reassigned.
+        A setter can be given, as for properties, to validate them. 
+
+        Usage:  @cached_field('field')
+                def vfield(self):
+                    ...
+    """
+
+    depends = ('x', 'y', 'z', 'r_c', 'backend')
+
+    def __init__(self, *depends, parameters=True):
+        self.depends = cached_field.depends + depends
+        self.parameters = parameters
+        self.fset = None
+
+    def __call__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+        return self
+
+    def setter(self, func):
+        """ Validate assigned values with func(self, value) """
+        self.fset = func
+        return self
+
+    def state(self, obj):
+        """ Current values of the attributes the field depends on """
+        depends = self.depends
+        if self.parameters:
+            depends += tuple(getattr(obj, 'parameters', {}))
+
+        return [getattr(obj, d, None) for d in depends]
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+
+        cache = obj.__dict__.setdefault('_cache', {})
+        state = self.state(obj)
+
+        if self.name in cache:
+            value, cached = cache[self.name]
+            if cached is None or all(a is b or (np.isscalar(a) and a == b) 
+                    for a, b in zip(state, cached)):
+                return value
+
+        value = self.func(obj)
+        cache[self.name] = (value, state)
+
+        return value
+
+    def __set__(self, obj, value):
+        if self.fset is not None:
+            self.fset(obj, value)
+
+        # Assigned values do not depend on other attributes
+        obj.__dict__.setdefault('_cache', {})[self.name] = (value, None)
+
+
+# Models available by name, e.g., for --model
+registry = {}
+
+def register(name):
+    """ Class decorator adding a model to the registry under name """
+    def decorator(cls):
+        cls.name = name
+        registry[name] = cls
+        return cls
+
+    return decorator
+
+
 class BaseModel(ABC):
     """ 
         This is an Astract Base class for the rest of the models below.
         All following objects should inherit from BaseModel, to ensure 
         self.dens, self.temp and self.vfield are set.
+
+        Coordinates can be sparse (i.e., np.meshgrid(..., sparse=True)) 
+        and are broadcast only when needed, so only the returned fields 
+        and a few temporaries take the full grid size (self.shape).
+
+        Models written as string expressions using self.evaluate() can be 
+        evaluated either with numpy or, to avoid the temporaries, with 
+        numexpr, as given by self.backend.
+
+        Fields are defined using @cached_field instead of @property, so 
+        they are evaluated once and only evaluated again when the 
+        coordinates, r_c, backend, parameters or any other declared 
+        dependency changes. 
+
+        Models declare their free parameters, in cgs, with their default
+        values in the class dictionary parameters. They become attributes 
+        of the model and can be changed at creation, e.g., 
+        PowerLaw(x, y, z, slope=1.5), or later on, with set_params(). 
+        Models are registered by name with @register(name), and their 
+        default half-box size (in cm) is given by bbox.
     """
 
-    def __init__(self, x, y, z, field='z'):
+    name = None
+    parameters = {}
+    bbox = 100 * u.au.to(u.cm)
+
+    def __init__(self, x, y, z, field='z', **params):
         self.x = x
         self.y = y
         self.z = z
+        self.shape = np.broadcast(x, y, z).shape
         self.plotmin = None
         self.plotmax = None
-        self.vfield = VectorField(x, y, z, morphology=field)
+        self.field = field
         self.r_c = x.max()
+        self.backend = 'numpy'
+        self.set_params(**self.parameters)
+        self.set_params(**params)
+
+    @property
+    def params(self):
+        """ Current values of the declared parameters """
+        return {p: getattr(self, p) for p in self.parameters}
+
+    def set_params(self, **params):
+        """ Set the value of any of the declared parameters """
+        unknown = [p for p in params if p not in self.parameters]
+        if len(unknown) > 0:
+            raise ValueError(f'Unknown parameters {unknown} for model ' +\
+                f'{self.name}. Available parameters are: ' +\
+                f'{list(self.parameters)}')
+
+        for name, value in params.items():
+            setattr(self, name, value)
+
+    def evaluate(self, expr, definitions=(), **constants):
+        """ 
+            Evaluate expr over the coordinates x, y, z, the scale radius r_c,
+            the model parameters and any other given constants, using 
+            self.backend. Definitions depending only on the coordinates are 
+            cached in self.geometry. See models.evaluate().
+        """
+
+        variables = dict(x=self.x, y=self.y, z=self.z, r_c=self.r_c)
+        variables.update(self.params)
+        variables.update(constants)
+
+        return evaluate(expr, variables, definitions, self.backend, 
+            self.geometry)
+
+    def sweep(self, sets, field='dens'):
+        """ 
+            Evaluate a field for every set of parameter values in sets, a 
+            sequence of dictionaries, yielding one array per set. 
+            Definitions depending only on the coordinates (e.g., radii) are 
+            evaluated for the first set and reused by the rest. 
+            Parameters are restored to their previous values at the end.
+        """
+
+        params = self.params
+        try:
+            for values in sets:
+                self.set_params(**values)
+                yield getattr(self, field)
+        finally:
+            self.set_params(**params)
+
+    def invalidate(self, *names):
+        """ Remove the given cached fields (all by default) to free memory """
+        cache = self.__dict__.get('_cache', {})
+        for name in names or list(cache):
+            cache.pop(name, None)
+
+    @cached_field(parameters=False)
+    def geometry(self):
+        """ Cache of the definitions that only depend on the coordinates """
+        return {}
 
     @property
     @abstractmethod
     def dens(self):
         pass
 
-    @property
+    @cached_field()
     def temp(self):
-        return self._temp
+        utils.not_implemented(f'Temperature of model {type(self).__name__}')
 
     @temp.setter
     def temp(self, temp):
@@ -42,171 +328,171 @@ class BaseModel(ABC):
             raise ValueError(
                 f'temp must be a numpy array, not a {type(temp)}.')
 
-        if temp.shape != dens.shape:
-            raise ValueError(f'Array shape of temp must be equal to dens.' +\
-                f'{temp.shape = }   {self._dens.shape = }')
-
-        self._temp = temp
+        if temp.shape != self.shape:
+            raise ValueError(f'Array shape of temp must be equal to dens. ' +\
+                f'{temp.shape = }   {self.shape = }')
 
-    @property
+    @cached_field('field', parameters=False)
     def vfield(self):
-        return self._vfield
+        return VectorField(self.x, self.y, self.z, morphology=self.field)
         
     @vfield.setter
     def vfield(self, vfield):
-        self._vfield = vfield
         if type(vfield) != VectorField:
             raise ValueError(
                 f'vfield must be a VectorField object, not a {type(vfield)}.')
     
 
+@register('constant')
 class Constant(BaseModel):
     """ Box with a constant density """
 
-    def __init__(self, x, y, z, field):
-        super().__init__(x, y, z, field)
+    parameters = dict(rho_0=1e-12, T_0=15.)
+    bbox = 1 * u.au.to(u.cm)
 
-    @property
+    @cached_field()
     def dens(self):
-        return 1e-12 * np.ones(self.x.shape)
+        return np.full(self.shape, self.rho_0)
 
-    @property
+    @cached_field()
     def temp(self):
-        return 15 * np.ones(self.dens.shape)
+        return np.full(self.shape, self.T_0)
 
+@register('plaw')
 class PowerLaw(BaseModel):
     """ Radial Power Law density distribution """
 
-    def __init__(self, x, y, z, field):
-        super().__init__(x, y, z, field)
+    # Temperature of a massive star with Teff = 35000 K
+    parameters = dict(rho_c=9e-18, slope=2, Teff=35000, Rstar=2.3e13)
+    bbox = 8500 * u.au.to(u.cm)
 
-    @property
+    @cached_field()
     def dens(self):
-        x = self.x
-        y = self.y
-        z = self.z
-        slope = 2
-        rho_c = 9e-18
-        self.r = np.sqrt(x**2 + y**2 + z**2)
         self.plotmin = 1e-19
-        return rho_c * (self.r / self.r_c)**(-slope)
+        return self.evaluate('rho_c * (r / r_c)**(-slope)', 
+            [('r', 'sqrt(x**2 + y**2 + z**2)')])
 
-    @property
+    @cached_field()
     def temp(self):
-        # Radial temperature profile for a massive star with Teff = 35000 K
-        return 35000 * 0.5**-0.25 * np.sqrt(0.5 * 2.3e13 / self.r)
+        # Radial temperature profile of the central star
+        return self.evaluate('Teff * 0.5**-0.25 * sqrt(0.5 * Rstar / r)', 
+            [('r', 'sqrt(x**2 + y**2 + z**2)')])
 
+@register('pcore')
 class PrestellarCore(BaseModel):
     """ Prestellar Core: Bonnort-Eber sphere """
-    def __init__(self, x, y, z, field):
-        super().__init__(x, y, z, field)
 
-    @property
+    parameters = dict(rho_c=1.07e-15, T_0=15.)
+    bbox = 0.1 * u.pc.to(u.cm)
+
+    @cached_field()
     def dens(self):
-        x = self.x
-        y = self.y
-        z = self.z
-        rho_c = 1.07e-15
-        r = np.sqrt(x**2 + y**2 + z**2)
-        return rho_c * self.r_c**2 / (r**2 + self.r_c**2)
+        return self.evaluate('rho_c * r_c**2 / (r**2 + r_c**2)', 
+            [('r', 'sqrt(x**2 + y**2 + z**2)')])
 
-    @property
+    @cached_field()
     def temp(self):
-        return 15 * np.ones(self.dens.shape)
+        return np.full(self.shape, self.T_0)
         
+@register('l1544')
 class L1544(BaseModel):
     """ L1544 Prestellar Core (Chacon-Tanarro et al. 2019) """
-    def __init__(self, x, y, z, field):
-        super().__init__(x, y, z, field)
 
-    @property
+    parameters = dict(rho_0=1.6e6 * m_H2, alpha=2.6, 
+        r_flat=2336 * u.au.to(u.cm), T_0=15.)
+    bbox = 5000 * u.au.to(u.cm)
+
+    @cached_field()
     def dens(self):
-        x = self.x
-        y = self.y
-        z = self.z
-        rho_0 = 1.6e6 * m_H2
-        alpha = 2.6
-        r_flat = 2336 * u.au.to(u.cm)
-        r = np.sqrt(x**2 + y**2 + z**2)
-        return rho_0 / (1 + (r / r_flat)**alpha)
+        return self.evaluate('rho_0 / (1 + (r / r_flat)**alpha)', 
+            [('r', 'sqrt(x**2 + y**2 + z**2)')])
 
-    @property
+    @cached_field()
     def temp(self):
-        return 15 * np.ones(self.dens.shape)
+        return np.full(self.shape, self.T_0)
 
+@register('ppdisk')
 class PPdisk(BaseModel):
     """ Protoplanetary disk with a gap and soft inner rim """
 
-    def __init__(self, x, y, z, field):
-        super().__init__(x, y, z, field)
-
-    @property
-    def dens(self):
+    parameters = dict(
         # Protoplanetary disk model 
-        x = self.x
-        y = self.y
-        z = self.z
-        rin = 1 * u.au.to(u.cm)
-        h_0 = 0.1 
-        rho_slope = 0.9
-        flaring = 0.0
-        Mdisk = 5e-3 * u.Msun.to(u.g)
-        Mstar = 1 * u.Msun.to(u.g)
-        rho_bg = 1e-30
-        self.plotmin = rho_bg
-        T_0 = 30
-        T_slope = 3 / 7
-
+        rin=1 * u.au.to(u.cm), 
+        h_0=0.1, 
+        rho_slope=0.9, 
+        flaring=0.0, 
+        Mdisk=5e-3 * u.Msun.to(u.g), 
+        Mstar=1 * u.Msun.to(u.g), 
+        rho_bg=1e-30, 
+        T_0=30, 
+        T_slope=3 / 7,
         # Inner rim and gap parameters
-        rim_rout = 0
-        srim_rout = 0.8
-        rim_slope = 0
-        sigma_gap = 5 * u.au.to(u.cm)
-        rin_gap = 10 * u.au.to(u.cm)
-        rout_gap = 50 * u.au.to(u.cm)
-        gap_c = 100 * u.au.to(u.cm)
-        gap_stddev = 5 * u.au.to(u.cm)
-        densredu_gap = 1e-7
+        rim_rout=0, 
+        srim_rout=0.8, 
+        rim_slope=0, 
+        sigma_gap=5 * u.au.to(u.cm), 
+        gap_c=100 * u.au.to(u.cm), 
+        densredu_gap=1e-7, 
+    )
+    bbox = 300 * u.au.to(u.cm)
+
+    # Radial temperature profile, shared by dens and temp
+    temperature = [
+        ('r3d', 'sqrt(x**2 + y**2 + z**2)'), 
+        ('T_r', 'T_0 * (r3d/r_c)**-T_slope'),
+    ]
+
+    @cached_field()
+    def dens(self):
+        self.plotmin = self.rho_bg
 
         # Surface density
-        r = np.sqrt(x**2 + y**2)
-        r3d = np.sqrt(x**2 + y**2 + z**2)
-        self.T_r = T_0 * (r3d/self.r_c)**-T_slope
-        c_s = np.sqrt(kB * self.T_r / m_H2)
-        v_K = np.sqrt(G * Mstar / r**3)
-        h = c_s / v_K * (r/self.r_c)**flaring
-        sigma_0 = (2 - rho_slope) * (Mdisk / 2 / np.pi / self.r_c**2)
-        sigma_g = sigma_0 * (r/self.r_c)**-rho_slope * \
-            np.exp(-(r/self.r_c)**(2-rho_slope))
+        sigma_0 = (2 - self.rho_slope) * \
+            (self.Mdisk / 2 / np.pi / self.r_c**2)
+        constants = dict(kB=kB, m_H2=m_H2, G=G, pi=np.pi, sigma_0=sigma_0)
+        definitions = [('r', 'sqrt(x**2 + y**2)')] + self.temperature + [
+            ('c_s', 'sqrt(kB * T_r / m_H2)'),
+            ('v_K', 'sqrt(G * Mstar / r**3)'),
+            ('h', 'c_s / v_K * (r/r_c)**flaring'),
+            ('sigma_g', 'sigma_0 * (r/r_c)**-rho_slope * ' +\
+                'exp(-(r/r_c)**(2-rho_slope))'),
+        ]
 
         # Add a smooth inner rim
-        if rim_rout > 0:
-            h_rin = np.sqrt(kB * T_0 * (rin/self.r_c)**-T_slope / m_H2) / \
-                np.sqrt(G * Mstar / rin**3)
-            a = h_0 * (r/self.r_c)**rho_slope
-            b = h_0 * (rim_rout * rin / h_0)**rho_slope
-            c = h_rin * (r/rin)**(np.log10(b / h_rin) / np.log10(rim_rout))
-            h = (a**8 + c**8)**(1/8) * r
-            sigma_rim = sigma_0 * (srim_rout*rin/rout)**-rho_slope * \
-                np.exp(-(r/rout)**(2-rho_slope)) * \
-                (r/srim_rout/rin)**rim_slope
-            sigma_g = (sigma_g**-5 + sigma_rim**-5)**(1/-5)
+        if self.rim_rout > 0:
+            rin = self.rin
+            h_rin = np.sqrt(kB * self.T_0 * (rin/self.r_c)**-self.T_slope / 
+                m_H2) / np.sqrt(G * self.Mstar / rin**3)
+            b = self.h_0 * (self.rim_rout * rin / self.h_0)**self.rho_slope
+            constants.update(h_rin=h_rin, b=b)
+            definitions += [
+                ('a', 'h_0 * (r/r_c)**rho_slope'),
+                ('c', 'h_rin * (r/rin)**(log10(b / h_rin) / log10(rim_rout))'),
+                ('h', '(a**8 + c**8)**(1/8) * r'),
+                ('sigma_rim', 'sigma_0 * (srim_rout*rin/r_c)**-rho_slope * '+\
+                    'exp(-(r/r_c)**(2-rho_slope)) * ' +\
+                    '(r/srim_rout/rin)**rim_slope'),
+                ('sigma_g', '(sigma_g**-5 + sigma_rim**-5)**(1/-5)'),
+            ]
         
         # Add a gap (as a radial gaussian density decrease)
-        gap = np.exp(-0.5 * (r-gap_c)**2 / sigma_gap**2) * (1/densredu_gap-1)
-        sigma_g /= (gap + 1)
+        definitions += [
+            ('gap', 'exp(-0.5 * (r-gap_c)**2 / sigma_gap**2) * ' +\
+                '(1/densredu_gap-1)'),
+            ('sigma_g', 'sigma_g / (gap + 1)'),
+        ]
 
         # Density profile from hydrostatic equilibrium
-        rho_g = sigma_g / np.sqrt(2*np.pi) / h * np.exp(-z*z / (2*h*h))
-        rho_g = rho_g + rho_bg
+        return self.evaluate(
+            'sigma_g / sqrt(2*pi) / h * exp(-z*z / (2*h*h)) + rho_bg', 
+            definitions, **constants)
 
-        return rho_g
-
-    @property
+    @cached_field()
     def temp(self):
         # Radial temperature profile
-        return self.T_r
+        return self.evaluate('T_r', self.temperature)
 
+@register('gidisk')
 class GIdisk(BaseModel):
     """
      Viscous gravitationally unstable accretion disk
@@ -217,25 +503,20 @@ class GIdisk(BaseModel):
      For a more recent model, follow the prescription from Yamamuro et al 2023.
     """
 
-    def __init__(self, x, y, z, field):
-        super().__init__(x, y, z, field)
-
-    @property
+    @cached_field()
     def dens(self):
         utils.not_implemented(f'Model: GIdisk')
         pass
 
-    @property
+    @cached_field()
     def temp(self):
         pass
 
+@register('spiral-disk')
 class SpiralDisk(BaseModel):
     """ PP Disk with logarithmic spiral arms (Huang et al. 2018b,c) """
 
-    def __init__(self, x, y, z, field):
-        super().__init__(x, y, z, field)
-
-    @property
+    @cached_field()
     def dens(self):
         utils.not_implemented(f'Model: SpiralDisk')
         x = self.x
@@ -244,31 +525,27 @@ class SpiralDisk(BaseModel):
         theta = np.tan(0.23)
         r_theta = self.r_c * np.exp(b*theta)
 
-    @property
+    @cached_field()
     def temp(self):
         pass
 
+@register('filament')
 class Filament(BaseModel):
     """
      Gas filament, modelled as a Plummer distribution (Arzoumanian+ 2011)
      Or from Koertgen+2018 and Tasker and Tan 2009
     """
 
-    def __init__(self, x, y, z, field):
-        super().__init__(x, y, z, field)
+    parameters = dict(p=2, r_flat=0.03 * u.pc.to(u.cm), rho_ridge=4e-19, 
+        T_0=15.)
+    bbox = 1 * u.pc.to(u.cm)
 
-    @property
+    @cached_field()
     def dens(self):
         utils.not_implemented(f'Model: Filament')
-        x = self.x
-        y = self.y
-        z = self.z
-        p = 2
-        r_flat = 0.03 * u.pc.to(u.cm) 
-        r = np.sqrt(x**2 + y**2)
-        rho_ridge = 4e-19
-        return rho_ridge / (1 + (r/r_flat)**2)**(p/2)
+        return self.evaluate('rho_ridge / (1 + (r/r_flat)**2)**(p/2)', 
+            [('r', 'sqrt(x**2 + y**2)')])
 
-    @property
+    @cached_field()
     def temp(self):
-        return 15 * np.ones(self.temp.shape)
+        return np.full(self.shape, self.T_0)
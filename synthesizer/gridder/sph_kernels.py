@@ -0,0 +1,167 @@
+"""
+    SPH kernel deposition of particles onto a regular cartesian grid.
+
+    Every particle scatters its mass over the cells that lie within its
+    kernel support (2h). The kernel weights are normalized per particle,
+    so the total mass is conserved exactly, no matter how the smoothing
+    length compares to the cell size. Particles smaller than a cell deposit
+    all their mass into the cell that contains them.
+
+    Particles are grouped by the size of their stencil (in cells) and
+    evaluated in chunks, so that memory usage is bounded by the chunk size
+    and not by the number of particles.
+"""
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+
+def cubic_spline(q):
+    """ M4 cubic spline kernel (Monaghan & Lattanzio 1985), support q < 2 """
+    t = np.clip(2 - q, 0, None)
+    s = np.clip(1 - q, 0, None)
+    return (0.25 * t * t * t - s * s * s) / np.pi
+
+def wendland_c2(q):
+    """ Wendland C2 kernel in 3D (Dehnen & Aly 2012), support q < 2 """
+    t = np.clip(1 - q / 2, 0, None)
+    t *= t
+    return t * t * (2 * q + 1) * (21 / 16 / np.pi)
+
+kernels = {'cubic': cubic_spline, 'wendland': wendland_c2}
+
+
+def _deposit_chunk(x, y, z, mass, hsml, values, nk, origin, dx, ncells,
+        kernel, zrange):
+    """
+        Deposit a chunk of particles sharing the same stencil half-width nk.
+        Returns the first flat index covered by the chunk and the deposited
+        mass and mass-weighted values over the covered range of cells.
+    """
+
+    k0, k1 = zrange
+    nz = k1 - k0
+
+    # Cell indices of the (2nk+1)^3 stencil around the closest cell center.
+    # Distances are separable, so they are computed per axis and broadcast.
+    o = np.arange(-nk, nk + 1)
+    axes = []
+    for coord in [x, y, z]:
+        i = np.rint((coord - origin) / dx).astype(np.int64)[:, None] + o
+        axes.append((i, ((origin + i * dx - coord[:, None]) / hsml[:, None])**2))
+
+    (ix, qx), (iy, qy), (iz, qz) = axes
+    q = np.sqrt(qx[:, :, None, None] + qy[:, None, :, None] + 
+        qz[:, None, None, :])
+    w = kernels[kernel](q).reshape(x.size, -1)
+
+    # Particles smaller than a cell are deposited in their closest cell
+    center = w.shape[1] // 2
+    norm = w.sum(axis=1)
+    ngp = norm == 0
+    w[ngp, center] = 1
+    norm[ngp] = 1
+
+    # Normalize over the full stencil to conserve the total mass. 
+    # Mass falling outside of the grid is discarded.
+    inside = lambda i, lo=0, hi=ncells: (i >= lo) & (i < hi)
+    inside = (inside(ix)[:, :, None, None] & inside(iy)[:, None, :, None] & 
+        inside(iz, k0, k1)[:, None, None, :]).reshape(w.shape)
+    frac = w * (mass / norm)[:, None]
+    valid = inside & (frac > 0)
+
+    flat = (ix[:, :, None, None] * ncells + iy[:, None, :, None]) * nz + \
+        (iz - k0)[:, None, None, :]
+    flat = flat.reshape(w.shape)[valid]
+    frac = frac[valid]
+
+    if flat.size == 0:
+        return 0, [np.zeros(0)] * (len(values) + 1)
+
+    fmin = flat.min()
+    flat -= fmin
+    size = flat.max() + 1
+
+    sums = [np.bincount(flat, weights=frac, minlength=size)]
+    for v in values:
+        vals = np.broadcast_to(v[:, None], w.shape)[valid]
+        sums.append(np.bincount(flat, weights=frac * vals, minlength=size))
+
+    return fmin, sums
+
+
+def deposit(x, y, z, mass, hsml, ncells, origin, dx, values=(),
+        kernel='cubic', chunksize=2**22, nproc=1, zrange=None):
+    """
+        Deposit particles onto a cubic grid of ncells^3 cells whose centers
+        are located at origin + i * dx along every axis.
+
+        Arguments:
+          - x, y, z, mass, hsml: particle positions, masses and smoothing
+            lengths, all in cgs
+          - values: list of per-particle quantities to be mass-weighted
+          - kernel: 'cubic' or 'wendland'
+          - chunksize: maximum number of particle-cell pairs per chunk
+          - nproc: number of processes used to evaluate the chunks
+          - zrange: (k0, k1) to compute only the z-slab of cells [k0, k1). 
+            Particles keep their normalization over the full stencil, so 
+            adding up the slabs gives the same result as the full grid.
+
+        Returns:
+          - mass: deposited mass per cell, shape (ncells, ncells, nz), 
+                  where nz = k1 - k0 (ncells by default)
+          - means: list of mass-weighted averages of every quantity in
+                   values, zero where no mass was deposited.
+
+        Arrays are indexed as [ix, iy, iz].
+    """
+
+    if kernel not in kernels:
+        raise ValueError(f'kernel must be one of {list(kernels)}.')
+
+    zrange = (0, ncells) if zrange is None else zrange
+    shape = (ncells, ncells, zrange[1] - zrange[0])
+
+    # Half-width of the stencil in cells. Limit it to bound the chunk memory.
+    nkmax = max(int((chunksize**(1/3) - 1) // 2), 1)
+    nk = np.clip(np.ceil(2 * hsml / dx), 0, min(ncells, nkmax)).astype(int)
+
+    # Sort by stencil size and then by cell, to keep chunks spatially compact
+    cell = np.rint((x - origin) / dx).astype(np.int64)
+    order = np.lexsort((cell, nk))
+
+    tasks = []
+    for n in np.unique(nk):
+        idx = order[np.searchsorted(nk[order], n, 'left'):
+            np.searchsorted(nk[order], n, 'right')]
+        step = max(chunksize // (2 * n + 1)**3, 1)
+
+        for i in range(0, idx.size, step):
+            c = idx[i: i + step]
+            tasks.append((x[c], y[c], z[c], mass[c], hsml[c],
+                [v[c] for v in values], n, origin, dx, ncells, kernel, zrange))
+
+    # No particles within the box deposit nothing
+    if len(tasks) == 0:
+        return np.zeros(shape), [np.zeros(shape) for v in values]
+
+    grids = np.zeros((len(values) + 1, np.prod(shape)))
+
+    def accumulate(result):
+        fmin, sums = result
+        for g, s in zip(grids, sums):
+            g[fmin: fmin + s.size] += s
+
+    if nproc > 1:
+        with ProcessPoolExecutor(max_workers=nproc) as pool:
+            for result in pool.map(_deposit_chunk, *zip(*tasks)):
+                accumulate(result)
+    else:
+        for task in tasks:
+            accumulate(_deposit_chunk(*task))
+
+    mass = grids[0].reshape(shape)
+    means = [np.divide(g.reshape(mass.shape), mass,
+        out=np.zeros(mass.shape), where=mass > 0) for g in grids[1:]]
+
+    return mass, means
@@ -35,13 +35,18 @@ class SPHCode(ABC):
 
 class SPHng(SPHCode):
     """ Handle binary snapshots from the SPHng code. """
+
+    # Values assigned to the outlier sink particle, by column
+    sink_id = 31330
+    sink = {5: 0, 6: 0, 7: 0, 8: 'min', 9: 'min', 10: 3e-11, 11: 900}
+
     def __init__(self, filename, temp=False, remove_sink=True):
         """
             Notes:
 
             This reader assumes your file is binary and formatted 
             with a header stating the quantities, assumed to be 
-            f4 floats. May not be widely applicable.
+            f8 floats. May not be widely applicable.
 
             Header is: id t x y z vx vy vz mass hsml rho T u, where
 
@@ -56,61 +61,231 @@ class SPHng(SPHCode):
             u = particle internal energy [ignore]
             
             There's an outlier (probably a sink particle) with index = 31330
+
+            The file is memory-mapped using a structured dtype built from 
+            the header. Columns are only read from disk, converted to f4 
+            in CGS, when accessed for the first time, and then cached.
         """
         
         self.add_temp = temp
+        self.remove_sink = remove_sink
+        self._cache = {}
 
-        # Read file in binary format
+        # Map the binary file, right after the header line
         try:
             with open(filename, "rb") as f:
-                names = f.readline()[1:].split()
-                self.data = np.frombuffer(f.read()).reshape(-1, len(names))
-                self.data = self.data.astype("f4")
+                header = f.readline()
+            self.names = [n.decode() for n in header[1:].split()]
+            dtype = np.dtype([(n, '<f8') for n in self.names])
+            self.data = np.memmap(
+                filename, dtype=dtype, mode='r', offset=len(header))
         except ValueError as e:
             utils.print_('Error trying to read SPHng binary file.', red=True)
             utils.print_(
                 'File is probably from another code. Set --source', bold=True)
             raise 
 
-        # Turn data into CGS 
-        self.data[:, 2:5] *= u.au.to(u.cm)
-        self.data[:, 8] *= u.M_sun.to(u.g)
-
-        # Remove the cell data of the outlier, probably a sink particle
-        if remove_sink:
-            sink_id = 31330
-            self.data[sink_id, 5] = 0
-            self.data[sink_id, 6] = 0
-            self.data[sink_id, 7] = 0
-            self.data[sink_id, 8] = self.data[:,8].min()
-            self.data[sink_id, 9] = self.data[:,9].min()
-            self.data[sink_id, 10] = 3e-11 
-            self.data[sink_id, 11] = 900
-        
-        self.x = self.data[:, 2]
-        self.y = self.data[:, 3]
-        self.z = self.data[:, 4]
+    def column(self, i, factor=1):
+        """ Read the i-th column, in units given by factor """
+
+        if i not in self._cache:
+            col = np.array(self.data[self.names[i]], dtype='f4')
+
+            # Remove the cell data of the outlier, probably a sink particle
+            if self.remove_sink and i in self.sink and self.sink_id < col.size:
+                value = self.sink[i]
+                col[self.sink_id] = col.min() if value == 'min' else value
+
+            col *= factor
+            self._cache[i] = col
+
+        return self._cache[i]
+
+    @property
+    def x(self):
+        return self.column(2, u.au.to(u.cm))
+
+    @property
+    def y(self):
+        return self.column(3, u.au.to(u.cm))
+
+    @property
+    def z(self):
+        return self.column(4, u.au.to(u.cm))
+
+    @property
+    def vx(self):
+        return self.column(5)
+
+    @property
+    def vy(self):
+        return self.column(6)
+
+    @property
+    def vz(self):
+        return self.column(7)
+
+    @property
+    def mass(self):
+        return self.column(8, u.M_sun.to(u.g))
+
+    @property
+    def hsml(self):
+        return self.column(9, u.au.to(u.cm))
 
     @property
     def rho_g(self):
-        return self.data[:, 10]
+        return self.column(10)
 
     @property
     def temp(self):
         if self.add_temp:
-            return self.data[:, 11]
+            return self.column(11)
+
+
+def _read_hdf5(filename, group, name, start, stop, mask=None):
+    """ Read the rows [start, stop) of a dataset and keep those in mask """
+    with h5py.File(filename, 'r') as f:
+        data = f[group][name][start: stop]
+
+    return data if mask is None else data[mask]
+
+class HDF5Snapshot(SPHCode):
+    """ 
+        Base class for HDF5 snapshots, like those from Gizmo, Gadget and Arepo.
+
+        Datasets are read lazily, only once and then cached. After select() 
+        is called with a mask of particles (e.g., from trimming the box), 
+        cached fields are masked and new ones are read only for the selected 
+        particles, using a single hyperslab that spans them.
+
+        Snapshots split into multiple files (snap_000.0.hdf5 ... 
+        snap_000.N.hdf5) are read and concatenated, in parallel using nproc 
+        processes, since h5py serializes reads within a process.
+
+        Subclasses set the code units of length and mass in cgs, which are 
+        used for the optional masses and smoothing lengths.
+    """
+    group = 'PartType0'
+    unit_length = 1
+    unit_mass = 1
+
+    def __init__(self, filename, temp=False, nproc=1):
+
+        self.add_temp = temp
+        self.nproc = nproc
+        self.files = self.find_files(filename)
+        self.mask = None
+        self._cache = {}
+
+        # Number of particles and dataset names per file
+        self.counts = []
+        for file in self.files:
+            with h5py.File(file, 'r') as f:
+                self.keys = list(f[self.group].keys())
+                self.counts.append(len(f[self.group][self.keys[0]]))
+
+        self.offsets = np.cumsum([0] + self.counts)
+
+    @staticmethod
+    def find_files(filename):
+        """ Find all the files of a multi-file snapshot, sorted by number """
+        import re, glob
+
+        match = re.match(r'(.*)\.(\d+)\.(hdf5|h5)$', str(filename))
+        if match is None:
+            return [filename]
+
+        stem, _, ext = match.groups()
+        files = [f for f in glob.glob(f'{stem}.*.{ext}') 
+            if re.match(rf'{re.escape(stem)}\.\d+\.{ext}$', f)]
 
+        return sorted(files, key=lambda f: int(f.split('.')[-2]))
 
-class Gizmo(SPHCode):
+    def __contains__(self, name):
+        return name in self.keys
+
+    @property
+    def mass(self):
+        if 'Masses' in self:
+            return self.read('Masses', self.unit_mass)
+
+    @property
+    def hsml(self):
+        if 'SmoothingLength' in self:
+            return self.read('SmoothingLength', self.unit_length)
+
+    def read(self, name, factor=1):
+        """ 
+            Read a dataset from all files, scaled by factor, or return it 
+            from the cache if it was already read.
+        """
+
+        if name in self._cache:
+            return self._cache[name]
+
+        tasks = []
+        for file, start, stop in zip(
+                self.files, self.offsets[:-1], self.offsets[1:]):
+            mask = None if self.mask is None else self.mask[start: stop]
+
+            # Read only the hyperslab spanning the selected particles
+            if mask is not None:
+                idx = np.flatnonzero(mask)
+                if idx.size == 0:
+                    continue
+                mask = mask[idx[0]: idx[-1] + 1]
+                start, stop = idx[0], idx[-1] + 1
+            else:
+                start, stop = 0, stop - start
+
+            tasks.append((file, self.group, name, start, stop, mask))
+
+        if self.nproc > 1 and len(tasks) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=self.nproc) as pool:
+                data = list(pool.map(_read_hdf5, *zip(*tasks)))
+        else:
+            data = [_read_hdf5(*task) for task in tasks]
+
+        data = np.concatenate(data) if len(data) > 0 else np.zeros(0)
+        self._cache[name] = data * factor if factor != 1 else data
+
+        return self._cache[name]
+
+    def select(self, mask):
+        """ 
+            Keep only the particles in mask, given relative to the currently 
+            selected particles. Following reads only load these particles.
+        """
+
+        if self.mask is None:
+            self.mask = mask.copy()
+        else:
+            self.mask[self.mask] = mask
+
+        for name, data in self._cache.items():
+            self._cache[name] = data[mask]
+
+        # Mask the coordinates, without triggering reads of lazy fields
+        for attr in ['x', 'y', 'z']:
+            value = vars(self).get(attr)
+            if isinstance(value, np.ndarray) and value.size == mask.size:
+                setattr(self, attr, value[mask])
+
+class Gizmo(HDF5Snapshot):
     """ Handle HDF5 snapshots from the GIZMO code. """
-    def __init__(self, filename):
+    unit_length = u.pc.to(u.cm)
+    unit_mass = 1.3816327e-23 * u.pc.to(u.cm)**3
+    def __init__(self, filename, temp=False, nproc=1):
 
-        # Read in particle coordinates and density
-        self.data = h5py.File(filename, 'r')['PartType0']
-        coords = np.array(self.data['Coordinates'])
-        self.x = coords[:, 0] * u.pc.to(u.cm)
-        self.y = coords[:, 1] * u.pc.to(u.cm)
-        self.z = coords[:, 2] * u.pc.to(u.cm)
+        super().__init__(filename, temp, nproc)
+
+        # Read in particle coordinates
+        coords = self.read('Coordinates')
+        self.x = coords[:, 0] * self.unit_length
+        self.y = coords[:, 1] * self.unit_length
+        self.z = coords[:, 2] * self.unit_length
 
         # Recenter the particles based on the center of mass
         self.x -= np.average(self.x, weights=self.rho_g)
@@ -119,36 +294,37 @@ class Gizmo(SPHCode):
 
     @property
     def rho_g(self):
-        return np.array(self.data['Density']) * 1.3816327e-23
+        return self.read('Density', 1.3816327e-23)
 
     @property
     def temp(self):
         # Read in temperature if available
-        if 'Temperature' in self.data:
-            return np.array(self.data['Temperature'])
+        if 'Temperature' in self:
+            return self.read('Temperature')
         # Or maybe the krome temperature, when coupled with KROME
-        elif 'KromeTemperature' in self.data:
-            return np.array(self.data['KromeTemperature'])
+        elif 'KromeTemperature' in self:
+            return self.read('KromeTemperature')
         
         # Or derive from a barotropic equation of state
-        elif 'InternalEnergy' in self.data.keys() and 'Pressure' in self.data.keys():
-            return self.data['InternalEnergy'] / np.array(self.data['Pressure'])
+        elif 'InternalEnergy' in self and 'Pressure' in self:
+            return self.read('InternalEnergy') / self.read('Pressure')
 
         else:
             return np.zeros(self.rho_g.shape)
 
-class Gadget(SPHCode):
+class Gadget(HDF5Snapshot):
     """ Handle snapshots from the Gadget code. """
-    def __init__(self, filename, temp=False):
+    unit_length = u.au.to(u.cm)
+    unit_mass = 1e-10 * u.Msun.to(u.g)
+    def __init__(self, filename, temp=False, nproc=1):
     
-        self.add_temp = temp
+        super().__init__(filename, temp, nproc)
 
-        # Read in particle coordinates and density
-        self.data = h5py.File(filename, 'r')['PartType0']
-        coords = np.array(self.data['Coordinates'])
-        self.x = coords[:, 0] * u.au.to(u.cm)
-        self.y = coords[:, 1] * u.au.to(u.cm)
-        self.z = coords[:, 2] * u.au.to(u.cm) 
+        # Read in particle coordinates
+        coords = self.read('Coordinates')
+        self.x = coords[:, 0] * self.unit_length
+        self.y = coords[:, 1] * self.unit_length
+        self.z = coords[:, 2] * self.unit_length
 
         # Recenter the particles based on the center of mass
         self.x -= np.average(self.x, weights=self.rho_g)
@@ -157,81 +333,87 @@ class Gadget(SPHCode):
     
     @property
     def rho_g(self):
-        dens = np.array(self.data['Density'])
-        return dens * 1e-10 * (u.Msun / u.au**3).to(u.g/u.cm**3)
+        return self.read(
+            'Density', 1e-10 * (u.Msun / u.au**3).to(u.g/u.cm**3))
 
     @property
     def temp(self):
         if self.add_temp:
             # Read in temperature if available
-            if 'Temperature' in self.data.keys():
-                return self.data['Temperature']
+            if 'Temperature' in self:
+                return self.read('Temperature')
 
             # Or derive from a barotropic equation of state
-            elif 'Pressure' in self.data.keys():
+            elif 'Pressure' in self:
                 kB = c.k_B.cgs.value
                 mu = 2.3 * (c.m_e + c.m_p).cgs.value
-                return (mu / kB) * np.array(self.data['Pressure']) / self.rho_g
+                return (mu / kB) * self.read('Pressure') / self.rho_g
 
             else:
                 return np.zeros(self.rho_g.shape)
 
-class Arepo(SPHCode):
+class Arepo(HDF5Snapshot):
     """ Handle snapshots from the AREPO code. """
-    def __init__(self, filename, temp=False):
+    unit_length = u.au.to(u.cm)
+    unit_mass = 1e-10 * u.Msun.to(u.g)
+    def __init__(self, filename, temp=False, nproc=1):
 
-        self.add_temp = temp
+        super().__init__(filename, temp, nproc)
 
-        # Read in particle coordinates and density
-        self.data = h5py.File(filename, 'r')['PartType0']
-        coords = np.array(self.data.get('Coordinates'))
-        mass = np.array(self.data.get('Masses'))
-        press = np.array(self.data.get('Pressure'))
-        energy = np.array(self.data.get('InternalEnergy'))
-        self.x = coords[:, 0] * u.au.to(u.cm)
-        self.y = coords[:, 1] * u.au.to(u.cm)
-        self.z = coords[:, 2] * u.au.to(u.cm)
-        self.mass = mass * 1e-10 * u.Msun.to(u.g) 
-        self.press = press * 1e-10 * (u.Msun/u.au/u.s**2).to(u.g/u.cm/u.s**2) 
-        self.u = energy * 1e-10 * (u.au**2*u.Msun/u.s**2).to(u.cm**2*u.g/u.s**2)
+        # Read in particle coordinates
+        coords = self.read('Coordinates')
+        self.x = coords[:, 0] * self.unit_length
+        self.y = coords[:, 1] * self.unit_length
+        self.z = coords[:, 2] * self.unit_length
 
         # Recenter the particles based on the center of mass
         self.x -= np.average(self.x, weights=self.mass)
         self.y -= np.average(self.y, weights=self.mass)
         self.z -= np.average(self.z, weights=self.mass)
 
+    @property
+    def press(self):
+        return self.read('Pressure', 
+            1e-10 * (u.Msun/u.au/u.s**2).to(u.g/u.cm/u.s**2))
+
+    @property
+    def u(self):
+        return self.read('InternalEnergy', 
+            1e-10 * (u.au**2*u.Msun/u.s**2).to(u.cm**2*u.g/u.s**2))
+
     @property
     def rho_g(self):
-        dens = np.array(self.data.get('Density'))
-        return dens * 1e-10 * (u.Msun/u.au**3).to(u.g/u.cm**3)
+        return self.read(
+            'Density', 1e-10 * (u.Msun/u.au**3).to(u.g/u.cm**3))
 
     @property
     def temp(self):
         if self.add_temp:
             # Read in temperature if available
-            if 'Temperature' in self.data.keys():
-                return self.data.get('Temperature')
+            if 'Temperature' in self:
+                return self.read('Temperature')
 
             # Derive from a barotropic EOS (Wurster et al. 2018, Eq.5)
-            elif 'Pressure' in self.data.keys():
+            elif 'Pressure' in self:
+                rho_g = self.rho_g
                 k_B = c.k_B.cgs.value
                 m_H = (c.m_e + c.m_p).cgs.value
-                rho_c = 1e-14 * np.ones(self.rho_g.shape)
-                rho_d = 1e-10 * np.ones(self.rho_g.shape)
-                T_iso = 14 * np.ones(self.rho_g.shape)
+                rho_c = 1e-14 * np.ones(rho_g.shape)
+                rho_d = 1e-10 * np.ones(rho_g.shape)
+                T_iso = 14 * np.ones(rho_g.shape)
                 cs_iso2 = k_B * T_iso / 2.33 / m_H
 
-                #T1 = np.where(self.rho_g >= rho_c, 
+                #T1 = np.where(rho_g >= rho_c, 
                 T1 = np.where(
-                    (rho_c <= self.rho_g) & (self.rho_g < rho_d), 
-                    T_iso * (self.rho_g / rho_c)**(7/5), 
+                    (rho_c <= rho_g) & (rho_g < rho_d), 
+                    T_iso * (rho_g / rho_c)**(7/5), 
                     T_iso
                 )
 
                 T2 = np.where(
-                    self.rho_g >= rho_d, 
-                    T_iso * (self.rho_g / rho_d)**(7/5) * \
-                            (self.rho_g / rho_d)**(11/10), 
+                    rho_g >= rho_d, 
+                    T_iso * (rho_g / rho_d)**(7/5) * \
+                            (rho_g / rho_d)**(11/10), 
                     T1
                 )
 
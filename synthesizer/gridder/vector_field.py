@@ -1,8 +1,31 @@
 import numpy as np
 
+def rows(vx, vy, vz, shape):
+    """
+        Iterate over arrays of (vx, vy, vz) rows, one per cell of a grid of 
+        the given shape in fortran-style order, as written to RADMC3D files 
+        (see utils.write_radmc3d_file). Components can be compact, i.e., 
+        broadcastable to shape, and are expanded one plane of the last axis
+        at a time, so the dense field is never held in memory at once.
+    """
+
+    vx, vy, vz = [np.broadcast_to(v, shape) for v in [vx, vy, vz]]
+    if vx.ndim < 2:
+        yield np.column_stack([vx, vy, vz])
+        return
+
+    for k in range(vx.shape[-1]):
+        yield np.column_stack(
+            [v[..., k].ravel(order='F') for v in [vx, vy, vz]])
+
 class VectorField():
 
-    def __init__(self, x, y, z, morphology, normalize=True, a_eff=1):
+    # Morphologies that do not depend on every coordinate, evaluated once 
+    # on the sparse coordinates and stored without expanding them
+    compact = ['x', 'y', 'z', 't', 'toroidal']
+
+    def __init__(self, x, y, z, morphology, normalize=True, a_eff=1, 
+            dtype=np.float64):
         """ Create an object containing 3D vector field for a given morphology. 
             The field can be optionally normalized and consider an alignment
             efficiency factor. Morphologies supported are:
@@ -15,14 +38,20 @@ class VectorField():
                 - Helicoidal: 'hel'
                 - Dipole: 'd'
                 - Quadrupole: 'q'
+
+            Coordinates can be sparse (i.e., np.meshgrid(..., sparse=True)).
+            Components are stored compactly, only over the coordinates they 
+            depend on (e.g., as constants for uniform fields), in 
+            self.components. vx, vy and vz give them over the full grid, as
+            read-only broadcast views, and rows() expands them for writing.
+            They are evaluated in double precision and stored as dtype.
         """
 
         self.x = x
         self.y = y 
         self.z = z 
-        self.vx = np.zeros((x.shape[0], y.shape[0], z.shape[0]))
-        self.vy = np.zeros((x.shape[0], y.shape[0], z.shape[0]))
-        self.vz = np.zeros((x.shape[0], y.shape[0], z.shape[0]))
+        self.shape = shape = np.broadcast(x, y, z).shape
+        self.components = [np.zeros((), dtype)] * 3
         if morphology is None:
             return morphology
         else:
@@ -31,13 +60,13 @@ class VectorField():
         self.a_eff = a_eff
  
         if self.morphology == 'x':
-            self.vx = np.ones(x.shape)
+            self.vx = np.ones(())
  
         elif self.morphology == 'y':
-            self.vy = np.ones(y.shape)
+            self.vy = np.ones(())
  
         elif self.morphology == 'z':
-            self.vz = np.ones(z.shape)
+            self.vz = np.ones(())
  
         elif self.morphology in ['t', 'toroidal']:
             r = np.sqrt(x**2 + y**2)
@@ -61,16 +90,16 @@ class VectorField():
         elif self.morphology in ['hel', 'helicoidal']:
             # Helicoidal = Superpoistion of Toroidal & Hourglass
             r = np.sqrt(x**2 + y**2)
-            toro = np.array([y/r, -x/r, np.zeros(z.shape)])
+            toro = np.array(np.broadcast_arrays(y/r, -x/r, np.zeros(shape)))
 
             a = 5e-34
             factor = np.sqrt(
                 1 + (a*x*z)**2*np.exp(-2*a*z*z) + (a*y*z)**2*np.exp(-2*a*z*z))
-            hour = np.array([
+            hour = np.array(np.broadcast_arrays(
                 a * x * z * np.exp(-a * z*z) / factor, 
                 a * y * z * np.exp(-a * z*z) / factor,
-                np.ones(z.shape)
-            ])
+                np.ones(shape)
+            ))
             heli = (toro + hour) / np.linalg.norm(toro + hour)
             self.vx = heli[0]
             self.vy = heli[1]
@@ -96,18 +125,65 @@ class VectorField():
         
 
 
-        # Normalize the field
+        components = [np.asarray(v) for v in self.components]
+
+        # Normalize the field, in place for full-size components
         if normalize:
-            self.r = np.sqrt(self.vx**2 + self.vy**2 + self.vz**2)
-            self.vx = np.squeeze(self.vx) / self.r
-            self.vy = np.squeeze(self.vy) / self.r
-            self.vz = np.squeeze(self.vz) / self.r
+            r = np.sqrt(sum(v**2 for v in components))
+            for i, v in enumerate(components):
+                if v.ndim > 0 and v.shape == r.shape and v.dtype == r.dtype \
+                        and v.flags.writeable:
+                    v /= r
+                else:
+                    components[i] = v / r
  
         # Assume perfect alignment (a_eff = 1). We can change it in the future
-        self.vx *= a_eff
-        self.vy *= a_eff
-        self.vz *= a_eff
+        if a_eff != 1:
+            components = [v * a_eff for v in components]
+
+        # Convert to the requested precision, keeping the compact shapes
+        self.components = [v.astype(dtype, copy=False) for v in components]
+
+    @property
+    def vx(self):
+        return np.broadcast_to(self.components[0], self.shape)
+
+    @vx.setter
+    def vx(self, vx):
+        self.components[0] = vx
+
+    @property
+    def vy(self):
+        return np.broadcast_to(self.components[1], self.shape)
+
+    @vy.setter
+    def vy(self, vy):
+        self.components[1] = vy
+
+    @property
+    def vz(self):
+        return np.broadcast_to(self.components[2], self.shape)
+
+    @vz.setter
+    def vz(self, vz):
+        self.components[2] = vz
+
+    @property
+    def ncells(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def rxy(self):
+        return np.sqrt(self.x**2 + self.y**2)
+
+    @property
+    def rxz(self):
+        return np.sqrt(self.x**2 + self.z**2)
+
+    @property
+    def ryz(self):
+        return np.sqrt(self.y**2 + self.z**2)
 
-        self.rxy = np.sqrt(self.x**2 + self.y**2)
-        self.rxz = np.sqrt(self.x**2 + self.z**2)
-        self.ryz = np.sqrt(self.y**2 + self.z**2)
+    def rows(self):
+        """ Iterate over the (vx, vy, vz) rows of every cell. See rows() """
+        return rows(*self.components, self.shape)
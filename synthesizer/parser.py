@@ -29,6 +29,24 @@ from synthesizer import utils
 from synthesizer.pipeline import Pipeline
 
 
+def model_parameter(string):
+    """ Parse a model parameter given as NAME=VALUE """
+    name, _, value = string.partition('=')
+    try:
+        return name, float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f'{string} must be of the form NAME=VALUE')
+
+def sweep_parameter(string):
+    """ Parse the values of a model parameter given as NAME=V1,V2,... """
+    name, _, values = string.partition('=')
+    try:
+        return name, [float(v) for v in values.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f'{string} must be of the form NAME=VALUE1,VALUE2,...')
+
 def synthesizer():
     
     # Initialize the argument parser
@@ -57,6 +75,11 @@ def synthesizer():
     parser.add_argument('--ncells', action='store', type=int, default=100,
         help='Number of cells in every direction')
 
+    parser.add_argument('--auto-ncells', action='store_true', default=False,
+        help='Choose the number of cells from the separation between SPH ' +\
+            'particles, using --ncells as the maximum. Not supported by ' +\
+            '--spherical nor --octree.')
+
     exc_trim = parser.add_mutually_exclusive_group() 
     exc_trim.add_argument('--bbox', action='store', type=float, default=None, 
         help='Size of the half-lenght of a bounding box in au.')
@@ -64,6 +87,91 @@ def synthesizer():
     exc_trim.add_argument('--rout', action='store', type=float, default=None, 
         help='Size of the outer radial boundary in au (i.e., zoom in)')
 
+    parser.add_argument('--interp', action='store', default='linear', 
+        choices=['linear', 'nearest', 'idw', 'sph'], 
+        help='Method used to interpolate SPH particles onto the grid. ' +\
+            'nearest and idw (inverse-distance weighting) use a KD-tree and ' +\
+            'are fast for quick-look grids. sph deposits the particle ' +\
+            'masses using their smoothing lengths.')
+
+    parser.add_argument('--neighbours', action='store', type=int, default=8, 
+        help='Number of neighbours averaged by --interp idw.')
+
+    parser.add_argument('--rmax-interp', action='store', type=float, 
+        default=None, 
+        help='Ignore particles farther than this distance (in au) from a ' +\
+            'cell when using --interp nearest or idw.')
+
+    parser.add_argument('--kernel', action='store', default='cubic', 
+        choices=['cubic', 'wendland'], 
+        help='Smoothing kernel used by --interp sph.')
+
+    parser.add_argument('--memory', action='store', type=float, default=None, 
+        help='Memory budget in GB. If given, SPH particles are gridded in ' +\
+            'slabs written to disk, to handle grids larger than RAM. ' +\
+            'Requires --interp nearest, idw or sph.')
+
+    parser.add_argument('--octree', action='store_true', default=False, 
+        help='Grid SPH particles onto an adaptive oct-tree, refined from a ' +\
+            'base grid of --ncells per side.')
+
+    parser.add_argument('--levelmax', action='store', type=int, default=6, 
+        help='Maximum number of refinement levels of --octree.')
+
+    parser.add_argument('--maxpart', action='store', type=int, default=8, 
+        help='Refine --octree cells containing more particles than this.')
+
+    parser.add_argument('--gradient', action='store', type=float, 
+        default=None, 
+        help='Also refine --octree cells whose particle densities span ' +\
+            'more than this number of orders of magnitude.')
+
+    parser.add_argument('--spherical', action='store_true', default=False, 
+        help='Use a spherical grid with --ncells logarithmically spaced ' +\
+            'radii, for models and SPH particles. The outer radius is ' +\
+            'given by --rout or --bbox.')
+
+    parser.add_argument('--rin', action='store', type=float, default=None, 
+        help='Inner radius in au of the --spherical grid ' +\
+            '(default: 1e-3 times the outer radius).')
+
+    parser.add_argument('--ntheta', action='store', type=int, default=64, 
+        help='Number of polar cells of the --spherical grid.')
+
+    parser.add_argument('--nphi', action='store', type=int, default=1, 
+        help='Number of azimuthal cells of the --spherical grid. ' +\
+            'Use 1 for axisymmetric models.')
+
+    parser.add_argument('--model-params', action='store', nargs='+', 
+        type=model_parameter, default=None, metavar='NAME=VALUE', 
+        help='Parameters of the analytical model (in cgs), overriding its ' +\
+            'defaults. See the parameters of every model in models.py.')
+
+    parser.add_argument('--sweep', action='store', nargs='+', 
+        type=sweep_parameter, default=None, metavar='NAME=V1,V2,...', 
+        help='Write the model grid for every combination of the given ' +\
+            'parameter values, into the directories sweep_000, sweep_001, ...')
+
+    parser.add_argument('--backend', action='store', default='numpy', 
+        choices=['numpy', 'numexpr'], 
+        help='Library used to evaluate analytical models. numexpr ' +\
+            'evaluates every model in a single multi-threaded pass.')
+
+    parser.add_argument('--precision', action='store', default='double', 
+        choices=['single', 'double'], 
+        help='Floating point precision of the grids. single halves the ' +\
+            'memory usage and writes 4-byte binary files.')
+
+    parser.add_argument('--no-cache', action='store_true', default=False, 
+        help='Do not reuse nor store interpolated SPH grids in ' +\
+            '.synthesizer_cache/, nor dust efficiencies per grain size in ' +\
+            '~/.cache/synthesizer/opacities/')
+
+    parser.add_argument('--cache-size', action='store', type=float, 
+        default=10, 
+        help='Maximum size in GB of the grid and opacity caches. Least ' +\
+            'recently used entries are removed beyond it.')
+
     parser.add_argument('--g2d', action='store', type=float, default=100, 
         help='Set the gas-to-dust mass ratio.')
 
@@ -75,6 +183,10 @@ def synthesizer():
     parser.add_argument('--temperature', action='store_true', default=False, 
         help='Write the dust temperature from the model.')
 
+    parser.add_argument('--binary', action='store_true', default=False, 
+        help='Write the density, temperature and alignment files in ' +\
+            "RADMC3D's binary format (.binp/.bdat) instead of ASCII.")
+
     parser.add_argument('--show-grid-2d', action='store_true', default=False,  
         help='Plot the midplane of the newly created grid')
 
@@ -100,7 +212,10 @@ def synthesizer():
         help='Maximum value for the grain size distribution')
 
     parser.add_argument('--na', action='store', type=int, default=100,
-        help='Number of size bins for the logarithmic grain size distribution')
+        help='Minimum number of size bins for the logarithmic grain size ' +\
+            'distribution. Sizes are taken from a fixed grid of a power of ' +\
+            'two bins per decade, shared by runs with different --amin or ' +\
+            '--amax.')
 
     parser.add_argument('--q', action='store', type=float, default=-3.5,
         help='Slope of the grain size distribution in logspace')
@@ -126,7 +241,8 @@ def synthesizer():
         help='Set the number of photons for scattering and thermal Monte Carlo')
 
     parser.add_argument('--nthreads', action='store', default=4, 
-        help='Number of threads used for the Monte-Carlo runs')
+        help='Number of threads used for the Monte-Carlo runs, to ' +\
+            'create the grid and to compute the dust opacities')
 
     parser.add_argument('-rt', '--raytrace', action='store_true', default=False,
         help='Call RADMC3D to raytrace the new grid and plot an image')
@@ -245,7 +361,7 @@ def synthesizer():
     # Initialize the pipeline
     pipeline = Pipeline(
         lam=cli.lam, lmin=cli.lmin, lmax=cli.lmax, nlam=cli.nlam,
-        amin=cli.amin, amax=cli.amax, na=cli.na,
+        amin=cli.amin, amax=cli.amax, na=cli.na, q=cli.q,
         csubl=cli.sublimation, sootline=cli.sootline, dgrowth=cli.dust_growth,
         polarization=cli.polarization, alignment=cli.alignment, star=cli.star, 
         bbox=cli.bbox, nphot=cli.nphot, nthreads=cli.nthreads, 
@@ -260,13 +376,23 @@ def synthesizer():
             bbox=cli.bbox, rout=cli.rout, temperature=cli.temperature, 
             render=cli.render, vtk=cli.vtk, show_2d=cli.show_grid_2d, 
             show_3d=cli.show_grid_3d, vector_field=cli.vector_field, 
-            tau=cli.tau,
+            tau=cli.tau, binary=cli.binary, interp=cli.interp, 
+            kernel=cli.kernel, neighbours=cli.neighbours, 
+            rmax_interp=cli.rmax_interp, memory=cli.memory, 
+            cache=not cli.no_cache, cache_size=cli.cache_size, 
+            octree=cli.octree, levelmax=cli.levelmax, maxpart=cli.maxpart, 
+            gradient=cli.gradient, spherical=cli.spherical, rin=cli.rin, 
+            ntheta=cli.ntheta, nphi=cli.nphi, auto_ncells=cli.auto_ncells,
+            precision=cli.precision, backend=cli.backend, 
+            model_params=dict(cli.model_params or []), 
+            sweep=dict(cli.sweep) if cli.sweep else None,
         )
 
     # Generate the dust opacity tables
     if cli.opacity:
         pipeline.dustmixer(
-            show_nk=cli.show_nk, show_opac=cli.show_opacity, pb=not cli.nopb
+            show_nk=cli.show_nk, show_opac=cli.show_opacity, pb=not cli.nopb,
+            cache=not cli.no_cache, cache_size=cli.cache_size, 
         )
 
     # Run a thermal Monte-Carlo
@@ -5,6 +5,7 @@ import sys
 import copy
 import random
 import requests
+import itertools
 import warnings
 import subprocess
 import numpy as np
@@ -17,6 +18,7 @@ from astropy.io import ascii, fits
 from scipy.interpolate import griddata
 
 from synthesizer import utils
+from synthesizer.cache import DiskCache
 from synthesizer import raytrace
 from synthesizer import synobs
 from synthesizer import gridder
@@ -28,7 +30,7 @@ source_dir = source_path.parent
 
 class Pipeline:
     
-    def __init__(self, lam=1300, amin=0.1, amax=10, na=100, q=3.5, nang=181, 
+    def __init__(self, lam=1300, amin=0.1, amax=10, na=100, q=-3.5, nang=181, 
             nphot=1e5, nthreads=1, lmin=0.1, lmax=1e5, nlam=200, star=None, 
             dgrowth=False, csubl=0, sootline=300, material='sg', bbox=None,
             polarization=False, alignment=False, 
@@ -100,8 +102,20 @@ class Pipeline:
     def create_grid(self, model=None, sphfile=None, amrfile=None, 
             source='sphng', bbox=None, rout=None, ncells=None, tau=False, 
             vector_field=None, show_2d=False, show_3d=False, vtk=False, 
-            render=False, g2d=100, temperature=True):
-        """ Initial step in the pipeline: creates an input grid for RADMC3D """
+            render=False, g2d=100, temperature=True, binary=False, 
+            interp='linear', kernel='cubic', neighbours=8, rmax_interp=None, 
+            memory=None, cache=True, cache_size=10, octree=False, levelmax=6, 
+            maxpart=8, gradient=None, spherical=False, rin=None, ntheta=64, 
+            nphi=1, auto_ncells=False, precision='double', backend='numpy', 
+            model_params=None, sweep=None):
+        """ 
+            Initial step in the pipeline: creates an input grid for RADMC3D.
+
+            model_params is a dictionary overriding the default parameters of
+            an analytical model. sweep is a dictionary with a list of values 
+            for some of them: the model grid is additionally written for 
+            every combination of values, into sweep_000/, sweep_001/, ...
+        """
 
         self.model = model
         self.sphfile = sphfile
@@ -111,6 +125,16 @@ class Pipeline:
         self.rout = rout * u.au.to(u.cm) if rout is not None else rout
         self.g2d = g2d
 
+        if sweep is not None and (model is None or spherical):
+            raise ValueError(f'{utils.color.red}--sweep requires --model on '+\
+                f'a cartesian grid{utils.color.none}')
+
+        # Triangulations are global, so they cannot be streamed in slabs
+        if sphfile is not None and memory is not None and interp == 'linear' \
+                and not (octree or spherical):
+            raise ValueError(f'{utils.color.red}--memory requires --interp '+\
+                f'nearest, idw or sph{utils.color.none}')
+
         # Make sure the model temp is read when c-sublimation is enabled
         if self.csubl > 0 and not temperature:
             utils.print_('--sublimation was given but not --temperature.') 
@@ -125,7 +149,31 @@ class Pipeline:
         utils.print_('Creating model grid ...\n', bold=True)
     
         # Create a grid using an analytical model
-        if model is not None:
+        # Keyword arguments for spherical grids
+        spherical_kwargs = dict(
+            ntheta=ntheta, 
+            nphi=nphi, 
+            rin=rin * u.au.to(u.cm) if rin is not None else rin,
+            rout=self.rout if self.rout is not None else self.bbox,
+        )
+
+        if model is not None and spherical:
+            self.grid = gridder.SphericalGrid(
+                ncells=self.ncells, 
+                g2d=self.g2d,
+                nspec=self.nspec,
+                csubl=self.csubl, 
+                sootline=self.sootline, 
+                temp=temperature, 
+                precision=precision,
+                **spherical_kwargs,
+            )
+            
+            # Evaluate the model density at the spherical cell centers
+            self.grid.create_model(self.model, nthreads=self.nthreads, 
+                backend=backend, params=model_params)
+
+        elif model is not None:
             self.grid = gridder.AnalyticalModel(
                 model=self.model,
                 bbox=self.bbox, 
@@ -133,6 +181,10 @@ class Pipeline:
                 g2d=self.g2d,
                 nspec=self.nspec,
                 temp=temperature, 
+                precision=precision,
+                nthreads=self.nthreads,
+                backend=backend,
+                params=model_params,
             )
             
             # Create a model density grid 
@@ -140,7 +192,7 @@ class Pipeline:
 
         # Create a grid from SPH particles
         elif sphfile is not None:
-            self.grid = gridder.CartesianGrid(
+            grid_kwargs = dict(
                 ncells=self.ncells, 
                 bbox=self.bbox, 
                 rout=self.rout,
@@ -149,20 +201,73 @@ class Pipeline:
                 sootline=self.sootline, 
                 g2d=self.g2d, 
                 temp=temperature,
+                auto_ncells=auto_ncells,
+                precision=precision,
             )
 
-            # Read the SPH data
-            self.grid.read_sph(self.sphfile, source=source)
+            # Use an adaptive oct-tree refined from a base of ncells^3
+            if octree:
+                self.grid = gridder.OctreeGrid(levelmax=levelmax, 
+                    maxpart=maxpart, gradient=gradient, **grid_kwargs)
 
-            # Set a bounding box or radius to trim particles outside of it
-            if self.bbox is not None or self.rout is not None:
-                self.grid.trim_box()
-    
-            # Interpolate the SPH points onto a regular cartesian grid
-            self.grid.interpolate_points('dens', 'linear', fill='min')
+            # Or a spherical grid with ncells logarithmic radial bins
+            elif spherical:
+                grid_kwargs.pop('bbox')
+                grid_kwargs.update(spherical_kwargs)
+                self.grid = gridder.SphericalGrid(**grid_kwargs)
+            else:
+                self.grid = gridder.CartesianGrid(**grid_kwargs)
+
+            fields = ['dens', 'temp'] if temperature else ['dens']
+            radius = None if rmax_interp is None else rmax_interp*u.au.to(u.cm)
+
+            # Reuse the interpolated grid of a previous run with the same
+            # snapshot, reader and grid parameters, if available
+            cached = None
+            if cache:
+                cache = DiskCache(maxsize=cache_size)
+                key = cache.key(
+                    snapshot=cache.file_hash(
+                        *gridder.HDF5Snapshot.find_files(self.sphfile)), 
+                    source=source, g2d=self.g2d, ncells=self.ncells, 
+                    bbox=self.bbox, rout=self.rout, fields=fields, 
+                    interp=interp, kernel=kernel, neighbours=neighbours, 
+                    radius=radius, octree=(levelmax, maxpart, gradient) \
+                        if octree else None, 
+                    spherical=spherical_kwargs if spherical else None, 
+                    auto_ncells=auto_ncells, precision=precision,
+                )
+                cached = cache.get(key)
+
+            if cached is not None:
+                utils.print_(f'Loading interpolated grid from {cache.path} ' +\
+                    '(use --no-cache to grid the snapshot again)')
+                self.grid.set_interpolated(cached)
+
+            else:
+                # Read the SPH data, trimming particles outside bbox or rout.
+                # Masses and smoothing lengths are only needed for SPH kernels.
+                self.grid.read_sph(
+                    self.sphfile, 
+                    source=source, 
+                    nproc=self.nthreads, 
+                    fields=['mass', 'hsml'] if interp == 'sph' else [],
+                )
+        
+                # Interpolate the SPH points onto a regular cartesian grid
+                self.grid.interpolate_fields(
+                    fields, 
+                    method=interp, 
+                    fill='min', 
+                    kernel=kernel, 
+                    nproc=self.nthreads,
+                    neighbours=neighbours,
+                    radius=radius,
+                    memory=None if memory is None else memory * 2**30,
+                )
 
-            if temperature:
-                self.grid.interpolate_points('temp', 'linear', fill='min')
+                if cache:
+                    cache.put(key, self.grid.get_interpolated(fields))
 
         # Create a grid from an AMR grid
         elif amrfile is not None:
@@ -190,13 +295,18 @@ class Pipeline:
         self.grid.write_grid_file()
 
         # Write the dust density distribution to radmc3d file format
-        self.grid.write_density_file()
+        self.grid.write_density_file(binary=binary)
         
         if temperature:
-            self.grid.write_temperature_file()
+            self.grid.write_temperature_file(binary=binary)
 
         if vector_field is not None:
-            self.grid.write_vector_field(morphology=vector_field)
+            self.grid.write_vector_field(morphology=vector_field, binary=binary)
+
+        # Write the model for every combination of the swept parameters
+        if sweep is not None:
+            self.grid.sweep([dict(zip(sweep, values)) for values in 
+                itertools.product(*sweep.values())], binary=binary)
 
         # Plot the density midplane
         if show_2d:
@@ -228,23 +338,36 @@ class Pipeline:
 
 
     @utils.elapsed_time
-    def dustmixer(self, show_nk=False, pb=True, show_opac=False, savefig=None):
+    def dustmixer(self, show_nk=False, pb=True, show_opac=False, savefig=None,
+            cache=True, cache_size=10):
         """
             Call dustmixer to generate dust opacity tables. 
             New dust materials can be manually defined here if desired.
+
+            If cache is True, the efficiencies of every grain size are reused 
+            from and stored to a compressed cache in ~/.cache/synthesizer/, 
+            holding up to cache_size GB, so later runs sharing materials and 
+            grain sizes only integrate them over the new size distribution.
         """
 
         print('')
         utils.print_("Calculating dust opacities ...\n", bold=True)
 
-        self.a_dist = np.logspace(
-            np.log10(self.amin), np.log10(self.amax), self.na)
+        # Sizes on a fixed logarithmic grid, shared by any size range, so 
+        # that cached efficiencies are reused when only amin or amax change
+        self.a_dist = dustmixer.size_grid(self.amin, self.amax, self.na)
 
         if self.polarization and self.nang < 181: self.nang = 181
 
-        # Use 1 until the parallelization of polarization is properly implemented
+        # Efficiencies are computed over nthreads processes
         nth = self.nthreads
-        nth = 1
+
+        # Per grain size efficiencies are shared by runs in any directory
+        if cache:
+            cache = DiskCache(path=Path.home()/'.cache/synthesizer/opacities',
+                maxsize=cache_size, compress=True)
+        else:
+            cache = None
 
         # Initialize a Dust object and set its wavelenght grid to the pipeline's
         mix = dustmixer.Dust()
@@ -266,26 +389,30 @@ class Pipeline:
             mix.name = 'Silicate'
             mix.set_nk(f'{pathnk}/astrosil-Draine2003.lnk')
             if show_nk: mix.plot_nk(savefig=savefig)
-            mix.get_opacities(a=self.a_dist, nang=self.nang, nproc=nth)
+            mix.get_opacities(a=self.a_dist, q=self.q, nang=self.nang, 
+                nproc=nth, cache=cache)
         
         elif self.material == 'g':
             mix.name = 'Graphite'
             mix.set_nk(f'{pathnk}/c-gra-Draine2003.lnk')
             if show_nk: mix.plot_nk(savefig=savefig)
-            mix.get_opacities(a=self.a_dist, nang=self.nang, nproc=nth)
+            mix.get_opacities(a=self.a_dist, q=self.q, nang=self.nang, 
+                nproc=nth, cache=cache)
         
         elif self.material == 'o':
             mix.name = 'Organics'
             mix.set_nk(f'{pathnk}/c-org-Henning1996.lnk')
             if show_nk: mix.plot_nk(savefig=savefig)
-            mix.get_opacities(a=self.a_dist, nang=self.nang, nproc=nth)
+            mix.get_opacities(a=self.a_dist, q=self.q, nang=self.nang, 
+                nproc=nth, cache=cache)
 
         elif self.material == 'p':
             mix.name = 'Pyroxene-Mg70'
             mix.set_nk(f'{pathnk}/pyr-mg70-Dorschner1995.lnk', get_dens=False)
             mix.set_density(3.01, cgs=True)
             if show_nk: mix.plot_nk(savefig=savefig)
-            mix.get_opacities(a=self.a_dist, nang=self.nang, nproc=nth)
+            mix.get_opacities(a=self.a_dist, q=self.q, nang=self.nang, 
+                nproc=nth, cache=cache)
 
         elif self.material == 'sg':
             sil = copy.deepcopy(mix)
@@ -298,8 +425,10 @@ class Pipeline:
             if show_nk: sil.plot_nk(savefig=savefig)
             if show_nk: gra.plot_nk(savefig=savefig)
 
-            sil.get_opacities(a=self.a_dist, nang=self.nang, nproc=nth)
-            gra.get_opacities(a=self.a_dist, nang=self.nang, nproc=nth)
+            sil.get_opacities(a=self.a_dist, q=self.q, nang=self.nang, 
+                nproc=nth, cache=cache)
+            gra.get_opacities(a=self.a_dist, q=self.q, nang=self.nang, 
+                nproc=nth, cache=cache)
 
             # Sum the opacities weighted by their mass fractions
             mix = sil * 0.625 + gra * 0.375
@@ -320,9 +449,34 @@ class Pipeline:
             if show_nk: gra.plot_nk(savefig=savefig)
             if show_nk: org.plot_nk(savefig=savefig)
 
-            sil.get_opacities(a=self.a_dist, nang=self.nang, nproc=nth)
-            gra.get_opacities(a=self.a_dist, nang=self.nang, nproc=nth)
-            org.get_opacities(a=self.a_dist, nang=self.nang, nproc=nth)
+            # With dust growth, the second species has sizes up to 1 mm. Add 
+            # them to the grid, so both species come out of a single Mie 
+            # calculation, each integrated over its own range
+            a_dist = self.a_dist
+            growth = self.dgrowth and self.csubl > 0 and self.a_dist.size > 1
+            if growth:
+                a_dist = np.union1d(self.a_dist, dustmixer.size_grid(self.amin,
+                    1000, ppd=dustmixer.sizes_per_decade(
+                        self.amin, self.amax, self.na)))
+
+            sil.get_opacities(a=a_dist, q=self.q, nang=self.nang, 
+                nproc=nth, cache=cache)
+            gra.get_opacities(a=a_dist, q=self.q, nang=self.nang, 
+                nproc=nth, cache=cache)
+            org.get_opacities(a=self.a_dist, q=self.q, nang=self.nang, 
+                nproc=nth, cache=cache)
+
+            if growth:
+                # Grown grains of the second species, without organics
+                sil.integrate_opacities(amax=1000)
+                gra.integrate_opacities(amax=1000)
+                grown = sil * 0.625 + gra * 0.375
+                grown.name = self.material2
+                grown.write_opacity_file(
+                    name=self._get_opac_name(dgrowth=self.dgrowth))
+
+                sil.integrate_opacities(amax=self.amax)
+                gra.integrate_opacities(amax=self.amax)
 
             mf_sil = 0.625
             mf_gra = 0.375
@@ -510,7 +664,7 @@ class Pipeline:
         utils.file_exists('amr_grid.inp', 
             msg='You must create a model grid first. Use synthesizer --grid')
 
-        utils.file_exists('dust_density.inp', 
+        utils.file_exists('dust_density.*inp', 
             msg='You must create a density model first. Use synthesizer --grid')
 
         # Generate only the input files that are not available in the directory
@@ -575,10 +729,10 @@ class Pipeline:
         utils.file_exists('amr_grid.inp', 
             msg='You must create a model grid first. Use synthesizer --grid')
 
-        utils.file_exists('dust_density.inp', 
+        utils.file_exists('dust_density.*inp', 
             msg='You must create a density model first. Use synthesizer --grid')
 
-        utils.file_exists('dust_temperature.dat',
+        utils.file_exists('dust_temperature.*dat',
             msg='You must create a temperature model first. '+\
                 'Use synthesizer -g --temperature or synthesizer -mc')
 
@@ -608,7 +762,7 @@ class Pipeline:
                 if len(glob('dustkapalignfact*')) == 0:
                     self.generate_input_files(dustkapalignfact=True)
 
-            if not os.path.exists('grainalign_dir.inp'):
+            if not utils.file_exists('grainalign_dir.*inp', raise_=False):
                 self.generate_input_files(grainalign=True)
 
         # Now double check that all necessary input files are available 
@@ -619,7 +773,7 @@ class Pipeline:
         utils.file_exists('dustkapscat*' if self.polarization else 'dustkappa*')
         if self.alignment: 
             utils.file_exists('dustkapalignfact*')
-            utils.file_exists('grainalign_dir.inp')
+            utils.file_exists('grainalign_dir.*inp')
 
         self.distance = distance
         self.tau = tau
@@ -931,9 +1085,9 @@ class Pipeline:
     @utils.elapsed_time
     def plot_tau(self, show=False):
         utils.print_(f'Generating optical depth map at {self.lam} microns')
-        utils.file_exists('dust_density.inp')
+        utils.file_exists('dust_density.*inp')
         utils.file_exists('amr_grid.inp')
-        rho = np.loadtxt('dust_density.inp', skiprows=3)
+        rho = utils.read_radmc3d_file('dust_density.inp')
         amr = np.loadtxt('amr_grid.inp', skiprows=6)
 
         # Integrate density weigthed by the dust opacity along the line-of-sight
@@ -964,9 +1118,9 @@ class Pipeline:
         """ Plot the grid's density and temperature midplanes from files,
             in case they are not currently available from pipeline.grid
         """
-        utils.file_exists('dust_density.inp')
+        utils.file_exists('dust_density.*inp')
         utils.print_('Reading density from dust_density.inp')
-        dens = np.loadtxt('dust_density.inp', skiprows=3).T
+        dens = utils.read_radmc3d_file('dust_density.inp')
         nx = int(np.cbrt(dens.size))
         dens = dens.reshape((nx, nx, nx))
         bbox = self._get_bbox()
@@ -974,9 +1128,9 @@ class Pipeline:
         grid.plot_midplane('density', data=dens)
 
         if temp: 
-            utils.file_exists('dust_temperature.dat')
+            utils.file_exists('dust_temperature.*dat')
             utils.print_('Reading temperature from dust_temperature.dat')
-            temp = np.loadtxt('dust_temperature.dat', skiprows=3)
+            temp = utils.read_radmc3d_file('dust_temperature.dat')
             temp = temp.reshape((nx, nx, nx))
             grid = gridder.CartesianGrid(nx, bbox)
             grid.plot_midplane('temperature', data=temp)
@@ -986,9 +1140,9 @@ class Pipeline:
         """ Render the grid's density and temperature in 3D from files,
             in case they are not currently available from pipeline.grid
         """
-        utils.file_exists('dust_density.inp')
+        utils.file_exists('dust_density.*inp')
         utils.print_('Reading density from dust_density.inp')
-        dens = np.loadtxt('dust_density.inp', skiprows=3).T
+        dens = utils.read_radmc3d_file('dust_density.inp')
         nx = int(np.cbrt(dens.size))
         dens = dens.reshape((nx, nx, nx))
         bbox = self._get_bbox()
@@ -997,9 +1151,9 @@ class Pipeline:
         grid.plot_3d('density', data=dens)
 
         if temp: 
-            utils.file_exists('dust_temperature.dat')
+            utils.file_exists('dust_temperature.*dat')
             utils.print_('Reading temperature from dust_temperature.dat')
-            temp = np.loadtxt('dust_temperature.dat', skiprows=3)
+            temp = utils.read_radmc3d_file('dust_temperature.dat')
             temp = temp.reshape((nx, nx, nx))
             grid = gridder.CartesianGrid(nx, bbox)
             grid.plot_3d('temperature', data=temp)
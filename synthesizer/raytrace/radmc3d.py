@@ -78,7 +78,7 @@ class RADMC3D:
         utils.file_exists('dustkapscat*' if self.stokes else 'dustkappa*')
         if self.alignment: 
             utils.file_exists('dustkapalignfact*')
-            utils.file_exists('grainalign_dir.inp')
+            utils.file_exists('grainalign_dir.*inp')
 
     def catch_error(self):
         """ Raise an exception to halt synthesizer if RADMC3D ended in Error """
@@ -119,11 +119,11 @@ class RADMC3D:
         utils.file_exists('amr_grid.inp', 
             msg='You must create a model grid first. Use synthesizer --grid')
 
-        utils.file_exists('dust_density.inp', 
+        utils.file_exists('dust_density.*inp', 
             msg='You must create a density model first. Use synthesizer --grid')
 
         if temp:
-            utils.file_exists('dust_temperature.dat',
+            utils.file_exists('dust_temperature.*dat',
                 msg='You must create a temperature model first. '+\
                     'Use synthesizer -g --temperature or synthesizer -mc')
 
@@ -135,7 +135,7 @@ class RADMC3D:
         utils.file_exists('dustkapscat*' if self.stokes else 'dustkappa*')
         if self.alignment: 
             utils.file_exists('dustkapalignfact*')
-            utils.file_exists('grainalign_dir.inp')
+            utils.file_exists('grainalign_dir.*inp')
 
     def installer(self):
         shell = os.environ('SHELL')
@@ -173,10 +173,10 @@ class RADMC3D:
         utils.file_exists('amr_grid.inp', 
             msg='You must create a model grid first. Use synthesizer --grid')
 
-        utils.file_exists('dust_density.inp', 
+        utils.file_exists('dust_density.*inp', 
             msg='You must create a density model first. Use synthesizer --grid')
 
-        utils.file_exists('dust_temperature.dat',
+        utils.file_exists('dust_temperature.*dat',
             msg='You must create a temperature model first. '+\
                 'Use synthesizer -g --temperature or synthesizer -mc')
 
@@ -206,7 +206,7 @@ class RADMC3D:
                 if len(glob('dustkapalignfact*')) == 0:
                     self.generate_input_files(dustkapalignfact=True)
 
-            if not os.path.exists('grainalign_dir.inp'):
+            if not utils.file_exists('grainalign_dir.*inp', raise_=False):
                 self.generate_input_files(grainalign=True)
 
 
@@ -280,6 +280,88 @@ def radmc3d_casafits(fitsfile='radmc3d_I.fits', radmc3dimage='image.out',
     })
     write_fits(fitsfile, img, header, True, verbose)
 
+def radmc3d_binary_name(filename):
+    """ Return the binary counterpart of a RADMC3D ASCII filename,
+        e.g., dust_density.inp -> dust_density.binp and
+        dust_temperature.dat -> dust_temperature.bdat
+    """
+    name, ext = os.path.splitext(filename)
+    return name + {'.inp': '.binp', '.dat': '.bdat'}[ext]
+
+def write_radmc3d_file(filename, data, nrspec=None, binary=False, 
+        nrcells=None, chunksize=2**20):
+    """ Write a RADMC3D data file, like dust_density, dust_temperature or
+        grainalign_dir, either in ASCII (.inp/.dat) or binary (.binp/.bdat).
+
+        data must be already sorted in RADMC3D (Fortran) ordering, as a 1D
+        array for scalar fields or as an array of shape (nrcells, 3) for
+        vector fields. For scalar fields nrspec is written to the header and
+        data must contain all species concatenated.
+
+        data can also be a sequence of arrays (e.g., one per species) that
+        are written one after another, so they never need to be concatenated
+        in memory. If it is an iterator, nrcells must be given. Arrays are
+        converted and written in chunks of chunksize rows, so memory-mapped 
+        grids are streamed from disk.
+
+        The file of the other format is removed, so that RADMC3D never reads 
+        a stale one.
+    """
+
+    blocks = [data] if isinstance(data, np.ndarray) else data
+    if nrcells is None:
+        blocks = [np.asarray(b) for b in blocks]
+        nrows = sum(b.shape[0] for b in blocks)
+        nrcells = nrows if nrspec is None else nrows // nrspec
+
+    header = [1, nrcells] if nrspec is None else [1, nrcells, nrspec]
+    binfile = radmc3d_binary_name(filename)
+    chunks = (b[i: i + chunksize] for b in blocks 
+        for i in range(0, b.shape[0], chunksize))
+
+    if binary:
+        # Header: iformat, precision (bytes), nrcells [, nrspec]
+        chunk = next(chunks, np.zeros(0))
+        precis = 4 if chunk.dtype == np.float32 else 8
+        header.insert(1, precis)
+
+        with open(binfile, 'wb') as f:
+            np.array(header, dtype=np.int64).tofile(f)
+            while chunk is not None:
+                chunk.astype(f'<f{precis}', copy=False).tofile(f)
+                chunk = next(chunks, None)
+
+        if os.path.exists(filename):
+            os.remove(filename)
+    else:
+        with open(filename, 'w+') as f:
+            f.write('\n'.join(str(h) for h in header) + '\n')
+            for chunk in chunks:
+                np.savetxt(f, chunk, fmt='%13.6e')
+
+        if os.path.exists(binfile):
+            os.remove(binfile)
+
+def read_radmc3d_file(filename, skip=3):
+    """ Read a RADMC3D data file written by write_radmc3d_file.
+        filename is the ASCII name (e.g., dust_density.inp). If its binary
+        counterpart exists (or is newer), that one is read instead.
+        skip is the number of header lines of the ASCII file.
+        Returns a flattened 1D array.
+    """
+
+    binfile = radmc3d_binary_name(filename)
+    use_binary = os.path.exists(binfile) and (not os.path.exists(filename) or
+        os.path.getmtime(binfile) > os.path.getmtime(filename))
+
+    if use_binary:
+        # Binary headers contain an additional int64 for the precision
+        header = np.fromfile(binfile, dtype=np.int64, count=skip + 1)
+        return np.fromfile(
+            binfile, dtype=f'<f{header[1]}', offset=8 * (skip + 1))
+    else:
+        return np.loadtxt(filename, skiprows=skip).ravel()
+
 def stats(data, verbose=False, slice=None):
     """
     Compute basic statistics of a array or a fits file.
@@ -0,0 +1,43 @@
+import pytest
+import numpy as np
+
+from synthesizer.dustmixer import bhmie
+
+
+@pytest.mark.parametrize('refrel', [1.5 + 0.01j, 3.4 + 0.8j])
+def test_batch_matches_bhmie(refrel):
+    x = np.logspace(-2, 2.5, 40)
+    theta = np.linspace(0, 180, 91)
+    batch = bhmie.bhmie_batch(x, refrel, theta, batchsize=2**12)
+
+    for i, x_ in enumerate(x):
+        single = bhmie.bhmie(x_, refrel, theta)
+        for b, s in zip(batch, single):
+            assert np.allclose(b[i], s, rtol=1e-10, atol=1e-14)
+
+
+def test_batch_without_amplitudes():
+    x = np.logspace(-1, 2, 30).reshape(5, 6)
+    refrel = np.full(x.shape, 1.7 + 0.1j)
+    theta = np.linspace(0, 180, 5)
+    full = bhmie.bhmie_batch(x, refrel, theta)
+    s1, s2, *efficiencies = bhmie.bhmie_batch(x, refrel, theta, 
+        amplitudes=False)
+
+    assert s1 is None and s2 is None
+    for q, expected in zip(efficiencies, full[2:]):
+        assert q.shape == x.shape
+        assert np.array_equal(q, expected)
+
+
+@pytest.mark.parametrize('amplitudes', [True, False])
+def test_parallel_batches_match_serial(amplitudes):
+    x = np.logspace(-1, 3, 60)
+    theta = np.linspace(0, 180, 19)
+    serial = bhmie.bhmie_batch(x, 1.7 + 0.1j, theta, batchsize=2**13, 
+        amplitudes=amplitudes)
+    parallel = bhmie.bhmie_batch(x, 1.7 + 0.1j, theta, batchsize=2**13, 
+        amplitudes=amplitudes, nproc=2)
+
+    for p, s in zip(parallel, serial):
+        assert (p is None and s is None) or np.array_equal(p, s)
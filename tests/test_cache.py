@@ -0,0 +1,72 @@
+import os
+import numpy as np
+
+from synthesizer.cache import DiskCache
+
+
+def test_round_trip(tmp_path):
+    cache = DiskCache(path=tmp_path)
+    arrays = dict(a=np.arange(10.0), b=np.ones((3, 4), dtype=np.float32))
+    key = cache.key('snapshot', ncells=10)
+
+    assert cache.get(key) is None
+    cache.put(key, arrays)
+    cached = cache.get(key)
+
+    assert set(cached) == {'a', 'b'}
+    for name, array in arrays.items():
+        assert np.array_equal(cached[name], array)
+        assert cached[name].dtype == array.dtype
+    assert cache.get(key, ['c']) is None
+
+
+def test_compressed_round_trip(tmp_path):
+    cache = DiskCache(path=tmp_path, compress=True)
+    arrays = dict(Qext=np.linspace(0, 2, 100), Z11=np.zeros((100, 181)))
+
+    entry = cache.put('entry', arrays)
+    assert entry.endswith('.npz') and os.path.isfile(entry)
+
+    cached = cache.get('entry', ['Qext', 'Z11'])
+    for name, array in arrays.items():
+        assert np.array_equal(cached[name], array)
+    assert cache.get('other') is None
+
+
+def test_keys():
+    assert DiskCache.key(1, a=2, b=3) == DiskCache.key(1, b=3, a=2)
+    assert DiskCache.key(1, a=2) != DiskCache.key(1, a=3)
+    assert DiskCache.array_hash(np.arange(3.0)) == \
+        DiskCache.array_hash(np.arange(3.0))
+    assert DiskCache.array_hash(np.arange(3.0)) != \
+        DiskCache.array_hash(np.arange(3.0).astype(np.float32))
+
+
+def test_eviction_keeps_recently_used(tmp_path):
+    array = np.zeros(2**14)
+    cache = DiskCache(path=tmp_path, maxsize=2.5 * array.nbytes / 2**30)
+
+    for i, key in enumerate(['old', 'used', 'new']):
+        cache.put(key, dict(x=array))
+        os.utime(tmp_path / key, (i, i))
+    cache.get('used')
+    cache.evict()
+
+    assert cache.get('old') is None
+    assert cache.get('used') is not None
+    assert cache.get('new') is not None
+
+
+def test_file_hash_detects_rewrites(tmp_path):
+    snapshot = tmp_path / 'snapshot.dat'
+    data = np.zeros(2**20 + 100, dtype=np.uint8)
+    data.tofile(snapshot)
+    os.utime(snapshot, ns=(0, 10**18))
+    before = DiskCache.file_hash(snapshot, sample=2**10)
+
+    # Same size, differing outside of the sampled blocks
+    data[2**10 + 1] = 1
+    data.tofile(snapshot)
+    os.utime(snapshot, ns=(0, 10**18 + 1))
+
+    assert DiskCache.file_hash(snapshot, sample=2**10) != before
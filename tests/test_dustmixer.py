@@ -0,0 +1,103 @@
+import pytest
+import numpy as np
+from pathlib import Path
+
+from synthesizer.cache import DiskCache
+from synthesizer.dustmixer.dustmixer import Dust, size_grid
+
+nk = Path(__file__).parents[1] / 'synthesizer/dustmixer/nk'
+
+opacities = ['kext', 'ksca', 'kabs', 'gsca', 'z11', 'z12', 'z22', 'z33', 
+    'z34', 'z44']
+
+
+def silicate(scatmatrix=False):
+    dust = Dust(name='Silicate', scatmatrix=scatmatrix)
+    dust.pb = False
+    dust.set_lgrid(1, 3000, 40)
+    dust.set_nk(str(nk / 'astrosil-Draine2003.lnk'), get_dens=False)
+    dust.set_density(3.0, cgs=True)
+    return dust
+
+
+@pytest.mark.parametrize('scatmatrix, nang', [(False, 2), (True, 91)])
+def test_cached_efficiencies(tmp_path, scatmatrix, nang):
+    cache = DiskCache(path=tmp_path, compress=True)
+    a = np.logspace(-1, 2, 16)
+
+    fresh = silicate(scatmatrix)
+    fresh.get_opacities(a=a, nang=nang)
+    stored = silicate(scatmatrix)
+    stored.get_opacities(a=a, nang=nang, cache=cache)
+    assert len(list(tmp_path.iterdir())) == a.size
+
+    # Sizes shared with the previous run are loaded, only new ones computed
+    extended = np.logspace(-1, 3, 21)
+    cached = silicate(scatmatrix)
+    cached.get_opacities(a=extended, q=-3, nang=nang, cache=cache)
+    assert len(list(tmp_path.iterdir())) == extended.size
+    reference = silicate(scatmatrix)
+    reference.get_opacities(a=extended, q=-3, nang=nang)
+
+    for name in opacities:
+        assert np.array_equal(getattr(stored, name), getattr(fresh, name))
+        assert np.allclose(getattr(cached, name), getattr(reference, name), 
+            rtol=1e-12, atol=0)
+
+
+@pytest.mark.parametrize('scatmatrix, nang', [(False, 2), (True, 91)])
+def test_integrate_opacities_over_subrange(scatmatrix, nang):
+    a = np.logspace(-1, 3, 21)
+    dust = silicate(scatmatrix)
+    dust.get_opacities(a=a, nang=nang)
+    dust.integrate_opacities(q=-3, amin=a[2], amax=a[15])
+
+    fresh = silicate(scatmatrix)
+    fresh.get_opacities(a=a[2: 16], q=-3, nang=nang)
+
+    assert dust.na == fresh.na and dust.q == fresh.q
+    assert dust.amin == fresh.amin and dust.amax == fresh.amax
+    for name in opacities:
+        assert np.allclose(getattr(dust, name), getattr(fresh, name), 
+            rtol=1e-12, atol=0)
+
+    # The efficiencies of all the computed sizes are kept
+    dust.integrate_opacities(q=-3.5, amin=None, amax=None)
+    full = silicate(scatmatrix)
+    full.get_opacities(a=a, nang=nang)
+    for name in opacities:
+        assert np.array_equal(getattr(dust, name), getattr(full, name))
+
+
+def test_integrate_opacities_requires_sizes():
+    dust = silicate()
+    with pytest.raises(ValueError):
+        dust.integrate_opacities()
+
+    dust.get_opacities(a=np.logspace(-1, 1, 5), nang=2)
+    with pytest.raises(ValueError):
+        dust.integrate_opacities(amin=5, amax=6)
+
+
+def test_size_grid_is_shared_by_ranges():
+    a = size_grid(0.1, 10, 100)
+    assert a.size >= 100 and a[0] == 0.1 and a[-1] == 10
+    assert np.all(np.diff(a) > 0)
+
+    # Other ranges at the same sampling, and coarser samplings, reuse sizes
+    assert np.isin(size_grid(0.1, 20, 100)[:-1], size_grid(0.1, 100, 100)).all()
+    assert np.isin(size_grid(0.1, 10, 20), a).all()
+    assert np.array_equal(size_grid(1, 1, 1), [1])
+
+
+@pytest.mark.parametrize('scatmatrix, nang', [(False, 2), (True, 91)])
+def test_parallel_opacities_match_serial(scatmatrix, nang):
+    # Sizes up to 1 mm split the size parameters into several batches
+    a = np.logspace(-1, 3, 12)
+    serial = silicate(scatmatrix)
+    serial.get_opacities(a=a, nang=nang, nproc=1)
+    parallel = silicate(scatmatrix)
+    parallel.get_opacities(a=a, nang=nang, nproc=2)
+
+    for name in opacities:
+        assert np.array_equal(getattr(parallel, name), getattr(serial, name))
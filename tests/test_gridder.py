@@ -0,0 +1,149 @@
+import pytest
+import numpy as np
+
+from synthesizer.cache import DiskCache
+from synthesizer.gridder.gridder import CartesianGrid, OctreeGrid, SphericalGrid
+
+
+def particles(grid, n=2000, seed=0):
+    """ Set a clustered cloud of particles on a grid """
+    rng = np.random.default_rng(seed)
+    grid.x, grid.y, grid.z = rng.normal(0, 1e15, (3, n))
+    grid.dens = np.exp(-(grid.x**2 + grid.y**2 + grid.z**2) / 1e30)
+
+
+def read_grid_file(filename='amr_grid.inp'):
+    """ Number of cells per axis and cell walls from amr_grid.inp """
+    with open(filename) as f:
+        lines = f.readlines()
+    ncells = [int(n) for n in lines[5].split()]
+    walls = np.array(lines[6:], dtype=float)
+    return ncells, walls
+
+
+def test_auto_ncells_restored_from_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = DiskCache(path=tmp_path / 'cache')
+
+    grid = CartesianGrid(ncells=200, auto_ncells=True)
+    particles(grid)
+    grid.interpolate_fields(['dens'], method='idw')
+    assert grid.ncells < 200
+    cache.put('grid', grid.get_interpolated(['dens']))
+
+    cached = CartesianGrid(ncells=200, auto_ncells=True)
+    cached.set_interpolated(cache.get('grid'))
+    assert cached.ncells == grid.ncells
+
+    cached.write_grid_file()
+    ncells, walls = read_grid_file()
+    assert ncells == [grid.ncells] * 3
+    assert walls.size == 3 * (grid.ncells + 1)
+    assert cached.interp_dens.shape == (grid.ncells,) * 3
+
+
+@pytest.mark.parametrize('method', ['nearest', 'idw', 'sph'])
+def test_streaming_does_not_depend_on_memory(method):
+    def interpolate(memory):
+        grid = CartesianGrid(ncells=24)
+        particles(grid)
+        grid.temp = 10 + grid.dens
+        grid.hsml = np.full(grid.x.size, 3e14)
+        grid.interpolate_fields(['dens', 'temp'], method=method, memory=memory)
+        return np.array(grid.interp_dens), np.array(grid.interp_temp)
+
+    reference = interpolate(None)
+    for memory in [24 * 24 * 2000, 24 * 24 * 20000]:
+        for result, expected in zip(interpolate(memory), reference):
+            assert np.array_equal(result, expected)
+
+
+def test_streaming_rejects_linear():
+    grid = CartesianGrid(ncells=8)
+    particles(grid, n=100)
+    with pytest.raises(ValueError):
+        grid.interpolate_fields(['dens'], method='linear', memory=2**20)
+
+
+def test_sph_masses_from_single_precision_fields():
+    grid = CartesianGrid(ncells=16)
+    particles(grid, n=500)
+    grid.dens = (1e-15 * grid.dens).astype(np.float32)
+    grid.hsml = np.full(grid.x.size, 3e14, dtype=np.float32)
+
+    mass, hsml = grid._sph_mass_hsml()
+    assert np.all(np.isfinite(mass))
+
+    grid.interpolate_fields(['dens'], method='sph')
+    cellsize = grid.xc[1] - grid.xc[0]
+    assert np.isfinite(grid.interp_dens).all()
+    assert grid.interp_dens.sum() * cellsize**3 <= mass.sum() * (1 + 1e-6)
+
+
+def test_spherical_grid_rejects_auto_ncells():
+    with pytest.raises(ValueError):
+        SphericalGrid(ncells=32, auto_ncells=True)
+
+
+def reference_tree(grid):
+    """ 
+        Refinement flags and leaf centers of the oct-tree of grid, from a 
+        recursive depth-first traversal with x varying fastest 
+    """
+    n = grid.ncells
+    rmin, size = grid.xi[0], grid.xi[-1] - grid.xi[0]
+    flags, leaves = [], []
+
+    def count(level, cell):
+        m = n * 2**level
+        p = [np.clip(((c - rmin) / size * m).astype(int), 0, m - 1) 
+            for c in [grid.x, grid.y, grid.z]]
+        return np.sum((p[0] == cell[0]) & (p[1] == cell[1]) & 
+            (p[2] == cell[2]))
+
+    def visit(level, cell):
+        refine = level < grid.levelmax and count(level, cell) > grid.maxpart
+        flags.append(int(refine))
+        if refine:
+            for k in range(8):
+                visit(level + 1, [2 * cell[0] + (k & 1), 
+                    2 * cell[1] + (k >> 1 & 1), 2 * cell[2] + (k >> 2 & 1)])
+        else:
+            dx = size / (n * 2**level)
+            leaves.append([rmin + (i + 0.5) * dx for i in cell])
+
+    for iz in range(n):
+        for iy in range(n):
+            for ix in range(n):
+                visit(0, [ix, iy, iz])
+
+    return np.array(flags), np.array(leaves)
+
+
+def test_octree_depth_first_order(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    grid = OctreeGrid(ncells=2, levelmax=4, maxpart=16)
+    particles(grid, n=3000)
+    grid.interpolate_fields(['dens'], method='nearest')
+
+    flags, leaves = reference_tree(grid)
+    assert grid.nlevels > 1
+    assert np.array_equal(grid.flags, flags)
+    assert np.allclose(grid.leaves, leaves, rtol=1e-12)
+    assert grid.interp_dens.size == leaves.shape[0]
+
+    grid.write_grid_file()
+    with open('amr_grid.inp') as f:
+        lines = f.read().splitlines()
+
+    assert lines[:6] == ['1', '1', '1', '0', '1 1 1', '2 2 2']
+    assert lines[6].split() == [str(grid.nlevels), str(len(leaves)), 
+        str(flags.size)]
+    walls = np.array(lines[7: 7 + 9], dtype=float)
+    assert np.allclose(walls, np.concatenate([grid.xi, grid.yi, grid.zi]))
+    assert np.array_equal(np.array(lines[16:], dtype=int), flags)
+
+
+def test_octree_grid_rejects_auto_ncells():
+    with pytest.raises(ValueError):
+        OctreeGrid(ncells=8, auto_ncells=True)
@@ -0,0 +1,116 @@
+import pytest
+import numpy as np
+
+from synthesizer.gridder import analytical, models
+from synthesizer.gridder.models import registry
+
+
+def coordinates(n=16, bbox=100):
+    c = np.linspace(-bbox, bbox, n) * 1.496e13
+    return np.meshgrid(c, c, c, sparse=True)
+
+
+@pytest.mark.parametrize('name', sorted(registry))
+def test_models_with_every_parameter_overridden(name):
+    x, y, z = coordinates()
+    cls = registry[name]
+    params = {p: 2 * v if v else 2.0 for p, v in cls.parameters.items()}
+
+    model = analytical.get_model(name, x, y, z, params=params)
+    assert model.params == params
+
+    try:
+        dens = np.broadcast_to(model.dens, np.broadcast(x, y, z).shape)
+    except NotImplementedError:
+        pytest.skip(f'Model {name} is not implemented')
+
+    assert np.all(np.isfinite(dens))
+
+    try:
+        temp = model.temp
+    except NotImplementedError:
+        return
+    if temp is not None:
+        assert np.all(np.isfinite(temp))
+
+
+def fields(model):
+    """ Density and temperature of a model over the full grid, if defined """
+    values = []
+    for field in ['dens', 'temp']:
+        try:
+            value = getattr(model, field)
+        except NotImplementedError:
+            value = None
+        values.append(None if value is None else 
+            np.broadcast_to(value, model.shape))
+
+    return values
+
+
+@pytest.mark.parametrize('overridden', [False, True])
+@pytest.mark.parametrize('name', sorted(registry))
+def test_numexpr_backend_matches_numpy(name, overridden):
+    pytest.importorskip('numexpr')
+    x, y, z = coordinates()
+    cls = registry[name]
+    params = {p: 2 * v if v else 2.0 for p, v in cls.parameters.items()} \
+        if overridden else None
+
+    results = []
+    for backend in models.backends:
+        model = analytical.get_model(name, x, y, z, params=params)
+        model.backend = backend
+        results.append(fields(model))
+
+    if all(value is None for value in results[0]):
+        pytest.skip(f'Model {name} is not implemented')
+
+    for expected, value in zip(*results):
+        assert (expected is None) == (value is None)
+        if expected is not None:
+            assert np.allclose(value, expected, rtol=2e-14, atol=0)
+
+
+@pytest.mark.parametrize('backend', models.backends)
+def test_evaluate_redefinitions_and_geometry_cache(backend):
+    if backend == 'numexpr':
+        pytest.importorskip('numexpr')
+    x, y, z = coordinates(n=8)
+    variables = dict(x=x, y=y, z=z, k=3.0)
+
+    # Names can be redefined in terms of their previous value
+    geometry = {}
+    definitions = [
+        ('r', 'sqrt(x**2 + y**2)'), 
+        ('r', 'r / 2'), 
+        ('s', 'r * k'), 
+        ('r', 'r + s'),
+        ('t', 'r + z'),
+    ]
+    value = models.evaluate('t * k', variables, definitions, backend, geometry)
+    r = np.sqrt(x**2 + y**2) / 2
+    assert np.allclose(value, (r + r * 3 + z) * 3, rtol=1e-14, atol=0)
+
+    # Only the definitions depending on the coordinates alone are cached, 
+    # keyed by their expression in terms of x, y and z
+    key = '((sqrt(x**2 + y**2)) / 2)'
+    assert set(geometry) == {'(sqrt(x**2 + y**2))', key}
+    assert np.allclose(geometry[key], r, rtol=1e-14, atol=0)
+
+    # Cached definitions are reused by later evaluations
+    geometry[key] = np.zeros_like(geometry[key])
+    value = models.evaluate('t * k', variables, definitions, backend, geometry)
+    assert np.allclose(value, z * 3, rtol=1e-14, atol=0)
+
+    # Models keep their geometry when parameters change, not coordinates
+    model = analytical.get_model('ppdisk', x, y, z)
+    model.backend = backend
+    dens = model.dens
+    geometry = model.geometry
+    assert '(sqrt(x**2 + y**2))' in geometry
+    model.set_params(rho_slope=1.2)
+    assert model.dens is not dens
+    assert model.geometry is geometry
+    model.x = x * 2
+    assert model.geometry is not geometry
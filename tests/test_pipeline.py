@@ -0,0 +1,101 @@
+import pytest
+import numpy as np
+
+from synthesizer.pipeline import Pipeline, source_dir
+from synthesizer.dustmixer import dustmixer
+
+nk = source_dir / 'dustmixer/nk'
+
+grid = dict(lmin=10, lmax=3000, nlam=20, nang=2)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """ Run in a temporary directory, with a temporary opacity cache """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('HOME', str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def mie_sizes(monkeypatch):
+    """ Record the number of grain sizes sent to Mie theory """
+    sizes = []
+    get_efficiencies = dustmixer.Dust.get_efficiencies
+
+    def counted(self, a, *args, **kwargs):
+        sizes.append(np.size(a))
+        return get_efficiencies(self, a, *args, **kwargs)
+
+    monkeypatch.setattr(dustmixer.Dust, 'get_efficiencies', counted)
+    return sizes
+
+
+def read_opacity_file(name):
+    """ Wavelengths, kabs, ksca and gsca from a dustkappa_*.inp file """
+    return np.loadtxt(f'dustkappa_{name}.inp', skiprows=10).T
+
+
+def material(filename, a, q=-3.5):
+    dust = dustmixer.Dust()
+    dust.pb = False
+    dust.set_lgrid(grid['lmin'], grid['lmax'], grid['nlam'])
+    dust.set_nk(str(nk / filename))
+    dust.get_opacities(a=a, q=q, nang=grid['nang'])
+    return dust
+
+
+def test_opacities_reuse_cached_sizes(workdir, mie_sizes):
+    Pipeline(amin=0.1, amax=20, na=100, material='s', **grid).dustmixer(
+        pb=False)
+    assert sum(mie_sizes) > 0
+
+    # A new slope or amax within the computed sizes runs no Mie theory
+    mie_sizes.clear()
+    Pipeline(amin=0.1, amax=10, na=100, q=-3, material='s', **grid).dustmixer(
+        pb=False)
+    assert sum(mie_sizes) == 0
+
+    # An amax off the size grid only computes that size
+    Pipeline(amin=0.1, amax=15, na=100, material='s', **grid).dustmixer(
+        pb=False)
+    assert mie_sizes == [1]
+
+    # The slope is passed on to the opacities
+    a = dustmixer.size_grid(0.1, 10, 100)
+    _, kabs, ksca, gsca = read_opacity_file('s-a10um')
+    reference = material('astrosil-Draine2003.lnk', a, q=-3)
+    assert np.allclose(kabs, reference.kabs, rtol=1e-5)
+    assert np.allclose(ksca, reference.ksca, rtol=1e-5)
+
+
+@pytest.mark.parametrize('amax', [10, 2000])
+def test_dust_growth_tables(workdir, amax):
+    Pipeline(amin=0.1, amax=amax, na=10, material='sgo', csubl=50, 
+        dgrowth=True, **grid).dustmixer(pb=False)
+
+    a = dustmixer.size_grid(0.1, amax, 10)
+    ppd = dustmixer.sizes_per_decade(0.1, amax, 10)
+    a_grown = np.union1d(a, dustmixer.size_grid(0.1, 1000, ppd=ppd))
+    a_grown = a_grown[a_grown <= 1000]
+
+    # Grown grains of the second species, up to exactly 1 mm
+    sil = material('astrosil-Draine2003.lnk', a_grown)
+    gra = material('c-gra-Draine2003.lnk', a_grown)
+    assert sil.amax * 1e4 == pytest.approx(1000)
+    grown = sil * 0.625 + gra * 0.375
+    _, kabs, ksca, gsca = read_opacity_file('sg-a1000um')
+    assert np.allclose(kabs, grown.kabs, rtol=1e-5)
+    assert np.allclose(ksca, grown.ksca, rtol=1e-5)
+    assert np.allclose(gsca, grown.gsca, rtol=1e-5, atol=1e-6)
+
+    # Main species, truncated back to amax
+    sil = material('astrosil-Draine2003.lnk', a)
+    gra = material('c-gra-Draine2003.lnk', a)
+    org = material('c-org-Henning1996.lnk', a)
+    mf_org = 0.5 * 0.375
+    mix = sil * 0.625 + gra * (0.375 - mf_org) + org * mf_org
+    _, kabs, ksca, gsca = read_opacity_file(f'sgo-a{amax}um-50org')
+    assert np.allclose(kabs, mix.kabs, rtol=1e-5)
+    assert np.allclose(ksca, mix.ksca, rtol=1e-5)
+    assert np.allclose(gsca, mix.gsca, rtol=1e-5, atol=1e-6)
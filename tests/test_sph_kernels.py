@@ -0,0 +1,56 @@
+import pytest
+import numpy as np
+
+from synthesizer.gridder import sph_kernels
+
+
+def particles(n=500, ncells=32, seed=1):
+    """ Particles whose kernels lie well within a grid of unit cells """
+    rng = np.random.default_rng(seed)
+    x, y, z = rng.uniform(8, ncells - 9, (3, n))
+    mass = rng.uniform(0.5, 2, n)
+    hsml = rng.uniform(0.3, 3, n)
+    temp = rng.uniform(10, 100, n)
+    return x, y, z, mass, hsml, temp
+
+
+@pytest.mark.parametrize('kernel', ['cubic', 'wendland'])
+def test_deposit_conserves_mass(kernel):
+    x, y, z, mass, hsml, temp = particles()
+    deposited, [mean] = sph_kernels.deposit(x, y, z, mass, hsml, ncells=32, 
+        origin=0, dx=1, values=[temp], kernel=kernel)
+
+    assert deposited.sum() == pytest.approx(mass.sum(), rel=1e-12)
+    assert (mean * deposited).sum() == pytest.approx(
+        (temp * mass).sum(), rel=1e-12)
+
+
+def test_deposit_slabs_add_up_to_full_grid():
+    x, y, z, mass, hsml, temp = particles()
+    full, _ = sph_kernels.deposit(x, y, z, mass, hsml, ncells=32, origin=0, 
+        dx=1)
+    slabs = [sph_kernels.deposit(x, y, z, mass, hsml, ncells=32, origin=0, 
+        dx=1, zrange=(k0, k0 + 8))[0] for k0 in range(0, 32, 8)]
+
+    assert np.allclose(np.concatenate(slabs, axis=2), full, rtol=1e-12)
+
+
+def test_parallel_deposit_matches_serial():
+    x, y, z, mass, hsml, temp = particles()
+    kwargs = dict(ncells=32, origin=0, dx=1, values=[temp], chunksize=2**10)
+    serial, [serial_temp] = sph_kernels.deposit(
+        x, y, z, mass, hsml, nproc=1, **kwargs)
+    parallel, [parallel_temp] = sph_kernels.deposit(
+        x, y, z, mass, hsml, nproc=2, **kwargs)
+
+    assert np.array_equal(serial, parallel)
+    assert np.array_equal(serial_temp, parallel_temp)
+
+
+def test_deposit_without_particles():
+    empty = np.zeros(0)
+    deposited, [mean] = sph_kernels.deposit(empty, empty, empty, empty, 
+        empty, ncells=8, origin=0, dx=1, values=[empty], nproc=2)
+
+    assert deposited.shape == mean.shape == (8, 8, 8)
+    assert not deposited.any() and not mean.any()
@@ -0,0 +1,185 @@
+import h5py
+import pytest
+import numpy as np
+import astropy.units as u
+
+from synthesizer.gridder import sph_reader
+from synthesizer.gridder.gridder import CartesianGrid
+from synthesizer.gridder.sph_reader import HDF5Snapshot, Gadget, SPHng
+
+
+def write_snapshot(path, counts=(50, 30, 20), seed=0):
+    """
+        Write a small Gadget snapshot split into len(counts) files, and
+        return the datasets of all the files concatenated.
+    """
+    rng = np.random.default_rng(seed)
+    n = sum(counts)
+    data = {
+        'Coordinates': rng.normal(0, 100, (n, 3)),
+        'Density': rng.uniform(1, 2, n),
+        'Masses': rng.uniform(1, 2, n),
+        'SmoothingLength': rng.uniform(1, 10, n),
+        'Temperature': rng.uniform(10, 100, n),
+    }
+
+    files = []
+    offsets = np.cumsum([0, *counts])
+    for i, (start, stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+        files.append(path / f'snap_000.{i}.hdf5')
+        with h5py.File(files[-1], 'w') as f:
+            for name, value in data.items():
+                f.create_dataset(f'PartType0/{name}', data=value[start: stop])
+
+    return files, data
+
+
+def eager_gadget(data):
+    """ Values expected from the Gadget reader, from the full datasets """
+    rho_g = data['Density'] * 1e-10 * (u.Msun / u.au**3).to(u.g/u.cm**3)
+    coords = data['Coordinates'] * u.au.to(u.cm)
+    coords -= np.average(coords, weights=rho_g, axis=0)
+    return {
+        'x': coords[:, 0], 'y': coords[:, 1], 'z': coords[:, 2],
+        'rho_g': rho_g,
+        'temp': data['Temperature'],
+        'mass': data['Masses'] * 1e-10 * u.Msun.to(u.g),
+        'hsml': data['SmoothingLength'] * u.au.to(u.cm),
+    }
+
+
+def test_find_files_sorted_by_number(tmp_path):
+    for name in ['snap_000.hdf5', 'snap_001.0.hdf5', 'snap_000.x.hdf5']:
+        (tmp_path / name).touch()
+    files = [tmp_path / f'snap_000.{i}.hdf5' for i in range(12)]
+    for file in files:
+        file.touch()
+
+    found = HDF5Snapshot.find_files(str(files[3]))
+    assert found == [str(f) for f in files]
+
+    single = tmp_path / 'snap_000.hdf5'
+    assert HDF5Snapshot.find_files(single) == [single]
+
+
+@pytest.mark.parametrize('counts', [(100,), (50, 30, 20)])
+@pytest.mark.parametrize('nproc', [1, 2])
+def test_lazy_reads_match_eager_read(tmp_path, counts, nproc):
+    files, data = write_snapshot(tmp_path, counts)
+    expected = eager_gadget(data)
+
+    sph = Gadget(str(files[-1]), temp=True, nproc=nproc)
+    assert sph.counts == list(counts)
+    assert set(sph._cache) == {'Coordinates', 'Density'}
+
+    for name, value in expected.items():
+        assert np.allclose(getattr(sph, name), value, rtol=1e-12, atol=0)
+
+
+@pytest.mark.parametrize('nproc', [1, 2])
+def test_select_matches_eager_read(tmp_path, monkeypatch, nproc):
+    files, data = write_snapshot(tmp_path)
+    expected = eager_gadget(data)
+
+    # Record the rows read from each file, within this process
+    slabs = []
+    def read(filename, group, name, start, stop, mask=None):
+        slabs.append((name, start, stop))
+        return read_hdf5(filename, group, name, start, stop, mask)
+    read_hdf5 = sph_reader._read_hdf5
+    if nproc == 1:
+        monkeypatch.setattr(sph_reader, '_read_hdf5', read)
+
+    sph = Gadget(str(files[0]), temp=True)
+    sph.nproc = nproc
+
+    # Select particles in two steps, keeping rows of the first two files
+    keep = np.zeros(100, dtype=bool)
+    keep[[5, 60, 65, 69]] = True
+    first = keep | (np.arange(100) >= 90)
+    sph.select(first)
+    sph.select(keep[first])
+
+    for name, value in expected.items():
+        assert np.allclose(getattr(sph, name), value[keep], rtol=1e-12, atol=0)
+
+    # Only the hyperslabs spanning the selected particles are read lazily
+    if nproc == 1:
+        lazy = [s for s in slabs if s[0] not in ['Coordinates', 'Density']]
+        assert sorted(set(s[1:] for s in lazy)) == [(5, 6), (10, 20)]
+
+
+def write_sphng(path, n=31340, seed=0):
+    """ Write a binary SPHng snapshot and return its f8 columns """
+    names = 'id t x y z vx vy vz mass hsml rho T u'
+    rng = np.random.default_rng(seed)
+    data = rng.uniform(1, 2, (n, len(names.split())))
+    with open(path, 'wb') as f:
+        f.write(f'# {names}\n'.encode())
+        f.write(data.astype('<f8').tobytes())
+
+    return data
+
+
+@pytest.mark.parametrize('remove_sink', [True, False])
+def test_sphng_memmap_matches_eager_read(tmp_path, remove_sink):
+    filename = tmp_path / 'snapshot.dat'
+    write_sphng(filename)
+
+    # Eager read: the whole file as f4, converted to cgs
+    with open(filename, 'rb') as f:
+        ncols = len(f.readline()[1:].split())
+        data = np.frombuffer(f.read()).reshape(-1, ncols).astype('f4')
+    if remove_sink:
+        data[SPHng.sink_id, 5:8] = 0
+        data[SPHng.sink_id, 8:10] = data[:, 8:10].min(axis=0)
+        data[SPHng.sink_id, 10:12] = [3e-11, 900]
+    au, msun = u.au.to(u.cm), u.M_sun.to(u.g)
+    expected = {
+        'x': data[:, 2] * au, 'y': data[:, 3] * au, 'z': data[:, 4] * au,
+        'vx': data[:, 5], 'vy': data[:, 6], 'vz': data[:, 7],
+        'mass': data[:, 8] * msun, 'hsml': data[:, 9] * au,
+        'rho_g': data[:, 10], 'temp': data[:, 11],
+    }
+
+    sph = SPHng(filename, temp=True, remove_sink=remove_sink)
+    assert isinstance(sph.data, np.memmap)
+    assert sph._cache == {}
+
+    for name, value in expected.items():
+        assert getattr(sph, name).dtype == np.float32
+        assert np.array_equal(getattr(sph, name), value)
+
+    # Columns are converted once and then returned from the cache
+    assert sph.x is sph.x
+    assert SPHng(filename, temp=False).temp is None
+
+
+@pytest.mark.parametrize('fields', [None, ['hsml'], []])
+def test_read_sph_fields_match_eager_read(tmp_path, fields):
+    files, data = write_snapshot(tmp_path)
+    expected = eager_gadget(data)
+    bbox = 100 * u.au.to(u.cm)
+    keep = np.all(np.abs([expected[c] for c in 'xyz']) <= bbox, axis=0)
+    assert 0 < keep.sum() < keep.size
+
+    grid = CartesianGrid(ncells=8, bbox=bbox, temp=True)
+    grid.read_sph(str(files[0]), source='gadget', nproc=2, fields=fields)
+
+    for name in 'xyz':
+        assert np.allclose(getattr(grid, name), expected[name][keep], 
+            rtol=1e-12, atol=0)
+    assert np.allclose(grid.dens, expected['rho_g'][keep] / 100, rtol=1e-12)
+    assert np.array_equal(grid.temp, expected['temp'][keep])
+
+    # Only the requested fields are stored, and read from disk
+    stored = ['mass', 'hsml'] if fields is None else fields
+    for name in ['mass', 'hsml']:
+        if name in stored:
+            assert np.allclose(
+                getattr(grid, name), expected[name][keep], rtol=1e-12)
+        else:
+            assert getattr(grid, name, None) is None
+    read = {'mass': 'Masses', 'hsml': 'SmoothingLength'}
+    assert set(grid.sph._cache) == {'Coordinates', 'Density', 
+        'Temperature', *[read[name] for name in stored]}
@@ -0,0 +1,59 @@
+import os
+import pytest
+import numpy as np
+
+from synthesizer import utils
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+
+def read_header(filename, count):
+    return np.fromfile(filename, dtype=np.int64, count=count).tolist()
+
+
+@pytest.mark.parametrize('dtype, precis', [(np.float64, 8), (np.float32, 4)])
+def test_binary_scalar_field_round_trip(dtype, precis):
+    species = [np.linspace(1, 2, 10, dtype=dtype), np.zeros(10, dtype=dtype)]
+    open('dust_density.inp', 'w').close()
+    utils.write_radmc3d_file('dust_density.inp', species, nrspec=2, 
+        binary=True)
+
+    assert not os.path.exists('dust_density.inp')
+    assert read_header('dust_density.binp', 4) == [1, precis, 10, 2]
+    assert os.path.getsize('dust_density.binp') == 8 * 4 + precis * 20
+
+    data = utils.read_radmc3d_file('dust_density.inp', skip=3)
+    assert data.dtype == dtype
+    assert np.array_equal(data, np.concatenate(species))
+
+
+def test_binary_vector_field_round_trip():
+    vectors = np.random.default_rng(0).normal(size=(50, 3))
+    open('grainalign_dir.inp', 'w').close()
+    utils.write_radmc3d_file('grainalign_dir.inp', 
+        iter([vectors[:20], vectors[20:]]), nrcells=50, binary=True, 
+        chunksize=7)
+
+    assert not os.path.exists('grainalign_dir.inp')
+    assert read_header('grainalign_dir.binp', 3) == [1, 8, 50]
+    data = utils.read_radmc3d_file('grainalign_dir.inp', skip=2)
+    assert np.array_equal(data, vectors.ravel())
+
+
+def test_ascii_replaces_binary():
+    temp = np.linspace(10, 100, 8)
+    utils.write_radmc3d_file('dust_temperature.dat', temp, nrspec=1, 
+        binary=True)
+    assert os.path.exists('dust_temperature.bdat')
+    assert read_header('dust_temperature.bdat', 4) == [1, 8, 8, 1]
+
+    utils.write_radmc3d_file('dust_temperature.dat', temp, nrspec=1)
+    assert not os.path.exists('dust_temperature.bdat')
+    with open('dust_temperature.dat') as f:
+        assert f.read().split()[:3] == ['1', '8', '1']
+
+    data = utils.read_radmc3d_file('dust_temperature.dat', skip=3)
+    assert np.allclose(data, temp, rtol=1e-6)
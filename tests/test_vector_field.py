@@ -0,0 +1,91 @@
+import pytest
+import numpy as np
+
+from synthesizer.gridder import vector_field
+from synthesizer.gridder.vector_field import VectorField
+from synthesizer.gridder.analytical import evaluate_vector_field
+
+morphologies = ['x', 'y', 'z', 't', 'r', 'h', 'hel', 'd', 'q']
+
+
+def coordinates(sparse):
+    """ Cell centers of a small grid with a different size per axis """
+    axes = [np.linspace(-1, 1, n) * 1e16 + 1e14 for n in [6, 5, 4]]
+    return np.meshgrid(*axes, indexing='ij', sparse=sparse)
+
+
+def dense_field(x, y, z, morphology):
+    """ Normalized components of each morphology, evaluated on a full grid """
+    one, zero = np.ones(x.shape), np.zeros(x.shape)
+    a = 5e-34
+    factor = 1 / np.sqrt(
+        1 + (a*x*z)**2*np.exp(-2*a*z*z) + (a*y*z)**2*np.exp(-2*a*z*z))
+    hour = [a*x*z*np.exp(-a*z*z) * factor, a*y*z*np.exp(-a*z*z) * factor,
+        factor]
+    toro = [y / np.sqrt(x**2 + y**2), -x / np.sqrt(x**2 + y**2), zero]
+    r = np.sqrt(x**2 + y**2 + z**2)
+
+    v = {
+        'x': [one, zero, zero],
+        'y': [zero, one, zero],
+        'z': [zero, zero, one],
+        't': toro,
+        'r': [x / r, y / r, z / r],
+        'h': hour,
+        'hel': [toro[0] + hour[0], toro[1] + hour[1], one],
+        'd': [3*x*z / r**5, 3*y*z / r**5, (2*z*z - x*x - y*y) / r**5],
+        'q': [-3*x*(x**2 + y**2 - 4*z**2), -3*y*(x**2 + y**2 - 4*z**2),
+            3*z*(-3*x**2 - 3*y**2 + 2*z**2)],
+    }[morphology]
+
+    norm = np.sqrt(sum(c**2 for c in v))
+    return [c / norm for c in v]
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+@pytest.mark.parametrize('morphology', morphologies)
+def test_compact_field_matches_dense_field(morphology, dtype):
+    expected = [v.astype(dtype) for v in
+        dense_field(*coordinates(sparse=False), morphology)]
+    rtol = 1e-12 if dtype == np.float64 else 1e-6
+
+    vfield = VectorField(*coordinates(sparse=True), morphology, dtype=dtype)
+    if morphology in VectorField.compact:
+        assert sum(c.size for c in vfield.components) < 3 * vfield.ncells
+
+    for c, v, e in zip(vfield.components, [vfield.vx, vfield.vy, vfield.vz],
+            expected):
+        assert c.dtype == dtype
+        assert v.shape == e.shape
+        assert np.allclose(np.broadcast_to(c, e.shape), e, rtol=rtol, atol=0)
+        assert np.allclose(v, e, rtol=rtol, atol=0)
+
+    # Rows expand in the fortran-style order of the RADMC3D files
+    rows = np.concatenate(list(vfield.rows()))
+    assert rows.dtype == dtype
+    assert np.allclose(rows, np.column_stack(
+        [e.ravel(order='F') for e in expected]), rtol=rtol, atol=0)
+
+    # Evaluated in slabs, as done by the analytical models
+    slabs = evaluate_vector_field(*coordinates(sparse=True), morphology,
+        dtype=dtype, nthreads=2)
+    for v, e in zip([slabs.vx, slabs.vy, slabs.vz], expected):
+        assert np.allclose(v, e, rtol=rtol, atol=0)
+
+
+def test_rows_of_compact_and_flat_components():
+    x, y, z = coordinates(sparse=True)
+    shape = np.broadcast(x, y, z).shape
+    components = [x, np.ones(()), y * z]
+
+    rows = list(vector_field.rows(*components, shape))
+    assert len(rows) == shape[-1]
+    assert np.array_equal(np.concatenate(rows), np.column_stack(
+        [np.broadcast_to(c, shape).ravel(order='F') for c in components]))
+
+    # Components of unstructured grids, like the leaves of oct-trees
+    flat = [np.arange(5.), np.ones(()), np.zeros(5)]
+    rows = list(vector_field.rows(*flat, (5,)))
+    assert len(rows) == 1
+    assert np.array_equal(rows[0], np.column_stack(
+        [np.broadcast_to(c, (5,)) for c in flat]))